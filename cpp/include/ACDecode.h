@@ -32,6 +32,11 @@ public:
     void finish();
 
     void shift() override;
+
+    // heap memory owned by the coder
+    [[nodiscard]] size_t footprint() const {
+        return buffer.capacity() / 8 + bitout.footprint();
+    }
 };
 
 [[maybe_unused]] void deflating(FreqTable &freqs, istream &inStream, BitOutStream out);
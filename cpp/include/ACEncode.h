@@ -54,6 +54,26 @@ void inflating(FreqTable &freqs, BitInStream &bitin, T &out, int minLen = 0) {
     }
 }
 
+class PacketEncoder {
+    /*
+     * Encodes one packet and keeps the state of the coder after the end of the packet, so that the sequence can
+     * later be extended to a larger minimal length with the same result as encoding the packet with that length.
+     */
+public:
+    PacketEncoder(const string &data, uint8_t sync, const FreqTable &freqs);
+
+    // continues encoding until the packet is encoded completely and the sequence has at least minLen bases
+    void encode(size_t minLen);
+
+    vector<unsigned char> out;
+
+private:
+    stringstream inStream;
+    BitInStream bitin;
+    FreqTable freqs;
+    Inflate inf;
+};
+
 extern void do_encode(const string &data, uint8_t sync, FreqTable freqs, uint16_t minLen, const string &filename,
                       list<tuple<string, vector<unsigned char>>> &results, std::mutex *res_lock);
 
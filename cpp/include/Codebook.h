@@ -0,0 +1,60 @@
+//
+// Created by michael on 18.10.26.
+//
+
+#ifndef ARITHMETIC_MODULATOR_ERROR_CORRECTION_CODEBOOK_H
+#define ARITHMETIC_MODULATOR_ERROR_CORRECTION_CODEBOOK_H
+
+#include "include/FreqTable.h"
+#include "include/ProbAutomaton.h"
+#include "single_include/nlohmann/json.hpp"
+#include "single_include/robin_hood.h"
+
+using namespace std;
+
+/*
+ * All state derived from the code book and the concatenation scheme that is shared by the en- and decoder.
+ * The FreqTable keeps pointers to motif, pMap and freqStates, so a Codebook can neither be copied nor moved.
+ * freqStates (probabilities of the arithmetic coder) and decodeStates (next-base probabilities of the decoder
+ * metric) are the compiled state machines of pMap and tMap, see ProbAutomaton.
+ *
+ * The derived tables are cached in a compiled code book (same path as the code book, extension .cbc), see
+ * generate_codebook.py for the format. The cache is only used if the CRC32 and size of both source files match,
+ * otherwise it is rebuilt from the sources. codewords is only filled if the tables were built from the sources.
+ */
+struct Codebook {
+    string wordsPath;
+    string motifsPath;
+    robin_hood::unordered_set<string> codewords;
+    string2stringVec motif;
+    int codewordLen;
+    string2int32 freqDict;
+    robin_hood::unordered_map<string, char2double> pMap;
+    robin_hood::unordered_map<string, char2double> tMap;
+    bool compiled;
+    ProbAutomaton freqStates;
+    ProbAutomaton decodeStates;
+    FreqTable freqs;
+
+    Codebook(const string &words, const string &motifs, bool useCache = true);
+
+    Codebook(const Codebook &other) = delete;
+
+    Codebook &operator=(const Codebook &other) = delete;
+
+    // the normalized transition map and its state machine are only needed for decoding
+    void buildDecodeMap();
+
+    [[nodiscard]] bool matches(const nlohmann::json &config) const;
+
+    static string compiledPath(const string &words);
+
+    bool writeCompiled(const string &path);
+
+private:
+    bool loadOrBuild(bool useCache);
+
+    bool loadCompiled(const string &path);
+};
+
+#endif //ARITHMETIC_MODULATOR_ERROR_CORRECTION_CODEBOOK_H
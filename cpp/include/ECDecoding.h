@@ -7,9 +7,13 @@
 
 #include <mutex>
 #include <memory>
+#include <atomic>
+#include <chrono>
+#include <optional>
 
 #include "include/FreqTable.h"
 #include "include/ProbabilityEval.h"
+#include "include/ProbAutomaton.h"
 #include "include/ACDecode.h"
 #include "include/bitIO.h"
 #include "absl/container/btree_set.h"
@@ -26,11 +30,18 @@ struct SeqEntry {
     Deflate ac;
     FreqTable freq;
     string lastCrc;
+    // state of seq in the state machine of the decoder metric
+    uint32_t state = ProbAutomaton::start;
 
     bool operator<(const SeqEntry &comp) const {
         return metric < comp.metric;
     }
 
+    // estimated memory of the entry, including the memory owned by its members
+    [[nodiscard]] size_t footprint() const {
+        return sizeof(SeqEntry) + seq.capacity() + lastCrc.capacity() + ac.footprint() + freq.footprint();
+    }
+
     SeqEntry(const SeqEntry &other) = default;
 
     SeqEntry(double metric, string &seq, int pos, Deflate acDeflate, FreqTable &freqTable, string lCrc = "") :
@@ -43,6 +54,27 @@ struct SeqEntry {
 
 };
 
+// statistics of a single decode
+struct DecodeStats {
+    // peak (estimated) memory of the search queue and the crc checkpoints
+    uint64_t peakBytes = 0;
+    // number of search steps
+    uint64_t nodes = 0;
+    // largest queue size and number of times the queue was cut down to decode.queue.reduce
+    uint64_t peakQueue = 0;
+    uint64_t queueReductions = 0;
+    // failed sync checks counted against a crc checkpoint, and steps back to an earlier checkpoint
+    // after a checkpoint failed more than decode.threshold.checkpoint times
+    uint64_t checkpointFailures = 0;
+    uint64_t backtracks = 0;
+    // set by do_decode: wall-clock time, final metric (empty if no candidate was found) and success
+    double seconds = 0;
+    std::optional<double> metric;
+    bool success = false;
+
+    [[nodiscard]] nlohmann::json toJson() const;
+};
+
 struct compare_ptr {
     bool operator() (const std::unique_ptr<SeqEntry> &lhs, const std::unique_ptr<SeqEntry> &rhs) const {
        return lhs->metric < rhs->metric;
@@ -61,12 +93,26 @@ private:
     absl::btree_multiset<std::unique_ptr<SeqEntry>, compare_ptr> queue;
     robin_hood::unordered_map<string, std::pair<int, SeqEntry>> crcCheckpoints;
     vector<SeqEntry> candidates;
-    robin_hood::unordered_map<string, char2double> &probMap;
+    const ProbAutomaton &states;
     bool seqFlag;
     double errorProb;
     array<int, 2> rate;
     array<double, 2> fanos;
+    // fano increments per read position from the base qualities (FASTQ input), empty to use fanos for all positions
+    vector<array<double, 2>> positionFanos;
     int queueCounter;
+    // per read budget: maximal number of search steps and wall-clock deadline (0 / max for unlimited)
+    uint64_t nodeBudget;
+    uint64_t nodeCount;
+    chrono::steady_clock::time_point deadline;
+    // estimated memory of the queue, the beam (beam search) and the crc checkpoints
+    uint64_t queueBytes;
+    uint64_t beamBytes;
+    uint64_t checkpointBytes;
+    uint64_t peakBytes;
+    uint64_t peakQueue;
+    uint64_t checkpointFailures;
+    uint64_t backtracks;
     nlohmann::json config;
 
 
@@ -77,45 +123,69 @@ private:
     static char defaultReturn(string &basicString, uint32_t index);
 
     void updateState(SeqEntry &sequence,
-                     bool hit, char2double &nextProbs, char base, int increNum);
+                     bool hit, const BaseProbs &nextProbs, char base, int increNum);
 
     void write(char symbol);
 
     void metricProbs(SeqEntry &sequence,
-                     array<double, 2> &fanoMetrics, char2double &nextProbs, array<char, 4> &bases);
+                     array<double, 2> &fanoMetrics, const BaseProbs &nextProbs, array<char, 4> &bases);
 
-    void fanoCheck(SeqEntry &sequence, char2double &nextProbs, char base);
+    void fanoCheck(SeqEntry &sequence, const BaseProbs &nextProbs, char base);
 
     void checkDels(SeqEntry &sequence);
 
-    void checkIns(SeqEntry &sequence, char base, char2double &nextProbs);
+    void checkIns(SeqEntry &sequence, char base, const BaseProbs &nextProbs);
 
     void queueInsert(SeqEntry &sequence);
 
+    SeqEntry queuePop();
+
+    void checkpointInsert(const SeqEntry &sequence);
+
     void queueCheck(array<double, 2> &fanoMetrics, array<char, 4> &bases);
 
-    char2double calcNextProbs(SeqEntry &bestSequence);
+    [[nodiscard]] BaseProbs calcNextProbs(const SeqEntry &bestSequence) const;
+
+    void checkBudget();
 
     void mainLoop(array<double, 2> &fanoMetrics, array<char, 4> &bases, int itCount);
 
+    SeqEntry seed(array<double, 2> &fanoMetrics, array<char, 4> &bases);
+
+    void resetSearch();
+
+    SeqEntry stackDecode(array<double, 2> &fanoMetrics, array<char, 4> &bases, nlohmann::json &config);
+
+    void nextBeam(vector<SeqEntry> &beam, size_t width);
+
+    SeqEntry beamDecode(array<double, 2> &fanoMetrics, array<char, 4> &bases, size_t width);
+
     SeqEntry checkCandidate(SeqEntry &can, unsigned long threshold);
 
     static array<double, 2> getFanos(double errorProb, array<int, 2> &rate);
 
+    [[nodiscard]] const array<double, 2> &fanosAt(uint32_t pos) const;
+
     long double calcFano(double &probsBase, long double &probsCurrSeq, bool hit) const;
 
 
 public:
-    ECdecoding(string inp, FreqTable &freqs, robin_hood::unordered_map<string, char2double> &probMap,
-               bool withCWProbs, nlohmann::json &config);
+    ECdecoding(string inp, FreqTable &freqs, const ProbAutomaton &states,
+               bool withCWProbs, nlohmann::json &config, const string &quality = "");
+
+    SeqEntry decode(nlohmann::json &config);
 
-    SeqEntry decode(int codewordLen, robin_hood::unordered_map<string, vector<string>> &conc, nlohmann::json &config);
+    [[nodiscard]] DecodeStats stats() const;
 
 };
 
+// set to stop all queued and running decodes, e.g. once the outer decoder has recovered the file
+extern std::atomic<bool> decodeCancelled;
+
 extern void do_decode(const string &inp, FreqTable &freqs,
                       robin_hood::unordered_map<string, char2double> &tMap, robin_hood::unordered_map<string, vector<string>> &motif,
                       nlohmann::json &config, int &codewordLen, list<tuple<string, vector<unsigned char>>> &results,
-                      std::mutex *res_lock);
+                      std::mutex *res_lock, DecodeStats *stats = nullptr, const string &quality = "",
+                      const ProbAutomaton *states = nullptr);
 
 #endif //ARITHMETIC_MODULATOR_ERROR_CORRECTION_ECDECODING_H
@@ -7,30 +7,15 @@
 
 #include <iostream>
 #include <fstream>
+#include <utility>
+#include <vector>
 #include "include/debug_log.h"
 
-int write_to_fasta(const std::string &file_name, list<tuple<std::string, vector<unsigned char>>> &list_of_sequences) {
+inline std::vector<std::string> readFasta(const std::string &fileName) {
     /*
-     * Writes the given list of sequences to a fasta file.
+     * Parses a fasta file and returns all sequences in the order of the file (including duplicates).
      */
-    std::ofstream fasta_file;
-    fasta_file.open(file_name);
-    for (tuple<std::string, vector<unsigned char>> &sequence: list_of_sequences) {
-        vector<unsigned char> tmp = std::get<1>(sequence);
-        std::string seq(reinterpret_cast<const char *>(tmp.data()), tmp.size());
-        fasta_file << ">" << std::get<0>(sequence) << "\n" << seq << "\n";
-    }
-    fasta_file.flush();
-    fasta_file.close();
-    return 0;
-}
-
-
-robin_hood::unordered_set<std::string> parseFasta(const std::string &fileName) {
-    /*
-     * Parses a fasta file and returns a set of all sequences.
-     */
-    robin_hood::unordered_set<std::string> sequences = robin_hood::unordered_set<std::string>();
+    std::vector<std::string> sequences;
     std::ifstream input(fileName);
     if (!input.good()) {
         ERROR("Error opening: " << fileName << ". ");
@@ -48,7 +33,7 @@ robin_hood::unordered_set<std::string> parseFasta(const std::string &fileName) {
             // output previous line before overwriting seq_id
             // but ONLY if seq_id actually contains something
             if (!seq_id.empty())
-                sequences.insert(DNA_sequence);
+                sequences.push_back(DNA_sequence);
             seq_id = line.substr(1);
             DNA_sequence.clear();
         } else if (line[0] == ';') {
@@ -61,8 +46,49 @@ robin_hood::unordered_set<std::string> parseFasta(const std::string &fileName) {
 
     // output final entry ONLY if seq_id actually contains something
     if (!seq_id.empty())
-        sequences.insert(DNA_sequence);
+        sequences.push_back(DNA_sequence);
     return sequences;
 }
 
+inline std::vector<std::pair<std::string, std::string>> readFastq(const std::string &fileName) {
+    /*
+     * Parses a fastq file and returns all (sequence, quality) pairs in the order of the file (including duplicates).
+     */
+    std::vector<std::pair<std::string, std::string>> records;
+    std::ifstream input(fileName);
+    if (!input.good()) {
+        ERROR("Error opening: " << fileName << ". ");
+        throw std::runtime_error("Error opening: " + fileName + " .");
+    }
+    std::string line;
+    while (std::getline(input, line)) {
+        if (line.empty())
+            continue;
+        if (line[0] != '@')
+            throw std::runtime_error("Invalid fastq record in " + fileName + ": " + line);
+        std::string DNA_sequence, quality;
+        // the sequence may span several lines up to the "+" separator, the quality has the same length
+        while (std::getline(input, line) && (line.empty() || line[0] != '+'))
+            DNA_sequence += line;
+        while (quality.size() < DNA_sequence.size() && std::getline(input, line))
+            quality += line;
+        if (quality.size() != DNA_sequence.size())
+            throw std::runtime_error("Sequence and quality length differ in " + fileName + ".");
+        records.emplace_back(std::move(DNA_sequence), std::move(quality));
+    }
+    return records;
+}
+
+inline bool isFastq(const std::string &fileName) {
+    return fileName.ends_with(".fastq") || fileName.ends_with(".fq");
+}
+
+inline robin_hood::unordered_set<std::string> parseFasta(const std::string &fileName) {
+    /*
+     * Parses a fasta file and returns a set of all sequences.
+     */
+    std::vector<std::string> sequences = readFasta(fileName);
+    return robin_hood::unordered_set<std::string>(sequences.begin(), sequences.end());
+}
+
 #endif //ARITHMETIC_MODULATOR_ERROR_CORRECTION_FASTAPARSER_H
@@ -6,17 +6,26 @@
 #define ARITHMETIC_MODULATOR_ERROR_CORRECTION_FREQTABLE_H
 
 #include "ProbabilityEval.h"
+#include "ProbAutomaton.h"
 #include <single_include/nlohmann/json.hpp>
 #include <fstream>
 #include <iostream>
+#include <array>
 
 using namespace std;
 class FreqTable: public ProbabilityEval {
     private:
         uint16_t wordEnd;
+        // only the symbols of the current distribution are stored (sorted), instead of a table for all 256 symbols,
+        // as every candidate of the decoder owns a copy.
+        array<uint8_t, 4> symbols{};
+        array<double, 4> symFreqs{};
+        uint8_t numSymbols{0};
+        // compiled state machine of the code book (see useAutomaton) and the state of the sequence so far
+        const ProbAutomaton *automaton{nullptr};
+        uint32_t state{ProbAutomaton::start};
 
         void setTotal(double csum);
-        void initCum();
         void checkSym(int symbol) const;
         void setFreqs(robin_hood::unordered_map<string, char2double> &usedMap);
 
@@ -24,19 +33,22 @@ class FreqTable: public ProbabilityEval {
     public:
         FreqTable(string2stringVec& motif, string seq,
                            int start, bool normalized, int codewordLen, robin_hood::unordered_map<string, char2double>& pDict);
-        vector<double> cumulative;
         int total{};
         int start;
-        vector<double> frequencies;
         uint8_t codewordLen;
 
         [[nodiscard]] uint32_t getSymLimit() const;
         double get(int symbol);
         void calcNewFreqs(char newSym);
         void calcFreqs();
+        // use the compiled state machine instead of evaluating the concatenation scheme for every symbol, the
+        // automaton has to be built from the same motifs and probabilities (without acrossWords) and outlive the table
+        void useAutomaton(const ProbAutomaton *states);
         [[nodiscard]] uint64_t getTotal() const;
         [[nodiscard]] uint64_t getLow(int symbol);
         [[nodiscard]] uint64_t getHigh(int symbol);
+        // estimated heap memory owned by this table
+        [[nodiscard]] size_t footprint() const;
 };
 
 
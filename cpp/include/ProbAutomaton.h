@@ -0,0 +1,92 @@
+//
+// Dense state machine of the next-base probabilities of a code book and its concatenation scheme.
+//
+
+#ifndef ARITHMETIC_MODULATOR_ERROR_CORRECTION_PROBAUTOMATON_H
+#define ARITHMETIC_MODULATOR_ERROR_CORRECTION_PROBAUTOMATON_H
+
+#include <array>
+#include <cstdint>
+#include <vector>
+#include "ProbabilityEval.h"
+
+using namespace std;
+
+class ProbAutomaton {
+    /*
+     * Every state stands for a prefix of the current code word together with the motif context of the code words
+     * before it, as far as the context still matters for the rest of the code word. The transitions and the
+     * next-base probabilities of all states are stored in flat arrays, so a sequence is tracked by a single state id
+     * that is advanced in O(1), without allocations or locks.
+     *
+     * The probabilities are the ones ProbabilityEval (acrossWords) or FreqTable (!acrossWords) compute for the same
+     * sequence: after every complete code word, the probabilities of the prefixes that would continue an undesired
+     * motif are replaced, where the motif keys are matched against the whole sequence (acrossWords) or only against
+     * the last code word. Bases with a probability of zero are never appended by the en- or decoder, they lead to a
+     * dead state with all probabilities zero.
+     */
+public:
+    static constexpr uint32_t start = 0;
+
+    ProbAutomaton() = default;
+
+    ProbAutomaton(const string2stringVec &motif, int codewordLen,
+                  const robin_hood::unordered_map<string, char2double> &probDict, bool acrossWords);
+
+    // index of a base in the probability arrays (A, C, G, T), -1 for any other symbol
+    static int baseIndex(char base) {
+        switch (base) {
+            case 'A':
+                return 0;
+            case 'C':
+                return 1;
+            case 'G':
+                return 2;
+            case 'T':
+                return 3;
+            default:
+                return -1;
+        }
+    }
+
+    [[nodiscard]] uint32_t next(uint32_t state, char base) const {
+        int idx = baseIndex(base);
+        return idx < 0 ? dead : transitions[state * 4 + idx];
+    }
+
+    // probabilities of A, C, G and T after the sequence of the state
+    [[nodiscard]] const double *probs(uint32_t state) const {
+        return &stateProbs[state * 4];
+    }
+
+    [[nodiscard]] size_t size() const {
+        return transitions.size() / 4;
+    }
+
+    [[nodiscard]] bool empty() const {
+        return transitions.empty();
+    }
+
+private:
+    uint32_t dead = 0;
+    vector<uint32_t> transitions;
+    vector<double> stateProbs;
+};
+
+class BaseProbs {
+    /*
+     * Next-base probabilities of a state, indexed by the base.
+     */
+public:
+    explicit BaseProbs(const double *probs) : probs(probs) {}
+
+    double operator[](char base) const {
+        int idx = ProbAutomaton::baseIndex(base);
+        return idx < 0 ? 0.0 : probs[idx];
+    }
+
+private:
+    const double *probs;
+};
+
+#endif //ARITHMETIC_MODULATOR_ERROR_CORRECTION_PROBAUTOMATON_H
@@ -32,11 +32,12 @@ protected:
     void removeMotifs();
 
 public:
-    ProbabilityEval(string &seq, string2stringVec& motif, int start,
+    ProbabilityEval(string &seq, const string2stringVec& motif, int start,
                     bool normalized,int codewordLen, robin_hood::unordered_map<string, char2double> *probDict);
 
     int codewordLen;
-    string2stringVec motif;
+    // shared by all copies, the concatenation scheme is owned by the code book
+    const string2stringVec *motif;
     string seq;
     int length;
     int start;
@@ -0,0 +1,193 @@
+//
+// Completion-driven job scheduler with ordered result delivery, and progress reporting.
+//
+
+#ifndef ARITHMETIC_MODULATOR_ERROR_CORRECTION_SCHEDULER_H
+#define ARITHMETIC_MODULATOR_ERROR_CORRECTION_SCHEDULER_H
+
+#include <chrono>
+#include <condition_variable>
+#include <deque>
+#include <exception>
+#include <functional>
+#include <iostream>
+#include <map>
+#include <mutex>
+#include <optional>
+#include <thread>
+#include <utility>
+#include <vector>
+#include "single_include/nlohmann/json.hpp"
+
+template<typename T>
+class OrderedScheduler {
+    /*
+     * Runs the submitted jobs on a fixed number of threads, every thread takes the next job as soon as it is done.
+     * Each result is handed to consume as soon as it and the results of all earlier jobs are available (in
+     * completion order if ordered is false). consume is called by the thread that completed the job, never
+     * concurrently, so that no thread has to poll for results. At most window jobs are queued, running or waiting
+     * for an earlier result, submit blocks until there is room, which bounds the memory of the buffered results.
+     */
+public:
+    OrderedScheduler(int threads, std::function<void(T &&)> consume, bool ordered = true, size_t window = 0) :
+            consume(std::move(consume)),
+            ordered(ordered),
+            window(window ? window : static_cast<size_t>(std::max(threads, 1)) * 256) {
+        for (int i = 0; i < std::max(threads, 1); i++)
+            workers.emplace_back(&OrderedScheduler::work, this);
+    }
+
+    OrderedScheduler(const OrderedScheduler &) = delete;
+
+    OrderedScheduler &operator=(const OrderedScheduler &) = delete;
+
+    ~OrderedScheduler() {
+        try {
+            finish();
+        } catch (...) {}
+    }
+
+    void submit(std::function<T()> job) {
+        std::unique_lock<std::mutex> uLock(lock);
+        roomAvailable.wait(uLock, [this] { return submitted - consumed < window; });
+        jobs.emplace_back(submitted++, std::move(job));
+        jobAvailable.notify_one();
+    }
+
+    // waits until all results are consumed and stops the threads, rethrows the first exception of a job or consume
+    void finish() {
+        {
+            std::unique_lock<std::mutex> uLock(lock);
+            allConsumed.wait(uLock, [this] { return consumed == submitted; });
+            stopping = true;
+        }
+        jobAvailable.notify_all();
+        for (auto &worker: workers) {
+            if (worker.joinable())
+                worker.join();
+        }
+        if (error) {
+            std::exception_ptr err = error;
+            error = nullptr;
+            std::rethrow_exception(err);
+        }
+    }
+
+private:
+    std::function<void(T &&)> consume;
+    bool ordered;
+    size_t window;
+    std::mutex lock;
+    std::condition_variable jobAvailable;
+    std::condition_variable roomAvailable;
+    std::condition_variable allConsumed;
+    std::deque<std::pair<size_t, std::function<T()>>> jobs;
+    // finished results waiting for an earlier one, empty if the job failed
+    std::map<size_t, std::optional<T>> ready;
+    size_t submitted = 0;
+    size_t completed = 0;
+    size_t consumed = 0;
+    bool consuming = false;
+    bool stopping = false;
+    std::exception_ptr error;
+    std::vector<std::thread> workers;
+
+    void fail(std::exception_ptr err) {
+        if (!error)
+            error = std::move(err);
+    }
+
+    void work() {
+        std::unique_lock<std::mutex> uLock(lock);
+        while (true) {
+            jobAvailable.wait(uLock, [this] { return !jobs.empty() || stopping; });
+            if (jobs.empty())
+                return;
+            auto [index, job] = std::move(jobs.front());
+            jobs.pop_front();
+            uLock.unlock();
+            std::optional<T> res;
+            std::exception_ptr err;
+            try {
+                res.emplace(job());
+            } catch (...) {
+                err = std::current_exception();
+            }
+            uLock.lock();
+            if (err)
+                fail(err);
+            ready.emplace(ordered ? index : completed, std::move(res));
+            completed++;
+            // the thread that is already consuming also picks up this result
+            if (consuming)
+                continue;
+            consuming = true;
+            while (!ready.empty() && ready.begin()->first == consumed) {
+                std::optional<T> next = std::move(ready.begin()->second);
+                ready.erase(ready.begin());
+                uLock.unlock();
+                std::exception_ptr consumeErr;
+                try {
+                    if (next)
+                        consume(std::move(*next));
+                } catch (...) {
+                    consumeErr = std::current_exception();
+                }
+                uLock.lock();
+                if (consumeErr)
+                    fail(consumeErr);
+                consumed++;
+                roomAvailable.notify_all();
+                if (consumed == submitted)
+                    allConsumed.notify_all();
+            }
+            consuming = false;
+        }
+    }
+};
+
+class Progress {
+    /*
+     * Reports the progress of a job as a json line ("PROGRESS {...}") on stderr, at most every interval seconds
+     * (0: never) and after the last update. The lines are picked up by encode.py and decode.py.
+     */
+public:
+    Progress(std::string stage, size_t pass, long total, double interval) :
+            stage(std::move(stage)),
+            pass(pass),
+            total(total),
+            interval(interval),
+            start(std::chrono::steady_clock::now()),
+            lastReport(start) {}
+
+    void update(size_t done) {
+        auto now = std::chrono::steady_clock::now();
+        if (interval > 0 && std::chrono::duration<double>(now - lastReport).count() >= interval) {
+            report(done, now);
+        }
+    }
+
+    void finish(size_t done) {
+        if (interval > 0)
+            report(done, std::chrono::steady_clock::now());
+    }
+
+private:
+    std::string stage;
+    size_t pass;
+    long total;
+    double interval;
+    std::chrono::steady_clock::time_point start;
+    std::chrono::steady_clock::time_point lastReport;
+
+    void report(size_t done, std::chrono::steady_clock::time_point now) {
+        lastReport = now;
+        double seconds = std::chrono::duration<double>(now - start).count();
+        nlohmann::json msg = {{"stage", stage}, {"pass", pass}, {"done", done},
+                              {"total", total < 0 ? nlohmann::json() : nlohmann::json(total)},
+                              {"seconds", seconds}, {"per_second", seconds > 0 ? done / seconds : 0.0}};
+        std::cerr << "PROGRESS " << msg.dump() << std::endl;
+    }
+};
+
+#endif //ARITHMETIC_MODULATOR_ERROR_CORRECTION_SCHEDULER_H
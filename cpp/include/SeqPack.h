@@ -0,0 +1,79 @@
+//
+// 2 bit packed, memory mapped sequence container (see seqpack.py for the layout).
+//
+
+#ifndef ARITHMETIC_MODULATOR_ERROR_CORRECTION_SEQPACK_H
+#define ARITHMETIC_MODULATOR_ERROR_CORRECTION_SEQPACK_H
+
+#include <cstdint>
+#include <string>
+#include <vector>
+#include "commons.h"
+
+using namespace std;
+
+inline bool isPacked(const string &fileName) {
+    return fileName.ends_with(".dnapack");
+}
+
+class PackedWriter : public ResultWriter {
+    /*
+     * Writes the sequences (the names are not kept) as packed bases while they come in, only the offsets and the
+     * escapes (symbols besides A, C, G and T) are kept in memory until the file is closed.
+     */
+public:
+    explicit PackedWriter(const string &outputFile);
+
+    ~PackedWriter() override;
+
+    void write(const string &name, const vector<unsigned char> &data) override;
+
+    void close() override;
+
+private:
+    string path;
+    ofstream out;
+    vector<uint64_t> offsets = {0};
+    vector<uint64_t> escapePos;
+    string escapeSym;
+    uint8_t pending = 0;
+};
+
+class PackedSequences {
+    /*
+     * Read-only view of a packed sequence file, the file is memory mapped and the sequences are unpacked on access.
+     */
+public:
+    explicit PackedSequences(const string &fileName);
+
+    ~PackedSequences();
+
+    PackedSequences(const PackedSequences &) = delete;
+
+    PackedSequences &operator=(const PackedSequences &) = delete;
+
+    [[nodiscard]] size_t size() const {
+        return count;
+    }
+
+    [[nodiscard]] string get(size_t i) const;
+
+private:
+    const unsigned char *data = nullptr;
+    size_t length = 0;
+    size_t count = 0;
+    const unsigned char *packed = nullptr;
+    const unsigned char *offsets = nullptr;
+    const unsigned char *escapePos = nullptr;
+    const unsigned char *escapeSym = nullptr;
+    uint64_t numEscapes = 0;
+
+    [[nodiscard]] uint64_t offset(size_t i) const;
+
+    [[nodiscard]] uint64_t escape(size_t i) const;
+};
+
+// all sequences of a packed sequence file in the order of the file (including duplicates), like readFasta
+extern vector<string> readPacked(const string &fileName);
+
+#endif //ARITHMETIC_MODULATOR_ERROR_CORRECTION_SEQPACK_H
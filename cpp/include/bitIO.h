@@ -73,6 +73,10 @@ public:
         [[nodiscard]] const vector<unsigned char> *get_data() {
             return &out.data;
         }
+        // heap memory owned by the stream
+        [[nodiscard]] size_t footprint() const {
+            return out.data.capacity() + wBuffer.capacity() + crcBuffer.capacity();
+        }
 };
 
 
@@ -8,13 +8,91 @@
 #include "absl/container/flat_hash_set.h"
 #include "absl/container/flat_hash_map.h"
 #include "single_include/robin_hood.h"
+#include <fstream>
+#include <memory>
 
 using namespace std;
 
-extern void write_to_zip(string outputFile, bool add_index, bool most_common_only, bool decodable_only, list <tuple<string, vector<unsigned char>>> &results);
+class ResultWriter {
+    /*
+     * Output of the en-/decoded packets, the results are written one by one as soon as they are available.
+     */
+public:
+    virtual ~ResultWriter() = default;
+
+    virtual void write(const string &name, const vector<unsigned char> &data) = 0;
+
+    // false if the output can not be written anymore (e.g. the consumer of a stream has closed it)
+    virtual bool good() { return true; }
+
+    virtual void close() {}
+};
+
+class FastaWriter : public ResultWriter {
+public:
+    explicit FastaWriter(const string &outputFile);
+
+    void write(const string &name, const vector<unsigned char> &data) override;
+
+    void close() override;
+
+private:
+    string path;
+    ofstream out;
+};
+
+class ZipWriter : public ResultWriter {
+    /*
+     * Writes the entries as uncompressed zip archive while they come in, only the offsets, sizes and crcs of the
+     * entries are kept in memory. With most_common_only, the entries that differ in size from the most common size
+     * are left out of the central directory on close, so that they are not part of the archive.
+     */
+public:
+    ZipWriter(string outputFile, bool add_index, bool most_common_only, bool decodable_only);
+
+    void write(const string &name, const vector<unsigned char> &data) override;
+
+    void close() override;
+
+private:
+    struct Entry {
+        string name;
+        uint32_t crc;
+        uint64_t size;
+        uint64_t offset;
+    };
+    string path;
+    ofstream out;
+    bool addIndex;
+    bool mostCommonOnly;
+    bool decodableOnly;
+    uint64_t offset = 0;
+    vector<Entry> entries;
+};
+
+class FrameWriter : public ResultWriter {
+    /*
+     * Writes the entries as frames (see writeFrame) and flushes after every entry. Undecodable packets are dropped,
+     * as the consumer can not tell them apart.
+     */
+public:
+    explicit FrameWriter(ostream &out);
+
+    void write(const string &name, const vector<unsigned char> &data) override;
+
+    bool good() override;
+
+private:
+    ostream &out;
+    size_t count = 0;
+};
 
 extern robin_hood::unordered_map<string, vector<string>> readConcScheme(const string &concScheme);
 
 extern int getCodewordLen(robin_hood::unordered_set<string> &codewords);
 
+extern bool readFrame(istream &in, string &name, string &data);
+
+extern void writeFrame(ostream &out, const string &name, const vector<unsigned char> &data);
+
 #endif //ARITHMETIC_MODULATOR_ERROR_CORRECTION_COMMONS_H
@@ -71,15 +71,25 @@ int Inflate::readCB() {
     return temp;
 }
 
+PacketEncoder::PacketEncoder(const string &data, uint8_t sync, const FreqTable &freqs) :
+        inStream(data),
+        bitin(inStream, sync),
+        freqs(freqs),
+        inf(16, bitin) {}
+
+void PacketEncoder::encode(size_t minLen) {
+    // same stopping rule as inflating: once the input is consumed, it stays consumed, so continuing with a larger
+    // minLen gives the sequence encoding with that minLen from the start would give
+    while (out.empty() || out.size() < minLen || !(inf.readingDone && bitin.streamDone && bitin.remBits <= 0)) {
+        out.push_back(static_cast<unsigned char>(inf.read(freqs)));
+    }
+}
+
 void do_encode(const string &data, uint8_t sync, FreqTable freqs, uint16_t minLen, const string &filename,
                list<tuple<string, vector<unsigned char>>> &results, std::mutex *res_lock) {
-    stringstream inStream(data);
-    assert(inStream.good());
-    BitInStream bin(inStream, sync);
-    stringstream out;
-    inflating(freqs, bin, out, minLen);
-    std::string out_str = out.str();
-    std::vector<unsigned char> res(out_str.begin(), out_str.end());
+    PacketEncoder enc(data, sync, freqs);
+    enc.encode(minLen);
+    std::vector<unsigned char> res = std::move(enc.out);
     {
         std::unique_lock<std::mutex> uLock(*res_lock);
         results.emplace_back(filename, res);
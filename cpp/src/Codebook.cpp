@@ -0,0 +1,267 @@
+//
+// Created by michael on 18.10.26.
+//
+
+#include "include/Codebook.h"
+#include "include/commons.h"
+#include "include/FastaParser.h"
+#include "include/debug_log.h"
+#include <filesystem>
+#include <fcntl.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include <unistd.h>
+
+#define CRCPP_USE_CPP11
+#include "single_include/CRC.h"
+
+using namespace std;
+
+static const char COMPILED_MAGIC[8] = {'A', 'E', 'O', 'N', 'C', 'B', '0', '1'};
+static const array<char, 4> COMPILED_BASES = {'A', 'C', 'G', 'T'};
+
+struct SourceHash {
+    uint32_t crc;
+    uint64_t size;
+
+    bool operator==(const SourceHash &other) const = default;
+};
+
+static SourceHash hashFile(const string &path) {
+    ifstream in(path, ios::binary);
+    if (!in.good())
+        throw runtime_error("Error opening: " + path + " .");
+    stringstream buffer;
+    buffer << in.rdbuf();
+    string data = buffer.str();
+    return {CRC::Calculate(data.data(), data.size(), CRC::CRC_32()), data.size()};
+}
+
+/*
+ * Sequential reader over the memory mapped compiled code book, all values are little endian.
+ */
+class CompiledReader {
+private:
+    const char *pos;
+    const char *end;
+
+public:
+    CompiledReader(const char *data, size_t size) : pos(data), end(data + size) {}
+
+    template<typename T>
+    T read() {
+        if (pos + sizeof(T) > end)
+            throw out_of_range("compiled code book is truncated.");
+        T val;
+        memcpy(&val, pos, sizeof(T));
+        pos += sizeof(T);
+        return val;
+    }
+
+    string readString() {
+        auto len = read<uint16_t>();
+        if (pos + len > end)
+            throw out_of_range("compiled code book is truncated.");
+        string str(pos, len);
+        pos += len;
+        return str;
+    }
+
+    void readTransitions(robin_hood::unordered_map<string, char2double> &map) {
+        auto count = read<uint32_t>();
+        map.reserve(count);
+        for (uint32_t i = 0; i < count; i++) {
+            char2double &probs = map[readString()];
+            for (char base: COMPILED_BASES)
+                probs[base] = read<double>();
+        }
+    }
+};
+
+class CompiledWriter {
+private:
+    ofstream &out;
+
+public:
+    explicit CompiledWriter(ofstream &out) : out(out) {}
+
+    template<typename T>
+    void write(T val) {
+        out.write(reinterpret_cast<const char *>(&val), sizeof(T));
+    }
+
+    void writeString(const string &str) {
+        write<uint16_t>(str.size());
+        out.write(str.data(), static_cast<streamsize>(str.size()));
+    }
+
+    void writeTransitions(const robin_hood::unordered_map<string, char2double> &map) {
+        write<uint32_t>(map.size());
+        for (const auto &[key, probs]: map) {
+            writeString(key);
+            for (char base: COMPILED_BASES) {
+                auto itr = probs.find(base);
+                write<double>(itr == probs.end() ? 0.0 : itr->second);
+            }
+        }
+    }
+};
+
+Codebook::Codebook(const string &words, const string &motifs, bool useCache) :
+        wordsPath(words),
+        motifsPath(motifs),
+        codewordLen(0),
+        compiled(loadOrBuild(useCache)),
+        freqStates(motif, codewordLen, pMap, false),
+        freqs(motif, "", 0, false, codewordLen, pMap) {
+    freqs.useAutomaton(&freqStates);
+    freqs.calcFreqs();
+}
+
+bool Codebook::loadOrBuild(bool useCache) {
+    string cachePath = compiledPath(wordsPath);
+    if (useCache) {
+        try {
+            if (loadCompiled(cachePath))
+                return true;
+        } catch (const exception &err) {
+            WARN("Could not read compiled code book " << cachePath << ": " << err.what());
+        }
+    }
+    codewords = parseFasta(wordsPath);
+    motif = readConcScheme(motifsPath);
+    codewordLen = getCodewordLen(codewords);
+    freqDict = ProbMap(codewordLen, false, codewords, motif).freqDict();
+    pMap = ProbMap(codewordLen, false, codewords, motif).createTransitionDict(freqDict);
+    if (useCache) {
+        tMap = ProbMap(codewordLen, true, codewords, motif).createTransitionDict(freqDict);
+        if (!writeCompiled(cachePath))
+            WARN("Could not write compiled code book " << cachePath);
+    }
+    return false;
+}
+
+void Codebook::buildDecodeMap() {
+    if (tMap.empty())
+        tMap = ProbMap(codewordLen, true, codewords, motif).createTransitionDict(freqDict);
+    if (decodeStates.empty())
+        decodeStates = ProbAutomaton(motif, codewordLen, tMap, true);
+}
+
+bool Codebook::matches(const nlohmann::json &config) const {
+    return config["general"]["codebook"]["words"] == wordsPath && config["general"]["codebook"]["motifs"] == motifsPath;
+}
+
+string Codebook::compiledPath(const string &words) {
+    return filesystem::path(words).replace_extension(".cbc").string();
+}
+
+bool Codebook::loadCompiled(const string &path) {
+    /*
+     * Loads the compiled code book if it was compiled from the current version of the code book and
+     * concatenation scheme. Returns false if there is no (up to date) compiled code book.
+     */
+    int fd = open(path.c_str(), O_RDONLY);
+    if (fd < 0)
+        return false;
+    struct stat st{};
+    if (fstat(fd, &st) != 0 || st.st_size == 0) {
+        close(fd);
+        return false;
+    }
+    size_t size = st.st_size;
+    void *data = mmap(nullptr, size, PROT_READ, MAP_PRIVATE, fd, 0);
+    close(fd);
+    if (data == MAP_FAILED)
+        return false;
+    bool upToDate = false;
+    try {
+        CompiledReader reader(static_cast<const char *>(data), size);
+        char magic[8];
+        for (char &c: magic)
+            c = reader.read<char>();
+        if (memcmp(magic, COMPILED_MAGIC, sizeof(magic)) == 0) {
+            SourceHash wordsHash{reader.read<uint32_t>(), reader.read<uint64_t>()};
+            SourceHash motifsHash{reader.read<uint32_t>(), reader.read<uint64_t>()};
+            upToDate = wordsHash == hashFile(wordsPath) && motifsHash == hashFile(motifsPath);
+        }
+        if (upToDate) {
+            codewordLen = static_cast<int>(reader.read<uint32_t>());
+            auto count = reader.read<uint32_t>();
+            freqDict.reserve(count);
+            for (uint32_t i = 0; i < count; i++) {
+                string key = reader.readString();
+                freqDict[key] = reader.read<int32_t>();
+            }
+            reader.readTransitions(pMap);
+            reader.readTransitions(tMap);
+            count = reader.read<uint32_t>();
+            for (uint32_t i = 0; i < count; i++) {
+                vector<string> &suffixes = motif[reader.readString()];
+                auto numSuffixes = reader.read<uint32_t>();
+                for (uint32_t j = 0; j < numSuffixes; j++)
+                    suffixes.push_back(reader.readString());
+            }
+        }
+    } catch (...) {
+        munmap(data, size);
+        freqDict.clear();
+        pMap.clear();
+        tMap.clear();
+        motif.clear();
+        throw;
+    }
+    munmap(data, size);
+    return upToDate;
+}
+
+bool Codebook::writeCompiled(const string &path) {
+    /*
+     * Writes the compiled code book to a temporary file that is then renamed, so that concurrent readers
+     * never see a partially written file.
+     */
+    if (tMap.empty())
+        tMap = ProbMap(codewordLen, true, codewords, motif).createTransitionDict(freqDict);
+    string tmpPath = path + ".tmp" + to_string(getpid());
+    {
+        ofstream out(tmpPath, ios::binary);
+        if (!out.good())
+            return false;
+        CompiledWriter writer(out);
+        out.write(COMPILED_MAGIC, sizeof(COMPILED_MAGIC));
+        SourceHash wordsHash = hashFile(wordsPath);
+        SourceHash motifsHash = hashFile(motifsPath);
+        writer.write<uint32_t>(wordsHash.crc);
+        writer.write<uint64_t>(wordsHash.size);
+        writer.write<uint32_t>(motifsHash.crc);
+        writer.write<uint64_t>(motifsHash.size);
+        writer.write<uint32_t>(codewordLen);
+        writer.write<uint32_t>(freqDict.size());
+        for (const auto &[key, count]: freqDict) {
+            writer.writeString(key);
+            writer.write<int32_t>(count);
+        }
+        writer.writeTransitions(pMap);
+        writer.writeTransitions(tMap);
+        writer.write<uint32_t>(motif.size());
+        for (const auto &[key, suffixes]: motif) {
+            writer.writeString(key);
+            writer.write<uint32_t>(suffixes.size());
+            for (const auto &suffix: suffixes)
+                writer.writeString(suffix);
+        }
+        out.flush();
+        if (!out.good()) {
+            out.close();
+            remove(tmpPath.c_str());
+            return false;
+        }
+    }
+    error_code err;
+    filesystem::rename(tmpPath, path, err);
+    if (err) {
+        remove(tmpPath.c_str());
+        return false;
+    }
+    return true;
+}
@@ -3,24 +3,48 @@
 //
 
 #include "include/ECDecoding.h"
+#include <cmath>
 #include <utility>
 #include "include/debug_log.h"
 
 using namespace std;
 
-ECdecoding::ECdecoding(string inp, FreqTable &freqs, robin_hood::unordered_map<string, char2double> &pMap, bool withCWProbs, nlohmann::json &config) :
+ECdecoding::ECdecoding(string inp, FreqTable &freqs, const ProbAutomaton &states, bool withCWProbs, nlohmann::json &config, const string &quality) :
         messageLen(config["decode"]["length"] <= 0 ? inp.size() : static_cast<uint32_t>(config["decode"]["length"])),
         withCwProbs(withCWProbs),
         readSeq(std::move(inp)),
         endFailed(true),
         frequencyMap(freqs),
-        probMap(pMap),
+        states(states),
         seqFlag(false),
         errorProb(config["decode"]["metric"]["fano"]["error_probability"]),
         rate({config["decode"]["metric"]["fano"]["rate"]["low"],config["decode"]["metric"]["fano"]["rate"]["high"]}),
         fanos(getFanos(errorProb, rate)),
         queueCounter(0),
-        config(config) {}
+        nodeBudget(config.value<uint64_t>(nlohmann::json::json_pointer("/decode/budget/nodes"), 0)),
+        nodeCount(0),
+        deadline(config.value<double>(nlohmann::json::json_pointer("/decode/budget/seconds"), 0.0) > 0
+                 ? chrono::steady_clock::now() + chrono::duration_cast<chrono::steady_clock::duration>(
+                         chrono::duration<double>(config.value<double>(nlohmann::json::json_pointer("/decode/budget/seconds"), 0.0)))
+                 : chrono::steady_clock::time_point::max()),
+        queueBytes(0),
+        beamBytes(0),
+        checkpointBytes(0),
+        peakBytes(0),
+        peakQueue(0),
+        checkpointFailures(0),
+        backtracks(0),
+        config(config) {
+    if (!quality.empty() && config.value<bool>(nlohmann::json::json_pointer("/decode/metric/fano/use_quality"), true)) {
+        // phred+33 error probability of each base, at least quality_floor (the qualities do not cover indels)
+        double minProb = config.value<double>(nlohmann::json::json_pointer("/decode/metric/fano/quality_floor"), 0.001);
+        positionFanos.reserve(quality.size());
+        for (char q: quality) {
+            double prob = pow(10.0, -static_cast<double>(max(q - 33, 0)) / 10.0);
+            positionFanos.push_back(getFanos(min(max(prob, minProb), 0.5), rate));
+        }
+    }
+}
 
 double ECdecoding::codewordFunc(double probs) {
     return probs;
@@ -38,7 +62,7 @@ char ECdecoding::defaultReturn(string &basicString, uint32_t index) {
 }
 
 void ECdecoding::metricProbs(SeqEntry &sequence, array<double, 2> &fanoMetrics,
-                             char2double &nextProbs, array<char, 4> &bases) {
+                             const BaseProbs &nextProbs, array<char, 4> &bases) {
 
     for (auto &ele: bases) {
         if (static_cast<bool>(nextProbs[ele])) {
@@ -50,7 +74,7 @@ void ECdecoding::metricProbs(SeqEntry &sequence, array<double, 2> &fanoMetrics,
 }
 
 void ECdecoding::updateState(SeqEntry &sequence,
-                             bool hit, char2double &nextProbs, char base, int increNum) {
+                             bool hit, const BaseProbs &nextProbs, char base, int increNum) {
     sequence.ac.write(sequence.freq, (int) base);
     if (sequence.ac.bitout.failedSync) {
         checkpointCheck(sequence);
@@ -58,7 +82,7 @@ void ECdecoding::updateState(SeqEntry &sequence,
         if (!sequence.ac.bitout.crcFlag && sequence.ac.bitout.bCount) {
             // crcFlag is off (just had a crc check) and the crc check was passed successful.
             if (!crcCheckpoints.count(sequence.seq)) {
-                crcCheckpoints.emplace(sequence.seq, std::pair(0, sequence));
+                checkpointInsert(sequence);
                 sequence.lastCrc = sequence.seq;
             }
         }
@@ -72,15 +96,16 @@ void ECdecoding::updateState(SeqEntry &sequence,
             penalty += (sequence.seq.size() / static_cast<int>(config["decode"]["metric"]["penalties"]["no_hit"]));
         }
 
-        sequence.metric -= (fanos[hit] + codewordFunc(nextProbs[base]) - penalty);
+        sequence.metric -= (fanosAt(sequence.pos)[hit] + codewordFunc(nextProbs[base]) - penalty);
         sequence.seq += base;
+        sequence.state = states.next(sequence.state, base);
         sequence.pos += increNum;
 
         // Put the first bases in the crc check hashmap, so that subtrees can get metric penalties
         // if the subtree fails multiple times at the same crc checkpoint. This should
         // reduce the probability of getting stuck in a local optima.
         if (sequence.pos == 1 && !crcCheckpoints.contains(sequence.seq)) {
-            crcCheckpoints.emplace(sequence.seq, std::pair(0, sequence));
+            checkpointInsert(sequence);
             sequence.lastCrc = base;
         }
         queueInsert(sequence);
@@ -97,18 +122,20 @@ void ECdecoding::checkpointCheck(const SeqEntry &sequence) {
         if (crcCheckpoints.contains(sequence.lastCrc)) {
             if (crcCheckpoints.at(sequence.lastCrc).first > config["decode"]["threshold"]["checkpoint"]) {
                 SeqEntry lastCheckpoint = crcCheckpoints.at(sequence.lastCrc).second;
+                backtracks++;
                 // Do the checkpoint check for the last checkpoint too, so that we can move even
                 // further behind if necessary.
                 checkpointCheck(lastCheckpoint);
                 //crcCheckpoints.erase(sequence.lastCrc);
             } else {
                 crcCheckpoints.at(sequence.lastCrc).first++;
+                checkpointFailures++;
             }
         }
     }
 }
 
-void ECdecoding::fanoCheck(SeqEntry &sequence, char2double &nextProbs, char base) {
+void ECdecoding::fanoCheck(SeqEntry &sequence, const BaseProbs &nextProbs, char base) {
     //switched sequence.pos to sequence.seq.size(), as it would lead to wrong results if indels are present
     if (sequence.seq.size() > messageLen)
         return;
@@ -125,16 +152,16 @@ void ECdecoding::fanoCheck(SeqEntry &sequence, char2double &nextProbs, char base
 }
 
 void ECdecoding::checkDels(SeqEntry &sequence) {
+    BaseProbs nextProbs = calcNextProbs(sequence);
     for (auto &baseDel: array<char, 4>{'A', 'T', 'C', 'G'}) {
-        SeqEntry newSeqDel = sequence;
-        char2double nextProbs = calcNextProbs(newSeqDel);
         if (static_cast<bool>(nextProbs[baseDel])) {
+            SeqEntry newSeqDel = sequence;
             updateState(newSeqDel, false, nextProbs, baseDel, 0);
         }
     }
 }
 
-void ECdecoding::checkIns(SeqEntry &sequence, char base, char2double &nextProbs) {
+void ECdecoding::checkIns(SeqEntry &sequence, char base, const BaseProbs &nextProbs) {
     if (defaultReturn(readSeq, sequence.pos + 1) == base) {
         SeqEntry newSeqIns = sequence;
         updateState(newSeqIns, false, nextProbs, base, 2);
@@ -142,26 +169,58 @@ void ECdecoding::checkIns(SeqEntry &sequence, char base, char2double &nextProbs)
 }
 
 void ECdecoding::queueInsert(SeqEntry &sequence) {
-    queue.insert(std::make_unique<SeqEntry>(sequence));
+    auto entry = std::make_unique<SeqEntry>(sequence);
+    queueBytes += entry->footprint();
+    peakBytes = max(peakBytes, queueBytes + beamBytes + checkpointBytes);
+    queue.insert(std::move(entry));
+    peakQueue = max<uint64_t>(peakQueue, queue.size());
 }
 
-void ECdecoding::queueCheck(array<double, 2> &fanoMetrics, array<char, 4> &bases) {
-    vector<SeqEntry> seqEvals;
+SeqEntry ECdecoding::queuePop() {
     auto itr = queue.begin();
-    seqEvals.push_back(**itr);
+    SeqEntry entry = **itr;
+    queueBytes -= (**itr).footprint();
     queue.erase(itr);
+    return entry;
+}
+
+void ECdecoding::checkpointInsert(const SeqEntry &sequence) {
+    crcCheckpoints.emplace(sequence.seq, std::pair(0, sequence));
+    checkpointBytes += sequence.seq.capacity() + sequence.footprint();
+    peakBytes = max(peakBytes, queueBytes + beamBytes + checkpointBytes);
+}
+
+DecodeStats ECdecoding::stats() const {
+    DecodeStats res;
+    res.peakBytes = peakBytes;
+    res.nodes = nodeCount;
+    res.peakQueue = peakQueue;
+    res.queueReductions = queueCounter;
+    res.checkpointFailures = checkpointFailures;
+    res.backtracks = backtracks;
+    return res;
+}
+
+nlohmann::json DecodeStats::toJson() const {
+    // no candidate found is written as null (not as NaN, which is not reliable with -ffast-math)
+    return {{"seconds", seconds}, {"nodes", nodes}, {"peak_queue", peakQueue}, {"queue_reductions", queueReductions},
+            {"checkpoint_failures", checkpointFailures}, {"backtracks", backtracks}, {"peak_bytes", peakBytes},
+            {"metric", metric ? nlohmann::json(*metric) : nlohmann::json()}, {"success", success}};
+}
+
+void ECdecoding::queueCheck(array<double, 2> &fanoMetrics, array<char, 4> &bases) {
+    vector<SeqEntry> seqEvals;
+    seqEvals.push_back(queuePop());
     int counter = 0;
     while (!queue.empty() && counter < config["decode"]["threshold"]["loop"]) {
-        itr = queue.begin();
-        if ((**itr).seq.size() == messageLen)
+        if ((**queue.begin()).seq.size() == messageLen)
             break;
-        seqEvals.push_back(**itr);
-        queue.erase(itr);
+        seqEvals.push_back(queuePop());
         counter++;
     }
 
     for (auto &seqEntry: seqEvals) {
-        char2double nextProbs = calcNextProbs(seqEntry);
+        BaseProbs nextProbs = calcNextProbs(seqEntry);
         metricProbs(seqEntry, fanoMetrics, nextProbs, bases);
     }
     if (queue.size() > config["decode"]["queue"]["size"]) {
@@ -173,50 +232,75 @@ void ECdecoding::queueCheck(array<double, 2> &fanoMetrics, array<char, 4> &bases
         auto delete_itr = queue.begin();
         int reduce_to =  static_cast<int>( static_cast<int>( config["decode"]["queue"]["size"])*static_cast<double>( config["decode"]["queue"]["reduce"]));
         advance(delete_itr, reduce_to);
+        for (auto itr = delete_itr; itr != queue.end(); itr++)
+            queueBytes -= (**itr).footprint();
         queue.erase(delete_itr, queue.end());
     }
 }
 
-char2double ECdecoding::calcNextProbs(SeqEntry &bestSequence) {
-    if (withCwProbs) {
-        char2double nextProbs = ProbabilityEval(bestSequence.seq,
-                                                this->frequencyMap.motif, 0, true, this->frequencyMap.codewordLen,
-                                                &probMap).nextProbsSingleLetter();
-        return nextProbs;
-    } else {
-        char2double nextProbs = {{'A', 1.0},
-                                 {'T', 1.0},
-                                 {'C', 1.0},
-                                 {'G', 1.0}
-        };
-        return nextProbs;
-    }
+BaseProbs ECdecoding::calcNextProbs(const SeqEntry &bestSequence) const {
+    static const array<double, 4> uniform = {1.0, 1.0, 1.0, 1.0};
+    if (withCwProbs)
+        return BaseProbs(states.probs(bestSequence.state));
+    return BaseProbs(uniform.data());
 }
 
-// ToDo calculate the fanos for each position seperatly, using the occurence probs as errorProb.
 array<double, 2> ECdecoding::getFanos(double errorProb, array<int, 2> &rate) {
     double bias = (static_cast<float>(rate[0]) / static_cast<float>(rate[1]));
     array<double, 2> fanos = {(log2(2 * errorProb) - bias), (log2(2 * (1 - errorProb)) - bias)};
     return fanos;
 }
 
+const array<double, 2> &ECdecoding::fanosAt(uint32_t pos) const {
+    // confidently called bases make a mismatch expensive, positions beyond the read use the global error probability
+    if (pos < positionFanos.size())
+        return positionFanos[pos];
+    return fanos;
+}
 
-SeqEntry ECdecoding::decode(int codewordLen, robin_hood::unordered_map<string, vector<string>> &motif, nlohmann::json &config) {
-    array<char, 4> bases{'A', 'T', 'C', 'G'};
-    int itCount = 0;
-    array<int, 2> e_rate = {config["decode"]["metric"]["fano"]["rate"]["low"],config["decode"]["metric"]["fano"]["rate"]["high"]};
-    array<double, 2> fanoMetrics = getFanos(errorProb, e_rate);
+
+SeqEntry ECdecoding::seed(array<double, 2> &fanoMetrics, array<char, 4> &bases) {
     string s;
-    ProbabilityEval currSeq = ProbabilityEval(s, motif, 0, true, codewordLen, &probMap);
-    char2double nextProbs = currSeq.nextProbsSingleLetter();
     DecodedData dec = DecodedData();
     BitOutStream bitOut = BitOutStream(dec, config["general"]["sync"]);
     Deflate ac = Deflate(16, bitOut);
-    SeqEntry sequence = SeqEntry(0.0, currSeq.seq, 0, ac, frequencyMap);
+    SeqEntry sequence = SeqEntry(0.0, s, 0, ac, frequencyMap);
+    BaseProbs nextProbs = calcNextProbs(sequence);
     //put in the empty sequence in the crcCheckpoint map as a last-resort
     SeqEntry baseLine = sequence;
-    crcCheckpoints.emplace(baseLine.seq, std::pair(0, baseLine));
+    checkpointInsert(baseLine);
     metricProbs(sequence, fanoMetrics, nextProbs, bases);
+    return sequence;
+}
+
+void ECdecoding::resetSearch() {
+    queue.clear();
+    crcCheckpoints.clear();
+    candidates.clear();
+    endFailed = true;
+    queueBytes = 0;
+    beamBytes = 0;
+    checkpointBytes = 0;
+}
+
+SeqEntry ECdecoding::decode(nlohmann::json &config) {
+    array<char, 4> bases{'A', 'T', 'C', 'G'};
+    array<int, 2> e_rate = {config["decode"]["metric"]["fano"]["rate"]["low"],config["decode"]["metric"]["fano"]["rate"]["high"]};
+    array<double, 2> fanoMetrics = getFanos(errorProb, e_rate);
+    if (config.value<string>(nlohmann::json::json_pointer("/decode/search"), "stack") == "beam") {
+        SeqEntry res = beamDecode(fanoMetrics, bases, config.value<size_t>(nlohmann::json::json_pointer("/decode/beam/width"), 256));
+        if (res.metric != 1000 || !config.value<bool>(nlohmann::json::json_pointer("/decode/beam/fallback"), false))
+            return res;
+        // the node and time budget are shared with the beam search
+        INFO("Beam search failed, falling back to the stack search.");
+        resetSearch();
+    }
+    return stackDecode(fanoMetrics, bases, config);
+}
+
+SeqEntry ECdecoding::stackDecode(array<double, 2> &fanoMetrics, array<char, 4> &bases, nlohmann::json &config) {
+    int itCount = 0;
+    seed(fanoMetrics, bases);
     try {
         mainLoop(fanoMetrics, bases, itCount);
     } catch (const logic_error &e) {
@@ -226,9 +310,7 @@ SeqEntry ECdecoding::decode(int codewordLen, robin_hood::unordered_map<string, v
         return res;
     }
     SUCCESS("Finished first run, checking CRC...");
-    auto itr = queue.begin();
-    SeqEntry res = **itr;
-    queue.erase(itr);
+    SeqEntry res = queuePop();
     while (endFailed) {
         try {
             endFailed = false;
@@ -245,18 +327,92 @@ SeqEntry ECdecoding::decode(int codewordLen, robin_hood::unordered_map<string, v
                 res.metric = 1000;
                 return res;
             }
-            itr = queue.begin();
-            res = **itr;
-            queue.erase(itr);
+            res = queuePop();
             itCount++;
         }
     }
     return res;
 }
 
+void ECdecoding::nextBeam(vector<SeqEntry> &beam, size_t width) {
+    // the best children of the last step. Children with the same sequence and read position only differ in their
+    // metric (e.g. a deletion followed by an insertion instead of two substitutions), only the best one is kept.
+    beam.clear();
+    beamBytes = 0;
+    robin_hood::unordered_set<string> seen;
+    while (!queue.empty() && beam.size() < width) {
+        SeqEntry entry = queuePop();
+        string key = entry.seq;
+        key.append(reinterpret_cast<const char *>(&entry.pos), sizeof(entry.pos));
+        if (seen.insert(std::move(key)).second) {
+            beamBytes += entry.footprint();
+            beam.push_back(std::move(entry));
+        }
+    }
+    queue.clear();
+    queueBytes = 0;
+}
+
+SeqEntry ECdecoding::beamDecode(array<double, 2> &fanoMetrics, array<char, 4> &bases, size_t width) {
+    // Position synchronous beam search: all entries of the beam have the same length, each step expands all of them
+    // by one base (match, substitution, insertion or deletion, see metricProbs) and keeps the width best children.
+    // A read takes at most messageLen steps of width expansions, the memory is bounded by the children of one step
+    // (and the crc checkpoints). The crc checkpoints work as in the stack search: failed sync checks are counted
+    // against the last checkpoint and the children of a failing checkpoint get the crc penalty.
+    SeqEntry res = seed(fanoMetrics, bases);
+    res.metric = 1000;
+    vector<SeqEntry> beam;
+    beam.reserve(width);
+    try {
+        while (true) {
+            if (queue.empty()) {
+                WARN("All candidates of the beam failed the sync check.");
+                return res;
+            }
+            nextBeam(beam, width);
+            if (beam.front().seq.size() >= messageLen)
+                break;
+            for (auto &entry: beam) {
+                checkBudget();
+                BaseProbs nextProbs = calcNextProbs(entry);
+                metricProbs(entry, fanoMetrics, nextProbs, bases);
+            }
+        }
+    } catch (const logic_error &e) {
+        WARN(e.what());
+        return res;
+    }
+    SUCCESS("Finished beam search, checking CRC...");
+    // the beam is ordered by metric, the first candidate that passes the final crc check is the result
+    for (auto &entry: beam) {
+        try {
+            entry.ac.finish();
+            SUCCESS("CRC SUCCESSFUL, metric " << entry.metric);
+            return entry;
+        } catch (const logic_error &e) {
+            INFO("CRC FAILED, metric " << entry.metric);
+        }
+    }
+    WARN("No candidate of the beam passed the CRC check.");
+    return res;
+}
+
+void ECdecoding::checkBudget() {
+    if (decodeCancelled) {
+        throw logic_error("Decoding cancelled.");
+    }
+    if (++nodeCount > nodeBudget && nodeBudget) {
+        throw logic_error("node budget exceeded.");
+    }
+    if (chrono::steady_clock::now() > deadline) {
+        throw logic_error("time budget exceeded.");
+    }
+}
+
 void ECdecoding::mainLoop(array<double, 2> &fanoMetrics, array<char, 4> &bases, int itCount) {
     // Stopping when the best candidate has the desired length is suboptimal.
     while ((**queue.begin()).seq.size() != messageLen) {
+        checkBudget();
         queueCheck(fanoMetrics, bases);
         itCount++;
         if (queue.empty()) {
@@ -277,19 +433,41 @@ SeqEntry ECdecoding::checkCandidate(SeqEntry &can, unsigned long threshold) {
     }
 }
 
+std::atomic<bool> decodeCancelled = false;
+
 void do_decode(const string &inp, FreqTable &freqs, robin_hood::unordered_map<string, char2double> &tMap, robin_hood::unordered_map<string, vector<string>> &motif,
-               nlohmann::json &config, int &codewordLen, list<tuple<string, vector<unsigned char>>> &results, std::mutex *res_lock) {
+               nlohmann::json &config, int &codewordLen, list<tuple<string, vector<unsigned char>>> &results, std::mutex *res_lock,
+               DecodeStats *stats, const string &quality, const ProbAutomaton *states) {
+    if (decodeCancelled)
+        return;
     string metric_str = "ERR";
     vector<unsigned char> data = {};
+    optional<double> metric;
+    auto start = chrono::steady_clock::now();
+    // without a compiled state machine (e.g. from a Codebook), it is built for this read
+    unique_ptr<ProbAutomaton> ownStates;
+    unique_ptr<ECdecoding> ecDec;
     try {
-        ECdecoding ecDec = ECdecoding(inp, freqs, tMap, true, config);
-        SeqEntry dec = ecDec.decode(codewordLen, motif, config);
+        if (states == nullptr) {
+            ownStates = make_unique<ProbAutomaton>(motif, codewordLen, tMap, true);
+            states = ownStates.get();
+        }
+        ecDec = make_unique<ECdecoding>(inp, freqs, *states, true, config, quality);
+        SeqEntry dec = ecDec->decode(config);
         metric_str = to_string(dec.metric);
+        metric = dec.metric;
         data = *dec.ac.bitout.get_data();
     }
     catch (...) {
         WARN("No candidate found.");
     }
+    if (stats != nullptr) {
+        if (ecDec)
+            *stats = ecDec->stats();
+        stats->metric = metric;
+        stats->seconds = chrono::duration<double>(chrono::steady_clock::now() - start).count();
+        stats->success = (metric_str != "ERR" && metric_str != "1000.000000");
+    }
     {
         std::unique_lock<std::mutex> uLock(*res_lock);
         results.emplace_back(metric_str, data);
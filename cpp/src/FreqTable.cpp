@@ -19,19 +19,33 @@ FreqTable::FreqTable(string2stringVec& motif, string seq,
 
 
 void FreqTable::setTotal(double csum=0.0) {
-    (static_cast<bool>(csum) ? this -> total = csum : this -> total = accumulate(frequencies.begin(), frequencies.end(), 0.0));
+    (static_cast<bool>(csum) ? this -> total = csum : this -> total = accumulate(symFreqs.begin(), symFreqs.begin() + numSymbols, 0.0));
 }
 
 double FreqTable::get(int symbol) {
     checkSym(symbol);
-    return frequencies[symbol];
+    for (uint8_t i = 0; i < numSymbols; i++) {
+        if (symbols[i] == symbol)
+            return symFreqs[i];
+    }
+    return 0;
 }
 
 uint32_t FreqTable::getSymLimit() const {
-    return frequencies.size();
+    return 256;
+}
+
+void FreqTable::useAutomaton(const ProbAutomaton *states) {
+    automaton = states;
+    state = ProbAutomaton::start;
 }
 
 void FreqTable::calcNewFreqs(char newSym) {
+    if (automaton != nullptr) {
+        state = automaton->next(state, newSym);
+        calcFreqs();
+        return;
+    }
     addBase(newSym);
     wordEnd++;
     if (wordEnd == codewordLen){
@@ -42,21 +56,39 @@ void FreqTable::calcNewFreqs(char newSym) {
 }
 
 void FreqTable::calcFreqs() {
-    vector<double> freqs(256, 0);
-    this -> frequencies = freqs;
+    numSymbols = 0;
+    if (automaton != nullptr) {
+        const double *probs = automaton->probs(state);
+        // the bases are stored in symbol order
+        for (char base: {'A', 'C', 'G', 'T'}) {
+            symbols[numSymbols] = static_cast<uint8_t>(base);
+            symFreqs[numSymbols] = probs[ProbAutomaton::baseIndex(base)];
+            numSymbols++;
+        }
+        setTotal(accumulate(symFreqs.begin(), symFreqs.end(), 0.0));
+        return;
+    }
     if (updatedDict.contains(seq)) {
         setFreqs(updatedDict);
     } else {
         setFreqs(*probDict);
     }
-    initCum();
 }
 
 void FreqTable::setFreqs(robin_hood::unordered_map<string, char2double> &usedMap){
     vector<double> baseFreqs;
     baseFreqs.reserve(4);
     for (const auto &[key, val] : usedMap[seq]){
-        frequencies[int(key)] = val;
+        if (numSymbols == symbols.size())
+            throw out_of_range("Too many symbols.");
+        // insertion sort, the cumulative frequencies are summed up in symbol order
+        uint8_t i = numSymbols++;
+        for (; i > 0 && symbols[i - 1] > static_cast<uint8_t>(key); i--) {
+            symbols[i] = symbols[i - 1];
+            symFreqs[i] = symFreqs[i - 1];
+        }
+        symbols[i] = static_cast<uint8_t>(key);
+        symFreqs[i] = val;
     }
     for (const auto &entry : usedMap[seq])
         baseFreqs.push_back(entry.second);
@@ -69,32 +101,29 @@ uint64_t FreqTable::getTotal() const {
 
 uint64_t FreqTable::getLow(int symbol) {
     checkSym(symbol);
-    if (cumulative.empty())
-        initCum();
-    return cumulative[symbol];
+    double sum = 0;
+    for (uint8_t i = 0; i < numSymbols && symbols[i] < symbol; i++)
+        sum += symFreqs[i];
+    return sum;
 }
 
 uint64_t FreqTable::getHigh(int symbol) {
     checkSym(symbol);
-    if (cumulative.empty())
-        initCum();
-    return cumulative[symbol+1];
+    double sum = 0;
+    for (uint8_t i = 0; i < numSymbols && symbols[i] <= symbol; i++)
+        sum += symFreqs[i];
+    return sum;
 }
 
 void FreqTable::checkSym(int symbol) const {
-    if (0 <= symbol && symbol < (int)frequencies.size())
+    if (0 <= symbol && symbol < 256)
         return;
     throw out_of_range("Symbol is out of range.");
 }
 
-void FreqTable::initCum() {
-    vector<double> cumul;
-    cumul.reserve(257);
-    double sum = 0;
-    cumul.push_back(0);
-    for (const auto &freq : frequencies) {
-        sum += freq;
-        cumul.push_back(sum);
-    }
-    cumulative = cumul;
+size_t FreqTable::footprint() const {
+    size_t bytes = seq.capacity();
+    for (const auto &[key, val] : updatedDict)
+        bytes += sizeof(key) + key.capacity() + sizeof(val) + val.size() * sizeof(pair<char, double>);
+    return bytes;
 }
@@ -0,0 +1,131 @@
+//
+// Dense state machine of the next-base probabilities of a code book and its concatenation scheme.
+//
+
+#include "include/ProbAutomaton.h"
+
+using namespace std;
+
+typedef array<double, 4> BaseArray;
+
+static const array<char, 4> BASES = {'A', 'C', 'G', 'T'};
+
+static BaseArray lookupProbs(const robin_hood::unordered_map<string, char2double> &probDict, const string &key) {
+    BaseArray res{};
+    auto itr = probDict.find(key);
+    if (itr != probDict.end()) {
+        for (const auto &[base, prob]: itr->second) {
+            int idx = ProbAutomaton::baseIndex(base);
+            if (idx >= 0)
+                res[idx] = prob;
+        }
+    }
+    return res;
+}
+
+ProbAutomaton::ProbAutomaton(const string2stringVec &motif, int codewordLen,
+                             const robin_hood::unordered_map<string, char2double> &probDict, bool acrossWords) {
+    /*
+     * The motif context of a sequence is the longest suffix that is a prefix of a motif key (the state of an
+     * aho-corasick automaton of the keys), it determines which keys end the sequence. The probabilities that
+     * ProbabilityEval::removeMotifs replaces for a context are computed once, in the same order, and the states are
+     * the reachable combinations of (context at the last code word boundary, context, code word prefix). The context
+     * at the boundary is dropped as soon as the prefix can no longer reach a replaced entry.
+     */
+    // motif key prefixes, the context of a sequence is the index of its longest suffix in this list
+    vector<string> contexts = {""};
+    robin_hood::unordered_map<string, uint32_t> contextIds = {{"", 0}};
+    for (const auto &[key, suffixes]: motif) {
+        for (size_t i = 1; i <= key.size(); i++) {
+            if (contextIds.try_emplace(key.substr(0, i), contexts.size()).second)
+                contexts.push_back(key.substr(0, i));
+        }
+    }
+    vector<array<uint32_t, 4>> contextNext(contexts.size());
+    for (uint32_t ctx = 0; ctx < contexts.size(); ctx++) {
+        for (int i = 0; i < 4; i++) {
+            string suffix = contexts[ctx] + BASES[i];
+            while (!contextIds.contains(suffix))
+                suffix.erase(0, 1);
+            contextNext[ctx][i] = contextIds.at(suffix);
+        }
+    }
+    // replaced probabilities of every context, and all prefixes of replaced entries
+    vector<robin_hood::unordered_map<string, BaseArray>> updated(contexts.size());
+    robin_hood::unordered_set<string> dependent;
+    for (uint32_t ctx = 0; ctx < contexts.size(); ctx++) {
+        for (const auto &[key, suffixes]: motif) {
+            if (!contexts[ctx].ends_with(key))
+                continue;
+            for (const auto &ele: suffixes) {
+                if (ele.empty())
+                    continue;
+                string preMinusOne = ele.substr(0, ele.size() - 1);
+                updated[ctx][preMinusOne] = lookupProbs(probDict, preMinusOne);
+                int idx = baseIndex(ele.back());
+                if (idx >= 0)
+                    updated[ctx][preMinusOne][idx] = 0;
+                updated[ctx][ele] = BaseArray{};
+            }
+        }
+        for (const auto &[key, probs]: updated[ctx]) {
+            for (size_t i = 0; i <= key.size(); i++)
+                dependent.insert(key.substr(0, i));
+        }
+    }
+
+    // breadth first search over the reachable states, boundary context -1: the boundary context no longer matters
+    struct Pending {
+        int64_t boundary;
+        uint32_t ctx;
+        string prefix;
+    };
+    vector<Pending> pending;
+    robin_hood::unordered_map<string, uint32_t> ids;
+    ids.reserve(probDict.size() * 2);
+    auto stateId = [&](int64_t boundary, uint32_t ctx, string prefix) {
+        if (!dependent.contains(prefix))
+            boundary = -1;
+        string key = to_string(boundary) + ',' + to_string(ctx) + ',' + prefix;
+        auto [itr, inserted] = ids.try_emplace(key, static_cast<uint32_t>(pending.size()));
+        if (inserted) {
+            BaseArray probs{};
+            auto upd = boundary < 0 ? updated[0].end() : updated[boundary].find(prefix);
+            if (boundary >= 0 && upd != updated[boundary].end())
+                probs = upd->second;
+            else
+                probs = lookupProbs(probDict, prefix);
+            stateProbs.insert(stateProbs.end(), probs.begin(), probs.end());
+            pending.push_back({boundary, ctx, std::move(prefix)});
+        }
+        return itr->second;
+    };
+    stateId(0, 0, "");
+    // the dead state has no pending entry to expand, all its transitions lead back to it
+    dead = static_cast<uint32_t>(pending.size());
+    pending.push_back({-1, 0, ""});
+    stateProbs.insert(stateProbs.end(), 4, 0.0);
+    transitions.reserve(probDict.size() * 4);
+    for (uint32_t state = 0; state < pending.size(); state++) {
+        transitions.resize(pending.size() * 4, dead);
+        if (state == dead)
+            continue;
+        // copied, stateId can reallocate pending
+        Pending cur = pending[state];
+        BaseArray codewordProbs = lookupProbs(probDict, cur.prefix);
+        for (int i = 0; i < 4; i++) {
+            if (!static_cast<bool>(codewordProbs[i]))
+                continue;
+            uint32_t ctx = contextNext[cur.ctx][i];
+            string prefix = cur.prefix + BASES[i];
+            uint32_t nextState;
+            if (static_cast<int>(prefix.size()) >= codewordLen)
+                nextState = stateId(ctx, acrossWords ? ctx : 0, "");
+            else
+                nextState = stateId(cur.boundary, ctx, prefix);
+            transitions.resize(pending.size() * 4, dead);
+            transitions[state * 4 + i] = nextState;
+        }
+    }
+    transitions.resize(pending.size() * 4, dead);
+}
@@ -8,11 +8,11 @@ using namespace std;
 
 extern std::mutex *res_lock;
 
-ProbabilityEval::ProbabilityEval(string &seq, string2stringVec &mot, int srt,
+ProbabilityEval::ProbabilityEval(string &seq, const string2stringVec &mot, int srt,
                                  bool norm, int cwL, robin_hood::unordered_map<string, char2double> *pDict) :
         normalized(norm),
         codewordLen(cwL),
-        motif(mot),
+        motif(&mot),
         seq(seq),
         length(static_cast<int>(seq.length())),
         start(srt),
@@ -80,9 +80,9 @@ void ProbabilityEval::removeMotifs() {
     updatedDict.clear();
     int end = start+codewordLen;
     string substring = seq.substr(0, end);
-    for (const auto & [key, value] : motif) {
+    for (const auto & [key, value] : *motif) {
         if (substring.ends_with(key)) {
-            for (const auto &ele: motif[key]) {
+            for (const auto &ele: value) {
                 uint32_t ele_len = ele.length() - 1;
                 string pre_minus_one = ele.substr(0, ele_len);
                 res_lock->lock();
@@ -0,0 +1,185 @@
+//
+// 2 bit packed, memory mapped sequence container (see seqpack.py for the layout).
+//
+
+#include <algorithm>
+#include <cstring>
+#include <fcntl.h>
+#include <stdexcept>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include <unistd.h>
+#include "include/SeqPack.h"
+
+using namespace std;
+
+static const char MAGIC[] = "DNAPACK1";
+static const size_t HEADER_SIZE = 32;
+static const char BASES[] = "ACGT";
+
+/*
+ * Little endian integers of the header and the index.
+ */
+static void writeLE64(ostream &out, uint64_t val) {
+    for (int i = 0; i < 8; i++)
+        out.put(static_cast<char>((val >> (8 * i)) & 0xFF));
+}
+
+static uint64_t readLE64(const unsigned char *ptr) {
+    uint64_t val = 0;
+    for (int i = 7; i >= 0; i--)
+        val = (val << 8) | ptr[i];
+    return val;
+}
+
+static uint64_t padded(uint64_t size) {
+    return (size + 7) / 8 * 8;
+}
+
+PackedWriter::PackedWriter(const string &outputFile) : path(outputFile) {
+    out.open(outputFile, ios::out | ios::binary | ios::trunc);
+    if (!out.good())
+        throw runtime_error("Could not open " + outputFile + ".");
+    out.write(string(HEADER_SIZE, '\0').data(), HEADER_SIZE);
+}
+
+PackedWriter::~PackedWriter() {
+    // write errors are only reported by an explicit close
+    try {
+        close();
+    } catch (const runtime_error &) {}
+}
+
+void PackedWriter::write(const string &, const vector<unsigned char> &data) {
+    uint64_t pos = offsets.back();
+    for (unsigned char base: data) {
+        uint8_t code;
+        switch (base) {
+            case 'A':
+                code = 0;
+                break;
+            case 'C':
+                code = 1;
+                break;
+            case 'G':
+                code = 2;
+                break;
+            case 'T':
+                code = 3;
+                break;
+            default:
+                code = 0;
+                escapePos.push_back(pos);
+                escapeSym += static_cast<char>(base);
+        }
+        pending |= code << (2 * (pos % 4));
+        if (++pos % 4 == 0) {
+            out.put(static_cast<char>(pending));
+            pending = 0;
+        }
+    }
+    offsets.push_back(pos);
+}
+
+void PackedWriter::close() {
+    if (!out.is_open())
+        return;
+    uint64_t bases = offsets.back();
+    if (bases % 4)
+        out.put(static_cast<char>(pending));
+    for (uint64_t i = (bases + 3) / 4; i < padded((bases + 3) / 4); i++)
+        out.put('\0');
+    for (uint64_t off: offsets)
+        writeLE64(out, off);
+    for (uint64_t pos: escapePos)
+        writeLE64(out, pos);
+    out.write(escapeSym.data(), static_cast<streamsize>(escapeSym.size()));
+    out.seekp(0);
+    out.write(MAGIC, 8);
+    writeLE64(out, offsets.size() - 1);
+    writeLE64(out, bases);
+    writeLE64(out, escapePos.size());
+    out.flush();
+    bool failed = out.fail();
+    out.close();
+    if (failed || out.fail())
+        throw runtime_error("Could not write " + path + ".");
+}
+
+PackedSequences::PackedSequences(const string &fileName) {
+    int fd = open(fileName.c_str(), O_RDONLY);
+    if (fd < 0)
+        throw runtime_error("Error opening: " + fileName + " .");
+    struct stat st{};
+    if (fstat(fd, &st) != 0 || static_cast<size_t>(st.st_size) < HEADER_SIZE) {
+        ::close(fd);
+        throw runtime_error(fileName + " is not a packed sequence file.");
+    }
+    length = st.st_size;
+    void *mapped = mmap(nullptr, length, PROT_READ, MAP_PRIVATE, fd, 0);
+    ::close(fd);
+    if (mapped == MAP_FAILED)
+        throw runtime_error("Could not map " + fileName + ".");
+    data = static_cast<const unsigned char *>(mapped);
+    if (memcmp(data, MAGIC, 8) != 0) {
+        munmap(const_cast<unsigned char *>(data), length);
+        throw runtime_error(fileName + " is not a packed sequence file.");
+    }
+    count = readLE64(data + 8);
+    uint64_t bases = readLE64(data + 16);
+    numEscapes = readLE64(data + 24);
+    packed = data + HEADER_SIZE;
+    uint64_t pos = HEADER_SIZE + padded((bases + 3) / 4);
+    offsets = data + pos;
+    pos += 8 * (count + 1);
+    escapePos = data + pos;
+    pos += 8 * numEscapes;
+    escapeSym = data + pos;
+    if (pos + numEscapes > length) {
+        munmap(const_cast<unsigned char *>(data), length);
+        throw runtime_error(fileName + " is truncated.");
+    }
+}
+
+PackedSequences::~PackedSequences() {
+    munmap(const_cast<unsigned char *>(data), length);
+}
+
+uint64_t PackedSequences::offset(size_t i) const {
+    return readLE64(offsets + 8 * i);
+}
+
+uint64_t PackedSequences::escape(size_t i) const {
+    return readLE64(escapePos + 8 * i);
+}
+
+string PackedSequences::get(size_t i) const {
+    if (i >= count)
+        throw out_of_range("sequence index out of range.");
+    uint64_t start = offset(i);
+    uint64_t end = offset(i + 1);
+    string seq(end - start, 'A');
+    for (uint64_t pos = start; pos < end; pos++)
+        seq[pos - start] = BASES[(packed[pos / 4] >> (2 * (pos % 4))) & 3];
+    // the escapes are sorted by their position
+    size_t lo = 0, hi = numEscapes;
+    while (lo < hi) {
+        size_t mid = (lo + hi) / 2;
+        if (escape(mid) < start)
+            lo = mid + 1;
+        else
+            hi = mid;
+    }
+    for (; lo < numEscapes && escape(lo) < end; lo++)
+        seq[escape(lo) - start] = static_cast<char>(escapeSym[lo]);
+    return seq;
+}
+
+vector<string> readPacked(const string &fileName) {
+    PackedSequences packedSeqs(fileName);
+    vector<string> sequences;
+    sequences.reserve(packedSeqs.size());
+    for (size_t i = 0; i < packedSeqs.size(); i++)
+        sequences.push_back(packedSeqs.get(i));
+    return sequences;
+}
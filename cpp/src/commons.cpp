@@ -3,11 +3,12 @@
 //
 //#include "iostream"
 #include "string"
-#include "../../Zippy/library/Zippy.hpp"
 #include "absl/container/flat_hash_set.h"
 #include "absl/container/flat_hash_map.h"
 #include "single_include/nlohmann/json.hpp"
 #include "single_include/robin_hood.h"
+#include "single_include/CRC.h"
+#include "include/commons.h"
 
 using namespace std;
 
@@ -22,52 +23,158 @@ uint64_t getMostFrequentElement(vector<uint64_t> &sizes) {
     return most_freq_int->first;
 }
 
+FastaWriter::FastaWriter(const string &outputFile) : path(outputFile), out(outputFile) {}
+
+void FastaWriter::write(const string &name, const vector<unsigned char> &data) {
+    out << ">" << name << "\n";
+    out.write(reinterpret_cast<const char *>(data.data()), static_cast<streamsize>(data.size()));
+    out << "\n";
+}
+
+void FastaWriter::close() {
+    if (!out.is_open())
+        return;
+    out.flush();
+    bool failed = out.fail();
+    out.close();
+    if (failed || out.fail())
+        throw runtime_error("Could not write " + path + ".");
+}
 
-void write_to_zip(string outputFile, bool add_index, bool most_common_only, bool decodable_only, list<tuple<string, vector<unsigned char>>> &results) {
 /*
- Writes the results to a zip file.
- @param outputFile: The name of the zip file.
- @param add_index: If true, the index is added to the file name.
- @param results: The results to write. Each result is a tuple of the name of the file and the data.
+ * Little endian integers of the zip headers.
  */
-    vector<uint64_t> sizes;
-    std::vector<std::string> ents;
-    Zippy::ZipArchive outarch;
+static void writeLE(ostream &out, uint64_t val, int bytes) {
+    for (int i = 0; i < bytes; i++)
+        out.put(static_cast<char>((val >> (8 * i)) & 0xFF));
+}
+
+ZipWriter::ZipWriter(string outputFile, bool add_index, bool most_common_only, bool decodable_only) :
+        addIndex(add_index),
+        mostCommonOnly(most_common_only),
+        decodableOnly(decodable_only) {
     if (!outputFile.ends_with(".zip")) {
         outputFile += ".zip";
     }
-    outarch.Create(outputFile);
-    uint32_t i = 0;
-    for (const tuple<string, vector<unsigned char>> &tuple1: results) {
-        string filename = get<0>(tuple1);
-        // optionally do not add packets that were not decodeable
-        if (filename != "1000.000000" || decodable_only == false){
-            if (add_index)
-                filename = to_string(i).append("_").append(filename);
-            else
-                filename = filename.append("_enc");
-            vector<unsigned char> res = get<1>(tuple1);
-            // Add filename to a map of sizes, so that deviating packets can be removed ToDo make optional!
-            outarch.AddEntry(filename, res);
-            sizes.push_back(res.size());
-            ents.push_back(filename);
-            i++;
-        }
+    path = outputFile;
+    out.open(outputFile, ios::out | ios::binary | ios::trunc);
+    if (!out.good())
+        throw runtime_error("Could not open " + outputFile + ".");
+}
+
+void ZipWriter::write(const string &name, const vector<unsigned char> &data) {
+    // optionally do not add packets that were not decodeable
+    if (name == "1000.000000" && decodableOnly)
+        return;
+    string filename = addIndex ? to_string(entries.size()).append("_").append(name) : string(name).append("_enc");
+    uint32_t crc = CRC::Calculate(data.data(), data.size(), CRC::CRC_32());
+    // local file header: version 2.0, no flags, stored, 1980-01-01 00:00; the zip64 extra field of the central
+    // directory is used for sizes or offsets beyond 4 GiB
+    writeLE(out, 0x04034b50, 4);
+    writeLE(out, 20, 2);
+    writeLE(out, 0, 2);
+    writeLE(out, 0, 2);
+    writeLE(out, 0, 2);
+    writeLE(out, 0x21, 2);
+    writeLE(out, crc, 4);
+    writeLE(out, data.size(), 4);
+    writeLE(out, data.size(), 4);
+    writeLE(out, filename.size(), 2);
+    writeLE(out, 0, 2);
+    out.write(filename.data(), static_cast<streamsize>(filename.size()));
+    out.write(reinterpret_cast<const char *>(data.data()), static_cast<streamsize>(data.size()));
+    entries.push_back({filename, crc, data.size(), offset});
+    offset += 30 + filename.size() + data.size();
+}
+
+void ZipWriter::close() {
+    if (!out.is_open())
+        return;
+    uint64_t mostCommonSize = 0;
+    if (mostCommonOnly) {
+        // optionally removing all entries that differ in size from the most frequent element
+        vector<uint64_t> sizes;
+        for (auto &ent: entries)
+            sizes.push_back(ent.size);
+        mostCommonSize = getMostFrequentElement(sizes);
     }
-    //Have to save it before being able to get the sizes.
-    outarch.Save();
-    if(most_common_only) {
-    // optionally removing all entries that differ in size from the most frequent element
-        uint_fast64_t mostCommonSize = getMostFrequentElement(sizes);
-        for (auto &ent : ents){
-            Zippy::ZipEntry b = outarch.GetEntry(ent);
-            if (b.UncompressedSize() != mostCommonSize){
-                outarch.DeleteEntry(ent);
-            }
+    uint64_t cdOffset = offset;
+    uint64_t numEntries = 0;
+    for (auto &ent: entries) {
+        if (mostCommonOnly && ent.size != mostCommonSize)
+            continue;
+        bool zip64 = ent.offset >= 0xFFFFFFFF;
+        writeLE(out, 0x02014b50, 4);
+        writeLE(out, zip64 ? 45 : 20, 2);
+        writeLE(out, zip64 ? 45 : 20, 2);
+        writeLE(out, 0, 2);
+        writeLE(out, 0, 2);
+        writeLE(out, 0, 2);
+        writeLE(out, 0x21, 2);
+        writeLE(out, ent.crc, 4);
+        writeLE(out, ent.size, 4);
+        writeLE(out, ent.size, 4);
+        writeLE(out, ent.name.size(), 2);
+        writeLE(out, zip64 ? 12 : 0, 2);
+        writeLE(out, 0, 2);
+        writeLE(out, 0, 2);
+        writeLE(out, 0, 2);
+        writeLE(out, 0, 4);
+        writeLE(out, zip64 ? 0xFFFFFFFF : ent.offset, 4);
+        out.write(ent.name.data(), static_cast<streamsize>(ent.name.size()));
+        if (zip64) {
+            writeLE(out, 0x0001, 2);
+            writeLE(out, 8, 2);
+            writeLE(out, ent.offset, 8);
         }
+        offset += 46 + ent.name.size() + (zip64 ? 12 : 0);
+        numEntries++;
     }
-    outarch.Save();
-    outarch.Close();
+    uint64_t cdSize = offset - cdOffset;
+    if (numEntries >= 0xFFFF || cdOffset >= 0xFFFFFFFF) {
+        // zip64 end of central directory record and locator
+        writeLE(out, 0x06064b50, 4);
+        writeLE(out, 44, 8);
+        writeLE(out, 45, 2);
+        writeLE(out, 45, 2);
+        writeLE(out, 0, 4);
+        writeLE(out, 0, 4);
+        writeLE(out, numEntries, 8);
+        writeLE(out, numEntries, 8);
+        writeLE(out, cdSize, 8);
+        writeLE(out, cdOffset, 8);
+        writeLE(out, 0x07064b50, 4);
+        writeLE(out, 0, 4);
+        writeLE(out, offset, 8);
+        writeLE(out, 1, 4);
+    }
+    writeLE(out, 0x06054b50, 4);
+    writeLE(out, 0, 2);
+    writeLE(out, 0, 2);
+    writeLE(out, min<uint64_t>(numEntries, 0xFFFF), 2);
+    writeLE(out, min<uint64_t>(numEntries, 0xFFFF), 2);
+    writeLE(out, min<uint64_t>(cdSize, 0xFFFFFFFF), 4);
+    writeLE(out, min<uint64_t>(cdOffset, 0xFFFFFFFF), 4);
+    writeLE(out, 0, 2);
+    // write errors (e.g. a full disk) are only detected on the flush
+    out.flush();
+    bool failed = out.fail();
+    out.close();
+    if (failed || out.fail())
+        throw runtime_error("Could not write " + path + ".");
+}
+
+FrameWriter::FrameWriter(ostream &out) : out(out) {}
+
+void FrameWriter::write(const string &name, const vector<unsigned char> &data) {
+    if (!data.empty() && name != "1000.000000")
+        writeFrame(out, to_string(count).append("_").append(name), data);
+    out.flush();
+    count++;
+}
+
+bool FrameWriter::good() {
+    return static_cast<bool>(out);
 }
 
 robin_hood::unordered_map<string, vector<string>> readConcScheme(const string &concScheme) {
@@ -84,3 +191,41 @@ robin_hood::unordered_map<string, vector<string>> readConcScheme(const string &c
 int getCodewordLen(robin_hood::unordered_set<string> &codewords) {
     return codewords.begin()->length();
 }
+
+/*
+ * Framing used to stream packets between the outer and the inner coder (see norec_stream.py):
+ * uint32 name length, name, uint32 data length, data; lengths are little endian.
+ */
+static bool readUint32(istream &in, uint32_t &val) {
+    unsigned char buf[4];
+    if (!in.read(reinterpret_cast<char *>(buf), 4))
+        return false;
+    val = buf[0] | (buf[1] << 8) | (buf[2] << 16) | (static_cast<uint32_t>(buf[3]) << 24);
+    return true;
+}
+
+static void writeUint32(ostream &out, uint32_t val) {
+    const unsigned char buf[4] = {static_cast<unsigned char>(val), static_cast<unsigned char>(val >> 8),
+                                  static_cast<unsigned char>(val >> 16), static_cast<unsigned char>(val >> 24)};
+    out.write(reinterpret_cast<const char *>(buf), 4);
+}
+
+bool readFrame(istream &in, string &name, string &data) {
+    uint32_t len;
+    if (!readUint32(in, len))
+        return false;
+    name.resize(len);
+    if (!in.read(name.data(), len) || !readUint32(in, len))
+        throw runtime_error("truncated frame in packet stream.");
+    data.resize(len);
+    if (!in.read(data.data(), len))
+        throw runtime_error("truncated frame in packet stream.");
+    return true;
+}
+
+void writeFrame(ostream &out, const string &name, const vector<unsigned char> &data) {
+    writeUint32(out, name.size());
+    out.write(name.data(), static_cast<streamsize>(name.size()));
+    writeUint32(out, data.size());
+    out.write(reinterpret_cast<const char *>(data.data()), static_cast<streamsize>(data.size()));
+}
@@ -2,65 +2,123 @@
 // Created by wintermute on 10/12/21.
 //
 #include <single_include/argparse.hpp>
-#include <absl/synchronization/internal/thread_pool.h>
 #include "../include/commons.h"
 #include "string"
 #include "iostream"
+#include <csignal>
+#include <numeric>
+#include <thread>
 #include "include/debug_log.h"
 #include "../include/bitIO.h"
 #include "../include/ACEncode.h"
 #include "../include/ECDecoding.h"
 #include "include/FastaParser.h"
+#include "../include/SeqPack.h"
+#include "../include/Codebook.h"
+#include "../include/Scheduler.h"
 #include "../../Zippy/library/Zippy/ZipArchive.hpp"
 
 
 using namespace std;
 
-list<tuple<string, vector<unsigned char>>> results = list<tuple<string, vector<unsigned char>>>();
 std::mutex *res_lock;
 
-void
-encode_zip(nlohmann::json config, const FreqTable &freqs, uint16_t minLen, bool sameLength, string configPath) {
-    int maxLen = 0;
-    Zippy::ZipArchive inarch(config["encode"]["input"]);
-    std::vector<std::string> ents = inarch.GetEntryNames();
-    absl::synchronization_internal::ThreadPool pool(static_cast<int>(min(static_cast<unsigned long>(config["general"]["threads"]),ents.size())));
-    for (auto &ent: ents) {
-        string data = inarch.GetEntry(ent).GetDataAsString();
-        pool.Schedule(std::bind(do_encode, data, config["general"]["sync"], freqs, minLen, ent, std::ref(results), std::ref(res_lock)));
-    }
-    while (results.size() != ents.size()) {
-        this_thread::sleep_for(chrono::milliseconds(500));
-    }
-    //either store as zip or as fasta...
-    {
-        std::unique_lock<std::mutex> uLock(*res_lock);
-        if (sameLength) {
-            for (auto &res: results) {
-                int size = get<1>(res).size();
-                if (size > maxLen)
-                    maxLen = size;
-            }
-        } else if (config["general"]["as_fasta"]) {
-            write_to_fasta(config["encode"]["output"], results);
-        } else {
-            write_to_zip(config["encode"]["output"], true, config["general"]["zip"]["most_common_only"], config["general"]["zip"]["decodable_only"], results);
-        }
-        if(config["encode"]["same_length"] && config["encode"]["update_config"]) {
-            config[nlohmann::json::json_pointer("/decode/length")] = minLen;
-            std::ofstream confout(configPath);
-            confout << config;
-            confout.flush();
-            confout.close();
+size_t encode_packets(const nlohmann::json &config, const FreqTable &freqs, uint16_t minLen,
+                      const function<bool(string &, string &)> &nextPacket, long total, ResultWriter *out,
+                      vector<pair<string, unique_ptr<PacketEncoder>>> *pending = nullptr) {
+    /*
+     * Encodes the packets returned by nextPacket (until it returns false) on general.threads threads, the packets
+     * are scheduled as soon as they are read. The encoded sequences are written to out in input order as soon as
+     * they are available; without out, the encoders are appended to pending (in input order), so that the sequences
+     * can still be extended.
+     * Returns the length of the longest sequence.
+     */
+    size_t maxLen = 0;
+    size_t done = 0;
+    Progress progress("encode", 1, total, config["general"]["progress"]);
+    uint8_t sync = config["general"]["sync"];
+    OrderedScheduler<pair<string, unique_ptr<PacketEncoder>>> scheduler(config["general"]["threads"], [&](pair<string, unique_ptr<PacketEncoder>> &&res) {
+        maxLen = max(maxLen, res.second->out.size());
+        if (out != nullptr)
+            out->write(res.first, res.second->out);
+        else
+            pending->push_back(std::move(res));
+        progress.update(++done);
+    });
+    string name, data;
+    while (nextPacket(name, data)) {
+        scheduler.submit([&freqs, sync, minLen, name, data] {
+            auto enc = make_unique<PacketEncoder>(data, sync, freqs);
+            enc->encode(minLen);
+            return make_pair(name, std::move(enc));
+        });
+    }
+    scheduler.finish();
+    progress.finish(done);
+    return maxLen;
+}
+
+void encode_all(nlohmann::json config, const FreqTable &freqs, const function<bool(string &, string &)> &nextPacket,
+                long total, const string &configPath) {
+    /*
+     * Encodes all packets and writes them to encode.output (packed sequences for a .dnapack file, FASTA or zip). With
+     * same_length, every packet is encoded once and its coder is kept; after the last packet, the sequences are
+     * extended to the length of the longest one, which gives the same sequences as encoding the packets with this
+     * length as min_length.
+     */
+    uint16_t minLen = config["encode"]["min_length"];
+    unique_ptr<ResultWriter> out;
+    if (isPacked(config["encode"]["output"]))
+        out = make_unique<PackedWriter>(config["encode"]["output"]);
+    else if (config["general"]["as_fasta"])
+        out = make_unique<FastaWriter>(config["encode"]["output"]);
+    else
+        out = make_unique<ZipWriter>(config["encode"]["output"], true, config["general"]["zip"]["most_common_only"], config["general"]["zip"]["decodable_only"]);
+    if (config["encode"]["same_length"]) {
+        vector<pair<string, unique_ptr<PacketEncoder>>> pending;
+        minLen = encode_packets(config, freqs, minLen, nextPacket, total, nullptr, &pending);
+        for (auto &[name, enc]: pending) {
+            enc->encode(minLen);
+            out->write(name, enc->out);
+            enc.reset();
         }
+    } else {
+        encode_packets(config, freqs, minLen, nextPacket, total, out.get());
     }
-    if (sameLength) {
-        results.clear();
-        encode_zip(config, freqs, maxLen, false, configPath);
+    out->close();
+    if (config["encode"]["same_length"] && config["encode"]["update_config"]) {
+        config[nlohmann::json::json_pointer("/decode/length")] = minLen;
+        std::ofstream confout(configPath);
+        confout << config;
+        confout.flush();
+        confout.close();
     }
 }
 
-nlohmann::json parseValidateConfig(string configPath, bool encode) {
+void encode_zip(const nlohmann::json &config, const FreqTable &freqs, const string &configPath) {
+    Zippy::ZipArchive inarch(config["encode"]["input"]);
+    std::vector<std::string> ents = inarch.GetEntryNames();
+    size_t pos = 0;
+    // the entries are read from the archive one by one, when they are scheduled
+    encode_all(config, freqs, [&](string &name, string &data) {
+        if (pos == ents.size())
+            return false;
+        name = ents[pos];
+        data = inarch.GetEntry(ents[pos]).GetDataAsString();
+        pos++;
+        return true;
+    }, static_cast<long>(ents.size()), configPath);
+}
+
+void encode_stream(const nlohmann::json &config, const FreqTable &freqs, istream &in, const string &configPath) {
+    /*
+     * Encodes the packets of a framed stream (see readFrame), e.g. directly from the outer encoder.
+     * Each packet is scheduled as soon as it is read, so the en-coding overlaps with the generation of the packets.
+     */
+    encode_all(config, freqs, [&in](string &name, string &data) { return readFrame(in, name, data); }, -1, configPath);
+}
+
+nlohmann::json parseValidateConfig(const string &configPath, bool encode, bool decode) {
     ifstream cf(configPath);
     nlohmann::json config = nlohmann::json::parse(cf, nullptr, true, true);
     
@@ -78,6 +136,8 @@ nlohmann::json parseValidateConfig(string configPath, bool encode) {
         // zip options
         config[nlohmann::json::json_pointer("/general/zip/most_common_only")] = config.value<bool>(nlohmann::json::json_pointer("/general/zip/most_common_only"), true);
         config[nlohmann::json::json_pointer("/general/zip/decodable_only")] = config.value<bool>(nlohmann::json::json_pointer("/general/zip/decodable_only"), true);
+        // progress report interval in seconds default 1 (0: off)
+        config[nlohmann::json::json_pointer("/general/progress")] = config.value<double>(nlohmann::json::json_pointer("/general/progress"), 1.0);
         
         if(encode) {
             //input & output required
@@ -89,7 +149,8 @@ nlohmann::json parseValidateConfig(string configPath, bool encode) {
             config[nlohmann::json::json_pointer("/encode/same_length")] = config.value<bool>(nlohmann::json::json_pointer("/encode/same_length"), false);
             //update_config default true (only if not zip or samelength)
             config[nlohmann::json::json_pointer("/encode/update_config")] = config.value<bool>(nlohmann::json::json_pointer("/encode/update_config"), true);
-        } else {
+        }
+        if(decode) {
             //input & output required
             static_cast<void>(config.at(nlohmann::json::json_pointer("/decode/input")));
             static_cast<void>(config.at(nlohmann::json::json_pointer("/decode/output")));
@@ -108,6 +169,9 @@ nlohmann::json parseValidateConfig(string configPath, bool encode) {
             config[nlohmann::json::json_pointer("/decode/metric/fano/rate/high")] = config.value<int>(nlohmann::json::json_pointer("/decode/metric/fano/rate/high"), static_cast<int>(config["general"]["sync"]) + 1);
             //errorProb default 0.05
             config[nlohmann::json::json_pointer("/decode/metric/fano/error_probability")] = config.value<double>(nlohmann::json::json_pointer("/decode/metric/fano/error_probability"), 0.05);
+            //FASTQ input: error probability per base from the qualities default true, at least quality_floor default 0.001
+            config[nlohmann::json::json_pointer("/decode/metric/fano/use_quality")] = config.value<bool>(nlohmann::json::json_pointer("/decode/metric/fano/use_quality"), true);
+            config[nlohmann::json::json_pointer("/decode/metric/fano/quality_floor")] = config.value<double>(nlohmann::json::json_pointer("/decode/metric/fano/quality_floor"), 0.001);
             //panalties
             //crc failed default 0.1
             config[nlohmann::json::json_pointer("/decode/metric/penalties/crc")] = config.value<double>(nlohmann::json::json_pointer("/decode/metric/penalties/crc"), 0.1);
@@ -120,20 +184,380 @@ nlohmann::json parseValidateConfig(string configPath, bool encode) {
             config[nlohmann::json::json_pointer("/decode/queue/runs")] = config.value<int>(nlohmann::json::json_pointer("/decode/queue/runs"), 5);
             //reduce default 0.5
             config[nlohmann::json::json_pointer("/decode/queue/reduce")] = config.value<double>(nlohmann::json::json_pointer("/decode/queue/reduce"), 0.5);
+            //search default "stack" (best first search), "beam": position synchronous search with beam/width candidates per step
+            config[nlohmann::json::json_pointer("/decode/search")] = config.value<string>(nlohmann::json::json_pointer("/decode/search"), "stack");
+            if (config["decode"]["search"] != "stack" && config["decode"]["search"] != "beam")
+                throw invalid_argument(R"(decode.search has to be "stack" or "beam".)");
+            //beam width default 256
+            config[nlohmann::json::json_pointer("/decode/beam/width")] = config.value<int>(nlohmann::json::json_pointer("/decode/beam/width"), 256);
+            //fallback default false: decode the reads the beam search fails on with the stack search
+            config[nlohmann::json::json_pointer("/decode/beam/fallback")] = config.value<bool>(nlohmann::json::json_pointer("/decode/beam/fallback"), false);
+            //budget per read
+            //max search steps default 0 (unlimited)
+            config[nlohmann::json::json_pointer("/decode/budget/nodes")] = config.value<uint64_t>(nlohmann::json::json_pointer("/decode/budget/nodes"), 0);
+            //max seconds default 0 (unlimited)
+            config[nlohmann::json::json_pointer("/decode/budget/seconds")] = config.value<double>(nlohmann::json::json_pointer("/decode/budget/seconds"), 0.0);
+            //passes default: a single pass with the settings above
+            config[nlohmann::json::json_pointer("/decode/passes")] = config.value(nlohmann::json::json_pointer("/decode/passes"), nlohmann::json::array());
+            //per read telemetry (json lines) default "" (off)
+            config[nlohmann::json::json_pointer("/decode/telemetry")] = config.value<string>(nlohmann::json::json_pointer("/decode/telemetry"), "");
+            //result journal (json lines) default "" (off)
+            config[nlohmann::json::json_pointer("/decode/journal")] = config.value<string>(nlohmann::json::json_pointer("/decode/journal"), "");
             
         }
     } catch (nlohmann::json::exception &err){
         cerr << err.what() << endl;
-        exit(EXIT_FAILURE);
+        throw;
     }
     return config;
 }
 
+void encode_file(nlohmann::json config, Codebook &cb, const string &configPath) {
+    if (config["encode"]["input"] == "-") {
+        encode_stream(config, cb.freqs, cin, configPath);
+    } else if (static_cast<string>(config["encode"]["input"]).ends_with(".zip")) {
+        encode_zip(config, cb.freqs, configPath);
+    } else {
+        ifstream inStream(config["encode"]["input"], ios::binary);
+        assert(inStream.good());
+        BitInStream bin(inStream, config["general"]["sync"]);
+        ofstream out(config["encode"]["output"], ios::binary);
+        FreqTable freqs = cb.freqs;
+        inflating(freqs, bin, out, config["encode"]["min_length"]);
+        if(config["encode"]["update_config"]){
+            out.flush();
+            out.close();
+            ifstream outin(config["encode"]["output"]);
+            stringstream buffer;
+            buffer << outin.rdbuf();
+            string inp = buffer.str();
+            int size = inp.size();
+            config[nlohmann::json::json_pointer("/decode/length")] = size;
+            std::ofstream confout(configPath);
+            confout << config;
+        }
+    }
+}
+
+vector<nlohmann::json> decodePasses(const nlohmann::json &config) {
+    /*
+     * The decoder settings of every pass: each entry of decode.passes is merged into the decode settings, without
+     * passes the reads are decoded once using the decode settings.
+     */
+    vector<nlohmann::json> passes;
+    for (const auto &pass: config["decode"]["passes"]) {
+        nlohmann::json passConfig = config;
+        passConfig["decode"].merge_patch(pass);
+        passes.push_back(passConfig);
+    }
+    if (passes.empty())
+        passes.push_back(config);
+    return passes;
+}
+
+string toHex(const vector<unsigned char> &data);
+
+struct DecodedRead {
+    size_t read = 0;
+    // false if the read was skipped because decoding was cancelled
+    bool decoded = false;
+    string metric;
+    vector<unsigned char> data;
+    DecodeStats stats;
+};
+
+void decode_passes(const vector<string> &reads, const vector<string> &qualities, Codebook &cb, const nlohmann::json &config, ResultWriter &out, bool ordered) {
+    /*
+     * Decodes the reads (with the base qualities of FASTQ input, if not empty) in one or more passes (see
+     * decodePasses), only the reads that failed are decoded again in
+     * the next pass. Successful reads are written to out as soon as they are decoded (in input order if ordered is
+     * set, else as soon as they are available), failed reads after the last pass. Writing stops early if decoding is
+     * cancelled or out can not be written anymore (e.g. once the outer decoder has recovered the file), the
+     * remaining reads are then not decoded.
+     * If decode.telemetry is set, one json record per decoded read and pass is written to that file.
+     * If decode.journal is set, the result of every read that is written to out is also appended to that file as
+     * json record (read index, read, qualities of FASTQ input, metric and hex data) and flushed, so that the results
+     * are kept if decoding is interrupted.
+     */
+    vector<nlohmann::json> passes = decodePasses(config);
+    ofstream telemetry;
+    if (!static_cast<string>(config["decode"]["telemetry"]).empty()) {
+        telemetry.open(static_cast<string>(config["decode"]["telemetry"]), ios::out | ios::trunc);
+        if (!telemetry.good())
+            WARN("Could not open the telemetry file " << config["decode"]["telemetry"] << ".");
+    }
+    ofstream journal;
+    if (!static_cast<string>(config["decode"]["journal"]).empty()) {
+        journal.open(static_cast<string>(config["decode"]["journal"]), ios::out | ios::trunc);
+        if (!journal.good())
+            WARN("Could not open the journal file " << config["decode"]["journal"] << ".");
+    }
+    auto decodeStart = chrono::steady_clock::now();
+    vector<size_t> pending(reads.size());
+    iota(pending.begin(), pending.end(), 0);
+    // peak search memory per read, over all passes
+    vector<uint64_t> peakBytes(reads.size(), 0);
+    // reads that are written to out (decoded or failed in the last pass)
+    size_t finished = 0;
+    for (size_t p = 0; p < passes.size() && !pending.empty() && !decodeCancelled; p++) {
+        auto start = chrono::steady_clock::now();
+        bool last = (p + 1 == passes.size());
+        vector<size_t> failed;
+        size_t numFailed = 0;
+        size_t done = 0;
+        Progress progress("decode", p + 1, static_cast<long>(pending.size()), passes[p]["general"]["progress"]);
+        // consume is never called concurrently, the telemetry, journal, failed reads and out need no lock
+        OrderedScheduler<DecodedRead> scheduler(passes[p]["general"]["threads"], [&](DecodedRead &&res) {
+            if (!res.decoded)
+                return;
+            peakBytes[res.read] = max(peakBytes[res.read], res.stats.peakBytes);
+            if (telemetry.is_open()) {
+                nlohmann::json record = res.stats.toJson();
+                record["read"] = res.read;
+                record["pass"] = p + 1;
+                record["length"] = reads[res.read].size();
+                telemetry << record.dump() << '\n';
+            }
+            progress.update(++done);
+            if (res.metric == "1000.000000" || res.metric == "ERR") {
+                numFailed++;
+                if (!last) {
+                    failed.push_back(res.read);
+                    return;
+                }
+            }
+            out.write(res.metric, res.data);
+            if (journal.is_open()) {
+                nlohmann::json record = {{"read", res.read}, {"seq", reads[res.read]}, {"metric", res.metric}, {"data", toHex(res.data)}};
+                if (!qualities.empty())
+                    record["quality"] = qualities[res.read];
+                journal << record.dump() << endl;
+            }
+            finished++;
+            if (!out.good())
+                decodeCancelled = true;
+        }, ordered);
+        for (size_t i: pending) {
+            scheduler.submit([&, i] {
+                list<tuple<string, vector<unsigned char>>> res;
+                std::mutex lock;
+                DecodedRead decoded;
+                decoded.read = i;
+                do_decode(reads[i], cb.freqs, cb.tMap, cb.motif, passes[p], cb.codewordLen, res, &lock, &decoded.stats,
+                          qualities.empty() ? "" : qualities[i], &cb.decodeStates);
+                if (!res.empty()) {
+                    decoded.decoded = true;
+                    tie(decoded.metric, decoded.data) = std::move(res.front());
+                }
+                return decoded;
+            });
+        }
+        scheduler.finish();
+        progress.finish(done);
+        if (passes.size() > 1) {
+            double elapsed = chrono::duration<double>(chrono::steady_clock::now() - start).count();
+            SUCCESS("Pass " << p + 1 << ": " << done - numFailed << " of " << pending.size()
+                    << " reads decoded in " << elapsed << "s.");
+        }
+        pending = failed;
+    }
+    if (decodeCancelled && finished < reads.size()) {
+        double elapsed = chrono::duration<double>(chrono::steady_clock::now() - decodeStart).count();
+        SUCCESS("Stopped after decoding " << finished << " of " << reads.size() << " reads in " << elapsed << "s, "
+             << "skipping the remaining reads saved an estimated " << (finished ? elapsed / finished * (reads.size() - finished) : 0.0) << "s.");
+    }
+    if (!reads.empty()) {
+        SUCCESS("Peak search memory per read: mean " << accumulate(peakBytes.begin(), peakBytes.end(), 0.0) / reads.size() / 1024
+                << " KiB, max " << static_cast<double>(*max_element(peakBytes.begin(), peakBytes.end())) / 1024 << " KiB.");
+    }
+}
+
+void decode_file(nlohmann::json config, Codebook &cb, ostream *frames = nullptr) {
+    cb.buildDecodeMap();
+    decodeCancelled = false;
+    if (static_cast<string>(config["decode"]["input"]).ends_with(".zip") || config["general"]["as_fasta"] || isFastq(config["decode"]["input"]) || isPacked(config["decode"]["input"])) {
+        vector<string> reads;
+        vector<string> qualities;
+        if (static_cast<string>(config["decode"]["input"]).ends_with(".zip")) {
+            Zippy::ZipArchive inarch(static_cast<string>(config["decode"]["input"]));
+            for (auto &ent: inarch.GetEntryNames()) {
+                reads.push_back(inarch.GetEntry(ent).GetDataAsString());
+            }
+        } else if (isFastq(config["decode"]["input"])) {
+            // duplicates are decoded only once (with the qualities of the first copy), in the order of the file
+            robin_hood::unordered_set<string> seen;
+            for (auto &[read, quality]: readFastq(config["decode"]["input"])) {
+                if (seen.insert(read).second) {
+                    reads.push_back(std::move(read));
+                    qualities.push_back(std::move(quality));
+                }
+            }
+        } else {
+            // duplicates are decoded only once, the reads keep the order of the file
+            robin_hood::unordered_set<string> seen;
+            for (auto &read: isPacked(config["decode"]["input"]) ? readPacked(config["decode"]["input"]) : readFasta(config["decode"]["input"])) {
+                if (seen.insert(read).second)
+                    reads.push_back(std::move(read));
+            }
+        }
+        if (frames != nullptr) {
+            // the consumer of the stream is waiting for each packet, the order does not matter
+            FrameWriter out(*frames);
+            decode_passes(reads, qualities, cb, config, out, false);
+        } else {
+            ZipWriter out(config["decode"]["output"], true, static_cast<bool>(config["general"]["zip"]["most_common_only"]), static_cast<bool>(config["general"]["zip"]["decodable_only"]));
+            decode_passes(reads, qualities, cb, config, out, true);
+            out.close();
+        }
+    } else {
+        ifstream iStream(config["decode"]["input"]);
+        stringstream buffer;
+        buffer << iStream.rdbuf();
+        string inp = buffer.str();
+        ECdecoding ecDec = ECdecoding(inp, cb.freqs, cb.decodeStates, true, config);
+
+        SeqEntry dec = ecDec.decode(config);
+        SUCCESS("Peak search memory: " << static_cast<double>(ecDec.stats().peakBytes) / 1024 << " KiB.");
+        ofstream out(config["decode"]["output"], ios::out | ios::binary);
+        const vector<unsigned char> str = *dec.ac.bitout.get_data();
+        std::string seq(reinterpret_cast<const char *>(str.data()), str.size());
+        out << seq;
+        out.flush();
+        out.close();
+    }
+}
+
+string toHex(const vector<unsigned char> &data) {
+    static const char digits[] = "0123456789abcdef";
+    string hex;
+    hex.reserve(data.size() * 2);
+    for (unsigned char c: data) {
+        hex += digits[c >> 4];
+        hex += digits[c & 0xf];
+    }
+    return hex;
+}
+
+string fromHex(const string &hex) {
+    if (hex.size() % 2)
+        throw invalid_argument("hex string of odd length.");
+    string data;
+    data.reserve(hex.size() / 2);
+    for (size_t i = 0; i < hex.size(); i += 2) {
+        data += static_cast<char>(stoi(hex.substr(i, 2), nullptr, 16));
+    }
+    return data;
+}
+
+void serve(const string &configPath) {
+    /*
+     * Long-lived server mode, keeps the code book state in memory between jobs.
+     * Requests are read from stdin and answered on stdout, one json object per line. Every request has an "op" and
+     * an optional "id" that is copied to all of its responses, "config" (default: the config the server was started
+     * with) selects the config for the job. If it uses a different code book, the code book is reloaded.
+     *   {"op": "encode"|"decode"}: run a complete en-/decoding job, exactly like -e/-d.
+     *   {"op": "decode_reads", "reads": [...], "length": n}: decode the reads, one response
+     *       {"read": i, "metric": ..., "data": <hex>} per read, as soon as it is decoded.
+     *   {"op": "encode_packets", "packets": [<hex>, ...], "min_length": n}: encode the packets, one response
+     *       {"packet": i, "seq": ...} per packet.
+     *   {"op": "shutdown"}
+     * Every request is terminated by a response with "status" set to "ok" or "error".
+     * The log output of the coder is redirected to stderr, so that stdout only contains responses.
+     */
+    std::ostream replies(cout.rdbuf());
+    cout.rdbuf(cerr.rdbuf());
+    std::mutex replyLock;
+    auto reply = [&replies, &replyLock](const nlohmann::json &msg) {
+        std::unique_lock<std::mutex> uLock(replyLock);
+        replies << msg.dump() << '\n' << flush;
+    };
+    nlohmann::json serverConfig = parseValidateConfig(configPath, false, false);
+    auto cb = make_unique<Codebook>(serverConfig["general"]["codebook"]["words"], serverConfig["general"]["codebook"]["motifs"]);
+    cb->buildDecodeMap();
+    reply({{"status", "ready"}});
+
+    string line;
+    while (getline(cin, line)) {
+        if (line.empty())
+            continue;
+        nlohmann::json id = nullptr;
+        // a failed decode request may leave the decoding cancelled
+        decodeCancelled = false;
+        try {
+            nlohmann::json req = nlohmann::json::parse(line);
+            id = req.value("id", nlohmann::json());
+            string op = req.at("op");
+            if (op == "shutdown") {
+                reply({{"id", id}, {"status", "ok"}});
+                break;
+            }
+            bool encode = (op == "encode" || op == "encode_packets");
+            string jobConfigPath = req.value("config", configPath);
+            nlohmann::json config = parseValidateConfig(jobConfigPath, encode, !encode);
+            if (!cb->matches(config)) {
+                cb.reset();
+                cb = make_unique<Codebook>(config["general"]["codebook"]["words"], config["general"]["codebook"]["motifs"]);
+                cb->buildDecodeMap();
+            }
+            if (config.value(nlohmann::json::json_pointer("/encode/input"), "") == "-" || config.value(nlohmann::json::json_pointer("/decode/output"), "") == "-")
+                throw invalid_argument("streaming from stdin / to stdout is not supported in server mode.");
+            if (op == "encode") {
+                encode_file(config, *cb, jobConfigPath);
+            } else if (op == "decode") {
+                decode_file(config, *cb);
+            } else if (op == "decode_reads") {
+                if (req.contains("length"))
+                    config["decode"]["length"] = req["length"];
+                vector<string> reads = req.at("reads");
+                vector<string> qualities = req.value("qualities", vector<string>());
+                if (!qualities.empty() && qualities.size() != reads.size())
+                    throw invalid_argument("reads and qualities differ in length.");
+                // the replies are sent as soon as a read is decoded, the client matches them by read index
+                OrderedScheduler<nlohmann::json> scheduler(config["general"]["threads"], reply, false);
+                for (size_t i = 0; i < reads.size(); i++) {
+                    scheduler.submit([&, i] {
+                        list<tuple<string, vector<unsigned char>>> res;
+                        std::mutex lock;
+                        do_decode(reads[i], cb->freqs, cb->tMap, cb->motif, config, cb->codewordLen, res, &lock, nullptr,
+                                  qualities.empty() ? "" : qualities[i], &cb->decodeStates);
+                        if (res.empty())
+                            return nlohmann::json({{"id", id}, {"read", i}, {"metric", "ERR"}, {"data", ""}});
+                        return nlohmann::json({{"id", id}, {"read", i}, {"metric", get<0>(res.front())}, {"data", toHex(get<1>(res.front()))}});
+                    });
+                }
+                scheduler.finish();
+            } else if (op == "encode_packets") {
+                vector<string> packets = req.at("packets");
+                uint16_t minLen = req.value("min_length", static_cast<int>(config["encode"]["min_length"]));
+                OrderedScheduler<nlohmann::json> scheduler(config["general"]["threads"], reply, false);
+                for (size_t i = 0; i < packets.size(); i++) {
+                    scheduler.submit([&, i] {
+                        list<tuple<string, vector<unsigned char>>> res;
+                        std::mutex lock;
+                        do_encode(fromHex(packets[i]), config["general"]["sync"], cb->freqs, minLen, to_string(i), res, &lock);
+                        if (res.empty())
+                            throw runtime_error("packet " + to_string(i) + " could not be encoded.");
+                        vector<unsigned char> seq = get<1>(res.front());
+                        return nlohmann::json({{"id", id}, {"packet", i}, {"seq", string(seq.begin(), seq.end())}});
+                    });
+                }
+                scheduler.finish();
+            } else {
+                throw invalid_argument("unknown op: " + op);
+            }
+            reply({{"id", id}, {"status", "ok"}});
+        } catch (const exception &err) {
+            reply({{"id", id}, {"status", "error"}, {"error", err.what()}});
+        }
+    }
+}
+
 int main(int argc, char *argv[]) {
     res_lock = new std::mutex();
     argparse::ArgumentParser program("arithmetic_error_correction", "1.0.0");
     program.add_argument("-e", "--encode").default_value(false).implicit_value(true).help("encode a file");
     program.add_argument("-d", "--decode").default_value(false).implicit_value(true).help("decode a file");
+    program.add_argument("-s", "--serve").default_value(false).implicit_value(true).help("keep running and process en-/decoding requests from stdin");
     program.add_argument("Config").required().help("config file with program parameters");
     try {
         program.parse_args(argc, argv);
@@ -143,100 +567,46 @@ int main(int argc, char *argv[]) {
         cerr << program << endl;
         exit(EXIT_FAILURE);
     }
-    // ensure only en- OR decoding is selected
+    // ensure only en- OR decoding OR serving is selected
     bool encode = program.get<bool>("--encode");
     bool decode = program.get<bool>("--decode");
-    if (!(encode ^ decode) || program.get<bool>("-h")) {
+    bool server = program.get<bool>("--serve");
+    if ((encode + decode + server) != 1 || program.get<bool>("-h")) {
         cerr << program << endl;
         exit(EXIT_FAILURE);
     }
 
     string configPath = program.get<string>("Config");
-    nlohmann::json config = parseValidateConfig(configPath, encode);
-    
-    robin_hood::unordered_set<string> codewords = parseFasta(config["general"]["codebook"]["words"]); //hp4_gc40-60.fasta
-    robin_hood::unordered_map<string, vector<string>> motif = readConcScheme(config["general"]["codebook"]["motifs"]); //hp4_gc40-60.json"
-    
-    int codewordLen = getCodewordLen(codewords);
-    auto propMap = ProbMap(codewordLen, false, codewords, motif);
-    robin_hood::unordered_map<string, int32_t> freqDict = propMap.freqDict();
-    robin_hood::unordered_map<string, char2double> pMap = propMap.createTransitionDict(freqDict);
-    results = list<tuple<string, vector<unsigned char>>>();
-    FreqTable freqs = FreqTable(motif, "", 0, false, codewordLen, pMap);
-    freqs.calcFreqs();
-    if (encode) {
-        if (static_cast<string>(config["encode"]["input"]).ends_with(".zip")) {
-            encode_zip(config, freqs, config["encode"]["min_length"], config["encode"]["same_length"], configPath);
-        } else {
-            ifstream inStream(config["encode"]["input"], ios::binary);
-            assert(inStream.good());
-            BitInStream bin(inStream, config["general"]["sync"]);
-            ofstream out(config["encode"]["output"], ios::binary);
-            inflating(freqs, bin, out, config["encode"]["min_length"]);
-            if(config["encode"]["update_config"]){
-                out.flush();
-                out.close();
-                ifstream outin(config["encode"]["output"]);
-                stringstream buffer;
-                buffer << outin.rdbuf();
-                string inp = buffer.str();
-                int size = inp.size();
-                config[nlohmann::json::json_pointer("/decode/length")] = size;
-                std::ofstream confout(configPath);
-                confout << config;
-            }
-        }
-    } else {
-        robin_hood::unordered_map<string, char2double> tMap = ProbMap(codewordLen, true, codewords,
-                                                                motif).createTransitionDict(freqDict);
-        if (static_cast<string>(config["decode"]["input"]).ends_with(".zip")) {
-            Zippy::ZipArchive inarch(static_cast<string>(config["decode"]["input"]));
-            std::vector<std::string> ents = inarch.GetEntryNames();
-            absl::synchronization_internal::ThreadPool pool(config["general"]["threads"]);
-            std::vector<std::string> inpts;
-            for (auto &ent: ents) {
-                inpts.push_back(inarch.GetEntry(ent).GetDataAsString());
-            }
-            for (auto &inp: inpts) {
-                pool.Schedule(std::bind(do_decode, std::ref(inp), std::ref(freqs), std::ref(tMap), std::ref(motif), std::ref(config), std::ref(codewordLen), std::ref(results), std::ref(res_lock)));
-            }
-            while (results.size() != ents.size()) {
-                this_thread::sleep_for(chrono::milliseconds(500));
-            }
-            {
-                std::unique_lock<std::mutex> uLock(*res_lock);
-                write_to_zip(config["decode"]["output"], true, static_cast<bool>(config["general"]["zip"]["most_common_only"]), static_cast<bool>(config["general"]["zip"]["decodable_only"]),results);
-            }
-        } else if (config["general"]["as_fasta"]) {
-            // since we are returning a set, we wont have duplicates
-            robin_hood::unordered_set<string> dna_lines = parseFasta(config["decode"]["input"]);
-            absl::synchronization_internal::ThreadPool pool(config["general"]["threads"]);
-            for (const string &line: dna_lines) {
-                pool.Schedule(std::bind(do_decode, std::ref(line), std::ref(freqs), std::ref(tMap), std::ref(motif), std::ref(config), std::ref(codewordLen), std::ref(results), std::ref(res_lock)));
-            }
-            //TODO THIS CONDITION SHOULD BE IMPROVED (right now we can not make "results" a set and thus might have duplicates)
-            // ideally we would not want any (semi) busy waiting and instead be notified when the threadpool is done
-            while (results.size() < dna_lines.size()) {
-                this_thread::sleep_for(chrono::milliseconds(1000));
-            }
-            {
-                std::unique_lock<std::mutex> uLock(*res_lock);
-                write_to_zip(config["decode"]["output"], true, static_cast<bool>(config["general"]["zip"]["most_common_only"]), static_cast<bool>(config["general"]["zip"]["decodable_only"]),results);
-            }
-        } else {
-            ifstream iStream(config["decode"]["input"]);
-            stringstream buffer;
-            buffer << iStream.rdbuf();
-            string inp = buffer.str();
-            thread_local ECdecoding ecDec = ECdecoding(inp, freqs, tMap, true, config);
+    if (server) {
+        serve(configPath);
+        return 0;
+    }
+    nlohmann::json config;
+    try {
+        config = parseValidateConfig(configPath, encode, decode);
+    } catch (nlohmann::json::exception &err){
+        exit(EXIT_FAILURE);
+    }
 
-            SeqEntry dec = ecDec.decode(codewordLen, motif, config);
-            ofstream out(config["decode"]["output"], ios::out | ios::binary);
-            const vector<unsigned char> str = *dec.ac.bitout.get_data();
-            std::string seq(reinterpret_cast<const char *>(str.data()), str.size());
-            out << seq;
-            out.flush();
-            out.close();
+    Codebook cb(config["general"]["codebook"]["words"], config["general"]["codebook"]["motifs"]); //hp4_gc40-60.fasta, hp4_gc40-60.json
+    try {
+        if (encode) {
+            encode_file(config, cb, configPath);
+        } else if (config["decode"]["output"] == "-") {
+            // stream the decoded packets to stdout, log output is redirected to stderr. A closed stdout or SIGTERM
+            // cancels the remaining reads instead of terminating the process.
+            signal(SIGPIPE, SIG_IGN);
+            signal(SIGTERM, [](int) { decodeCancelled = true; });
+            std::ostream frames(cout.rdbuf());
+            cout.rdbuf(cerr.rdbuf());
+            decode_file(config, cb, &frames);
+            cout.rdbuf(frames.rdbuf());
+        } else {
+            decode_file(config, cb);
         }
+    } catch (const runtime_error &err) {
+        // e.g. the output could not be written
+        cerr << err.what() << endl;
+        exit(EXIT_FAILURE);
     }
 }
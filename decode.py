@@ -2,15 +2,48 @@ import subprocess
 import argparse
 import pathlib
 import json
+import time
 import os
+import tempfile
+import zipfile
+from collections import Counter
+import read_clustering
+import decode_coordinator
+import decode_cache
+import seqpack
+from inner_coder import print_progress, watch_progress, run_inner_coder
 
-def decode_ac(current_path, config_path):
+def decode_ac(current_path, config_path, inner_coder=None, progress=print_progress):
+    """
+    inner decoder, either as a new process or as request to a running InnerCoder (see inner_coder.py).
+    :param current_path:
+    :param config_path:
+    :param inner_coder: optional InnerCoder that keeps the code book loaded between calls
+    :param progress: callback for the progress of the inner decoder (see inner_coder.watch_progress)
+    :return:
+    """
+    if inner_coder is not None:
+        inner_coder.decode(config_path, progress)
+        return
     py_command = ("{cpath}/arithmetic_modulator_error_correction -d {conf_path}".format(cpath=current_path,
                                                                                                 conf_path=config_path))
-    process = subprocess.Popen(py_command.split(), stdout=subprocess.PIPE)
-    output, error = process.communicate()
+    run_inner_coder(py_command.split(), progress)
     return
 
+def write_temp_config(config_data, output):
+    """
+    write the config of a single run of the inner decoder to a new file next to output, so that concurrent runs do
+    not overwrite each other's config.
+    :param config_data:
+    :param output: path the config is placed next to (e.g. decode.output)
+    :return: path of the config, removed by the caller
+    """
+    output = pathlib.Path(output).resolve()
+    fd, config_path = tempfile.mkstemp(prefix=output.name + ".", suffix=".config.json", dir=output.parent)
+    with os.fdopen(fd, "w") as inter:
+        json.dump(config_data, inter)
+    return pathlib.Path(config_path)
+
 def decode_norec_for_ac(current_path, config_data):
     """
     outer decoder for the fountaincode-arithmetic code concatenation.
@@ -20,8 +53,9 @@ def decode_norec_for_ac(current_path, config_data):
     ini_path = pathlib.Path(config_data["decode"]["NOREC4DNA_config"]).resolve()
     with open(ini_path, "r") as c_:
         line_list = c_.readlines()
-        line_list[0] = "[{cpath}/{dpath}.zip]\n".format(cpath=current_path, dpath=config_data["decode"]["output"]) #"[../data/" + filename + "_RU10.zip]\n"
-        with open("{cpath}/{ini_path}".format(cpath=current_path, ini_path=config_data["decode"]["NOREC4DNA_config"]), "w") as o_:
+        # pathlib keeps absolute paths (e.g. of isolated error simulation trials) as they are
+        line_list[0] = "[{dpath}]\n".format(dpath=pathlib.Path(current_path, config_data["decode"]["output"] + ".zip")) #"[../data/" + filename + "_RU10.zip]\n"
+        with open(pathlib.Path(current_path, config_data["decode"]["NOREC4DNA_config"]), "w") as o_:
             o_.writelines(line_list)
     pathlib.Path('data/results').mkdir(parents=True, exist_ok=True)
     os.chdir('data/results')
@@ -32,22 +66,256 @@ def decode_norec_for_ac(current_path, config_data):
     os.chdir('../..')
     return
 
+def decode_stream(current_path, config_data, progress=print_progress):
+    """
+    inner and outer decoder connected by a pipe, decoded packets are passed to NOREC4DNA as soon as they are
+    available (see norec_stream.py). Once the file is recovered, the inner decoder is stopped and the remaining
+    reads are not decoded, the inner decoder reports the estimated time saved.
+    :param current_path:
+    :param config_data:
+    :param progress: callback for the progress of the inner decoder (see inner_coder.watch_progress)
+    :return: True if the file was recovered
+    """
+    start = time.time()
+    config = json.loads(json.dumps(config_data))
+    config["decode"]["output"] = "-"
+    config["decode"]["input"] = str(pathlib.Path(config_data["decode"]["input"]).resolve())
+    inter_path = write_temp_config(config, config_data["decode"]["output"])
+    try:
+        ini_path = pathlib.Path(config_data["decode"]["NOREC4DNA_config"]).resolve()
+        pathlib.Path('data/results').mkdir(parents=True, exist_ok=True)
+        inner = subprocess.Popen(["{cpath}/arithmetic_modulator_error_correction".format(cpath=current_path), "-d",
+                                  str(inter_path)], stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        watcher = watch_progress(inner.stderr, progress)
+        outer = subprocess.Popen(["{cpath}/NOREC4DNA/venv/bin/python3".format(cpath=current_path),
+                                  "{cpath}/norec_stream.py".format(cpath=current_path), "decode", str(ini_path)],
+                                 stdin=inner.stdout, cwd="data/results")
+        # the outer decoder is the only reader of the pipe
+        inner.stdout.close()
+        outer.wait()
+        # the outer decoder exits as soon as the file is recovered, SIGTERM cancels the remaining reads of the inner
+        # decoder
+        if inner.poll() is None:
+            inner.terminate()
+        inner.wait()
+        watcher.join()
+    finally:
+        os.remove(inter_path)
+    print("Streaming decoding took {:.2f}s.".format(time.time() - start))
+    return outer.returncode == 0
+
+def has_read_list(config_data):
+    """
+    :param config_data:
+    :return: True if decode.input is a list of reads (FASTA, FASTQ or packed sequences) instead of a zip file or a
+             single sequence
+    """
+    inp = config_data["decode"]["input"]
+    return config_data["general"]["as_fasta"] or decode_coordinator.is_fastq(inp) or seqpack.is_packed(inp)
+
+def cluster_input(current_path, config_data, top_n=0, workers=None):
+    """
+    optional pre-stage of the inner decoder: the reads are clustered by similarity and every cluster is replaced by
+    its consensus sequence (see read_clustering.py), so that each oligo is decoded once instead of once per copy.
+    :param current_path:
+    :param config_data: config, decode.input is replaced by the FASTA file of the consensus sequences
+    :param top_n: additionally decode the top_n cluster members closest to the consensus
+    :param workers: number of worker processes
+    :return: path of the config for the inner decoder (a new file per run, removed by the caller)
+    """
+    if decode_coordinator.is_fastq(config_data["decode"]["input"]):
+        # the consensus sequences are decoded without base qualities
+        reads = [seq for seq, _ in read_clustering.iter_fastq(config_data["decode"]["input"])]
+    else:
+        reads = list(seqpack.iter_sequences(config_data["decode"]["input"]))
+    sequences, num_clusters = read_clustering.cluster_consensus(reads, top_n=top_n, workers=workers)
+    consensus_path = pathlib.Path(config_data["decode"]["input"] + ".consensus.fasta").resolve()
+    read_clustering.write_fasta(consensus_path, sequences)
+    print("Clustered {} reads into {} clusters, {} sequences are decoded.".format(len(reads), num_clusters,
+                                                                                  len(sequences)))
+    config_data["decode"]["input"] = str(consensus_path)
+    # the consensus sequences are always FASTA (also for FASTQ, packed or as_fasta false input)
+    config_data["general"]["as_fasta"] = True
+    return write_temp_config(config_data, config_data["decode"]["output"])
+
+def decode_cached(current_path, config_data, cache, progress=print_progress):
+    """
+    inner decoder with a result cache (see decode_cache.py): only the reads without a cached result are decoded. the
+    new results are added to the cache, also if decoding is interrupted (from the journal of the inner decoder, which
+    is read after decoding or, if the process was killed, by the next run with the same output and settings, so it
+    continues where the first one stopped), and the decoded zip file is written from the cached and the new results,
+    in input order. the read indices of the telemetry refer to the decoded reads only.
+    :param current_path:
+    :param config_data: config (FASTA, FASTQ or packed input)
+    :param cache: DecodeCache
+    :param progress: callback for the progress of the inner decoder (see inner_coder.watch_progress)
+    :return: number of cache hits and misses
+    """
+    inp = config_data["decode"]["input"]
+    fastq = decode_coordinator.is_fastq(inp)
+    records = read_clustering.iter_fastq(inp) if fastq else ((seq, None) for seq in seqpack.iter_sequences(inp))
+    # duplicates are decoded once (with the qualities of the first copy), as by the inner decoder
+    reads = []
+    seen = set()
+    for seq, quality in records:
+        if seq not in seen:
+            seen.add(seq)
+            reads.append((seq, quality))
+    context = decode_cache.decode_context(config_data)
+    with_quality = fastq and decode_cache.uses_quality(config_data)
+    keys = [decode_cache.cache_key(context, seq, quality if with_quality else None) for seq, quality in reads]
+    base = str(pathlib.Path(config_data["decode"]["output"]).resolve())
+    journal = decode_cache.journal_path(base, context)
+    if os.path.exists(journal):
+        # left by a run that was killed before it could add its results to the cache
+        recovered = decode_cache.read_journal(journal, context, with_quality)
+        cache.put_many((key, metric, data) for key, (metric, data) in recovered.items()
+                       if metric not in decode_cache.FAILED_METRICS)
+        os.remove(journal)
+    results = cache.get_many(keys)
+    misses = [i for i, key in enumerate(keys) if key not in results]
+    print("Decode cache: {} hits, {} misses.".format(len(reads) - len(misses), len(misses)))
+    if misses:
+        config = json.loads(json.dumps(config_data))
+        config["decode"]["input"] = base + (".misses.fastq" if fastq else ".misses.fasta")
+        config["decode"]["output"] = base + ".misses"
+        config["decode"]["journal"] = journal
+        # the misses are always written as FASTA / FASTQ (also for packed or as_fasta false input)
+        config["general"]["as_fasta"] = True
+        with open(config["decode"]["input"], "w") as out:
+            for i in misses:
+                seq, quality = reads[i]
+                out.write("@{}\n{}\n+\n{}\n".format(i, seq, quality) if fastq else ">{}\n{}\n".format(i, seq))
+        # one config per run, concurrent runs share the cache but not their configs
+        config_path = write_temp_config(config, base)
+        new = {}
+        try:
+            decode_ac(current_path, config_path, progress=progress)
+        finally:
+            if os.path.exists(journal):
+                new = decode_cache.read_journal(journal, context, with_quality)
+            cache.put_many((key, metric, data) for key, (metric, data) in new.items()
+                           if metric not in decode_cache.FAILED_METRICS)
+            for path in (config_path, config["decode"]["input"], journal, config["decode"]["output"] + ".zip"):
+                if os.path.exists(path):
+                    os.remove(path)
+        results.update(new)
+    # same selection of the packets as by the inner decoder
+    zip_config = config_data["general"]["zip"]
+    entries = [results[key] for key in keys if key in results]
+    if zip_config["decodable_only"]:
+        entries = [(metric, data) for metric, data in entries if metric != "1000.000000"]
+    if zip_config["most_common_only"] and entries:
+        length = Counter(len(data) for _, data in entries).most_common(1)[0][0]
+        entries = [(metric, data) for metric, data in entries if len(data) == length]
+    output = config_data["decode"]["output"]
+    with zipfile.ZipFile(output if output.endswith(".zip") else output + ".zip", "w", zipfile.ZIP_STORED) as out:
+        for count, (metric, data) in enumerate(entries):
+            out.writestr("{}_{}".format(count, metric), data)
+    return len(reads) - len(misses), len(misses)
+
+def read_telemetry(path):
+    """
+    :param path: telemetry file written by the inner decoder (decode.telemetry)
+    :return: list of records, one dict per decoded read and pass
+    """
+    with open(path, "r") as inp:
+        return [json.loads(line) for line in inp if line.strip()]
+
+def summarize_telemetry(records):
+    """
+    aggregate the telemetry of one decoding run, the cost is summed over all passes.
+    :param records: see read_telemetry
+    :return: dict with the number of reads and decoded reads, the summed seconds, nodes, queue reductions,
+             checkpoint failures and backtracks and the largest queue size
+    """
+    summary = {"reads": len({rec["read"] for rec in records}),
+               "decoded": sum(rec["success"] for rec in records)}
+    for key in ("seconds", "nodes", "queue_reductions", "checkpoint_failures", "backtracks"):
+        summary[key] = sum(rec[key] for rec in records)
+    summary["peak_queue"] = max((rec["peak_queue"] for rec in records), default=0)
+    return summary
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Decode data that was encoded in DNA using the concatenation of the NOREC4DNA raptor-fountain implementation and DNA-Aeon.')
     parser.add_argument('--config', '-c', dest='conf', type=str, action='store',
                         help='path to the config file.', required=True)
+    parser.add_argument('--stream', dest='stream', action='store_true',
+                        help='pipe the decoded packets from the inner to the outer decoder instead of using an intermediate zip file.')
+    parser.add_argument('--cluster', dest='cluster', action='store_true',
+                        help='cluster the reads and only decode the consensus of each cluster (FASTA / FASTQ / packed input only).')
+    parser.add_argument('--top_n', dest='top_n', type=int, default=0,
+                        help='with --cluster, additionally decode the top_n reads closest to the consensus of each cluster.')
+    parser.add_argument('--workers', dest='workers', type=int, default=None,
+                        help='number of worker processes used for clustering (default: number of cpus).')
+    parser.add_argument('--telemetry', dest='telemetry', type=str, default=None,
+                        help='write one json record per decoded read (time, search nodes, queue and checkpoint statistics) to this file.')
+    parser.add_argument('--local_workers', dest='local_workers', type=int, default=0,
+                        help='split the input into shards and decode them in this many inner decoder processes.')
+    parser.add_argument('--hosts', dest='hosts', type=str, nargs='+', default=[],
+                        help='host:port of remote workers (see decode_coordinator.py) to decode shards on.')
+    parser.add_argument('--shards', dest='shards', type=int, default=None,
+                        help='with --local_workers or --hosts, number of shards (default: four per worker).')
+    parser.add_argument('--threads_per_worker', dest='threads_per_worker', type=int, default=None,
+                        help='general.threads of each local worker (default: from the config).')
+    parser.add_argument('--retries', dest='retries', type=int, default=2,
+                        help='number of times a failed shard is retried.')
+    parser.add_argument('--cache', dest='cache', type=str, default=None,
+                        help='result cache (sqlite file, see decode_cache.py), reads with a cached result are not decoded again (FASTA / FASTQ / packed input only).')
+    parser.add_argument('--cache_size', dest='cache_size', type=float, default=None,
+                        help='with --cache, size limit of the cache in MiB, the least recently used results are removed (default: no limit).')
     args = parser.parse_args()
+    sharded = args.local_workers > 0 or len(args.hosts) > 0
+    if sharded and args.stream:
+        parser.error("--stream can not be combined with --local_workers or --hosts.")
+    if args.cache and (sharded or args.stream):
+        parser.error("--cache can not be combined with --stream, --local_workers or --hosts.")
     cpath = pathlib.Path(__file__).parent.resolve()
     conf_path = pathlib.Path(args.conf).resolve()
     with open(args.conf, "r") as conf_inp:
         config_data = json.load(conf_inp)
 
-    # Start outer decode
-    print("Starting inner decoder.")
-    decode_ac(cpath, conf_path)
-    print("\nFinished inner decoding, starting outer decoder...\n")
-    # Start inner encoder
-    decode_norec_for_ac(cpath, config_data)
+    inter_conf = None
+    if args.telemetry:
+        config_data["decode"]["telemetry"] = str(pathlib.Path(args.telemetry).resolve())
+    if args.cluster:
+        if has_read_list(config_data):
+            conf_path = inter_conf = cluster_input(cpath, config_data, args.top_n, args.workers)
+        else:
+            print("Clustering requires FASTA, FASTQ or packed input, decoding all reads.")
+    if args.telemetry and inter_conf is None:
+        conf_path = inter_conf = write_temp_config(config_data, config_data["decode"]["output"])
+    try:
+        if args.stream:
+            print("Starting streaming decoder.")
+            if not decode_stream(cpath, config_data):
+                print("\nThe file could not be recovered.")
+        else:
+            # Start outer decode
+            print("Starting inner decoder.")
+            if sharded:
+                decode_coordinator.decode_sharded(cpath, config_data, args.local_workers, args.hosts, args.shards,
+                                                  args.threads_per_worker, args.retries)
+            elif args.cache and has_read_list(config_data):
+                max_bytes = None if args.cache_size is None else int(args.cache_size * 1024 * 1024)
+                with decode_cache.DecodeCache(args.cache, max_bytes) as cache:
+                    decode_cached(cpath, config_data, cache)
+            else:
+                if args.cache:
+                    print("The result cache requires FASTA, FASTQ or packed input, decoding all reads.")
+                decode_ac(cpath, conf_path)
+            print("\nFinished inner decoding, starting outer decoder...\n")
+            # Start inner encoder
+            decode_norec_for_ac(cpath, config_data)
+    finally:
+        if inter_conf is not None:
+            os.remove(inter_conf)
+    telemetry = config_data["decode"].get("telemetry")
+    if telemetry and os.path.exists(telemetry):
+        summary = summarize_telemetry(read_telemetry(telemetry))
+        print("Inner decoder: {decoded} of {reads} reads decoded, {seconds:.2f}s and {nodes} search nodes in total, "
+              "peak queue {peak_queue}, {queue_reductions} queue reductions, {checkpoint_failures} checkpoint "
+              "failures, {backtracks} backtracks. Telemetry per read: {path}".format(path=telemetry, **summary))
     print("\nFinished outer decoding. File can be found at {cur_path}/data/results/{inp_file}".format(
         cur_path=cpath, inp_file=config_data["encode"]["input"].split("/")[-1]))
     '''
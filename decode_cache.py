@@ -0,0 +1,182 @@
+"""
+persistent cache of inner decoder results, shared by all runs (and processes) that use the same cache file.
+
+the results are addressed by a hash of the read (and its base qualities, if they are used by the decoder), the
+content of the code book and the concatenation scheme and the decoder settings, so a read is only decoded again if
+one of them changed. only successfully decoded reads are cached. the cache is a sqlite database: concurrent runs can
+read and write it at the same time, and once it grows beyond its size limit, the least recently used results are
+removed.
+
+$ python3 decode.py -c config.json --cache data/decode_cache.sqlite --cache_size 1024
+"""
+import hashlib
+import json
+import sqlite3
+import time
+
+# decode settings that do not change the result of a read
+IGNORED_DECODE_KEYS = ("input", "output", "telemetry", "journal", "NOREC4DNA_config")
+# metrics of reads that could not be decoded, these are not cached
+FAILED_METRICS = ("1000.000000", "ERR")
+# number of keys per query, below the sqlite limit of host parameters
+QUERY_CHUNK = 500
+
+
+def file_digest(path):
+    with open(path, "rb") as inp:
+        return hashlib.blake2b(inp.read(), digest_size=16).hexdigest()
+
+
+def decode_context(config_data):
+    """
+    :param config_data: decoder config
+    :return: digest of everything besides the read that the result of the inner decoder depends on
+    """
+    decode = {key: value for key, value in config_data["decode"].items() if key not in IGNORED_DECODE_KEYS}
+    context = {"words": file_digest(config_data["general"]["codebook"]["words"]),
+               "motifs": file_digest(config_data["general"]["codebook"]["motifs"]),
+               "sync": config_data["general"]["sync"], "decode": decode}
+    return hashlib.blake2b(json.dumps(context, sort_keys=True).encode(), digest_size=16).digest()
+
+
+def uses_quality(config_data):
+    fano = config_data["decode"].get("metric", {}).get("fano", {})
+    return fano.get("use_quality", True)
+
+
+def cache_key(context, read, quality=None):
+    """
+    :param context: see decode_context
+    :param read: sequence of the read
+    :param quality: base qualities of the read, None if they are not used by the decoder
+    :return: key of the result of the read
+    """
+    key = hashlib.blake2b(context, digest_size=16)
+    key.update(read.encode())
+    if quality is not None:
+        key.update(b"\n" + quality.encode())
+    return key.digest()
+
+
+def read_journal(path, context, with_quality):
+    """
+    :param path: journal written by the inner decoder (decode.journal)
+    :param context: see decode_context, of the config the journal was written with
+    :param with_quality: True if the base qualities are part of the keys
+    :return: dict key -> (metric, data) of all results in the journal
+    """
+    res = {}
+    with open(path, "r") as journal:
+        for line in journal:
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                # the last line of an interrupted run may be incomplete
+                continue
+            key = cache_key(context, rec["seq"], rec.get("quality") if with_quality else None)
+            res[key] = (rec["metric"], bytes.fromhex(rec["data"]))
+    return res
+
+
+def journal_path(output, context):
+    """
+    :param output: decode.output of the run
+    :param context: see decode_context
+    :return: path of the journal of the inner decoder, a run with other settings does not use it
+    """
+    return "{}.{}.journal.jsonl".format(output, context.hex()[:16])
+
+
+class DecodeCache:
+    """
+    size bounded LRU store of decoder results (metric and decoded data) in a sqlite database.
+    """
+
+    def __init__(self, path, max_bytes=None, timeout=60.0):
+        """
+        :param path: path of the database, created if it does not exist
+        :param max_bytes: size limit of the cached results (keys, metrics and data), None for no limit
+        :param timeout: seconds to wait for a lock held by another process
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.conn = sqlite3.connect(path, timeout=timeout, isolation_level=None)
+        # write ahead logging: readers do not block the writer and vice versa
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS results (key BLOB PRIMARY KEY, metric TEXT NOT NULL, "
+                          "data BLOB NOT NULL, size INTEGER NOT NULL, used REAL NOT NULL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS results_used ON results (used)")
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def get_many(self, keys):
+        """
+        :param keys: list of keys
+        :return: dict key -> (metric, data) of the cached keys, these are marked as recently used
+        """
+        keys = list(set(keys))
+        res = {}
+        for i in range(0, len(keys), QUERY_CHUNK):
+            chunk = keys[i:i + QUERY_CHUNK]
+            rows = self.conn.execute("SELECT key, metric, data FROM results WHERE key IN ({})".format(
+                ",".join("?" * len(chunk))), chunk)
+            res.update((key, (metric, bytes(data))) for key, metric, data in rows)
+        if res:
+            now = time.time()
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                self.conn.executemany("UPDATE results SET used = ? WHERE key = ?", ((now, key) for key in res))
+                self.conn.execute("COMMIT")
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+        return res
+
+    def put_many(self, items):
+        """
+        store results and remove the least recently used ones if the cache exceeds its size limit.
+        :param items: iterable of (key, metric, data)
+        :return: number of stored results
+        """
+        now = time.time()
+        rows = [(key, metric, bytes(data), len(key) + len(metric) + len(data), now) for key, metric, data in items]
+        if not rows:
+            return 0
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            self.conn.executemany("INSERT OR REPLACE INTO results (key, metric, data, size, used) "
+                                  "VALUES (?, ?, ?, ?, ?)", rows)
+            self._evict()
+            self.conn.execute("COMMIT")
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        return len(rows)
+
+    def _evict(self):
+        if self.max_bytes is None:
+            return
+        total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        remove = []
+        for key, size in self.conn.execute("SELECT key, size FROM results ORDER BY used"):
+            if total <= self.max_bytes:
+                break
+            remove.append((key,))
+            total -= size
+        self.conn.executemany("DELETE FROM results WHERE key = ?", remove)
+
+    def stats(self):
+        """
+        :return: dict with the number of cached results and their size in bytes
+        """
+        count, size = self.conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM results").fetchone()
+        return {"results": count, "bytes": size}
@@ -0,0 +1,417 @@
+"""
+sharded inner decoding on several local worker processes and / or remote workers.
+
+the FASTA, FASTQ or zip input is split into shards of consecutive reads (duplicate reads are dropped), every shard is
+decoded by the inner decoder of a local worker process or sent to a remote worker, failed shards are retried on the
+next free worker. the shard results are merged into the zip file that is passed to the NOREC4DNA decoder as today,
+most_common_only is applied to the merged entries so that all shards keep the same packet length.
+
+remote workers are started on every host with
+
+$ python3 decode_coordinator.py -c config.json --host 0.0.0.0 --port 9000 --jobs 1
+
+and decode up to --jobs shards at a time with their own code book and general.threads (per shard). a message of the protocol is a json
+header line followed by the payload parts, the header lists the size of each part in bytes ("sizes"). the
+coordinator sends {"op": "decode", "config": ..., "format": "fasta" | "fastq" | "zip"} with the shard as single
+part, the worker answers {"status": "ok"} with the decoded zip and the telemetry records as parts, or
+{"status": "error", "error": ...}.
+"""
+import argparse
+import hashlib
+import json
+import os
+import pathlib
+import shutil
+import socket
+import socketserver
+import tempfile
+import threading
+import time
+import zipfile
+from collections import Counter, deque
+from copy import deepcopy
+from inner_coder import run_inner_coder
+from read_clustering import iter_fastq
+from seqpack import PackedSequences, is_packed, iter_sequences
+
+
+def count_reads(input_path):
+    """
+    :param input_path: FASTA, FASTQ, packed sequence or zip file
+    :return: number of reads (including duplicates)
+    """
+    if str(input_path).endswith(".zip"):
+        with zipfile.ZipFile(input_path) as inp:
+            return len(inp.infolist())
+    if is_packed(input_path):
+        return len(PackedSequences(input_path))
+    if is_fastq(input_path):
+        return sum(1 for _ in iter_fastq(input_path))
+    with open(input_path, "r") as f:
+        return sum(line.startswith(">") for line in f)
+
+
+def is_fastq(input_path):
+    return str(input_path).endswith((".fastq", ".fq"))
+
+
+def split_input(input_path, shards_dir, num_shards):
+    """
+    split the input into shards of consecutive reads, duplicate reads are only added to the first shard they occur in.
+    the shards of packed sequences are FASTA files.
+    :param input_path: FASTA, FASTQ, packed sequence or zip file
+    :param shards_dir: folder for the shard files
+    :param num_shards: maximal number of shards
+    :return: list of shard dicts with index, path, format and number of reads
+    """
+    per_shard = max(1, -(-count_reads(input_path) // max(1, num_shards)))
+    is_zip = str(input_path).endswith(".zip")
+    fmt = "zip" if is_zip else "fastq" if is_fastq(input_path) else "fasta"
+    shards = []
+    # 8 byte digests instead of the reads, to bound the memory for large sequencing runs
+    seen = set()
+
+    def new_shard():
+        shard = {"index": len(shards), "reads": 0, "format": fmt}
+        shard["path"] = str(pathlib.Path(shards_dir, "shard_{}.{}".format(shard["index"], shard["format"])))
+        shards.append(shard)
+        return shard
+
+    if is_zip:
+        out = None
+        with zipfile.ZipFile(input_path) as inp:
+            for info in inp.infolist():
+                data = inp.read(info)
+                digest = hashlib.blake2b(data, digest_size=8).digest()
+                if digest in seen:
+                    continue
+                seen.add(digest)
+                if out is None or shards[-1]["reads"] == per_shard:
+                    if out is not None:
+                        out.close()
+                    out = zipfile.ZipFile(new_shard()["path"], "w", zipfile.ZIP_STORED)
+                out.writestr(info.filename, data)
+                shards[-1]["reads"] += 1
+        if out is not None:
+            out.close()
+    else:
+        out = None
+        records = iter_fastq(input_path) if fmt == "fastq" else ((seq, None) for seq in iter_sequences(input_path))
+        for seq, qual in records:
+            digest = hashlib.blake2b(seq.encode(), digest_size=8).digest()
+            if digest in seen:
+                continue
+            seen.add(digest)
+            if out is None or shards[-1]["reads"] == per_shard:
+                if out is not None:
+                    out.close()
+                out = open(new_shard()["path"], "w")
+            if qual is None:
+                out.write(">{}\n{}\n".format(shards[-1]["reads"], seq))
+            else:
+                out.write("@{}\n{}\n+\n{}\n".format(shards[-1]["reads"], seq, qual))
+            shards[-1]["reads"] += 1
+        if out is not None:
+            out.close()
+    return shards
+
+
+def decode_shard(current_path, config_data, input_path, output_dir, progress=None):
+    """
+    decode a single shard with the inner decoder.
+    :param current_path: path of the DNA-Aeon folder
+    :param config_data: config of the complete decoding
+    :param input_path: FASTA, FASTQ or zip file of the shard
+    :param output_dir: folder for the shard config and results
+    :param progress: callback for the progress of the inner decoder (see inner_coder.watch_progress)
+    :return: (path of the decoded zip, path of the telemetry records or None)
+    """
+    config = deepcopy(config_data)
+    output_dir = pathlib.Path(output_dir)
+    config["decode"]["input"] = str(input_path)
+    config["decode"]["output"] = str(output_dir / "decoded.zip")
+    config["general"]["as_fasta"] = not str(input_path).endswith(".zip")
+    config["general"].setdefault("zip", {})
+    # the most common length is chosen over all shards when merging
+    config["general"]["zip"]["most_common_only"] = False
+    telemetry = output_dir / "telemetry.jsonl" if config["decode"].get("telemetry") else None
+    config["decode"]["telemetry"] = str(telemetry) if telemetry else ""
+    config_path = output_dir / "config.json"
+    with open(config_path, "w") as inter:
+        json.dump(config, inter)
+    returncode = run_inner_coder(["{cpath}/arithmetic_modulator_error_correction".format(cpath=current_path), "-d",
+                                  str(config_path)], progress)
+    if returncode != 0 or not os.path.exists(config["decode"]["output"]):
+        raise RuntimeError("Inner decoder failed on {} (exit code {}).".format(input_path, returncode))
+    return config["decode"]["output"], telemetry
+
+
+def send_message(out, header, *parts):
+    """
+    :param out: binary file object of the socket
+    :param header: json serializable dict, the sizes of the parts are added
+    :param parts: payload bytes
+    """
+    header = dict(header, sizes=[len(part) for part in parts])
+    out.write((json.dumps(header) + "\n").encode())
+    for part in parts:
+        out.write(part)
+    out.flush()
+
+
+def recv_message(inp):
+    """
+    :param inp: binary file object of the socket
+    :return: (header, list of payload bytes)
+    """
+    line = inp.readline()
+    if not line:
+        raise ConnectionError("Connection closed by the peer.")
+    header = json.loads(line)
+    parts = []
+    for size in header.get("sizes", []):
+        part = inp.read(size)
+        if len(part) != size:
+            raise ConnectionError("Connection closed by the peer.")
+        parts.append(part)
+    return header, parts
+
+
+class LocalWorker:
+    """
+    decodes the shards in a separate inner decoder process on this machine.
+    """
+
+    def __init__(self, current_path, threads=None):
+        """
+        :param current_path: path of the DNA-Aeon folder
+        :param threads: general.threads of the inner decoder, defaults to the config
+        """
+        self.current_path = current_path
+        self.threads = threads
+        self.name = "local"
+
+    def decode(self, shard, config_data, output_dir):
+        config = deepcopy(config_data)
+        if self.threads:
+            config["general"]["threads"] = self.threads
+        return decode_shard(self.current_path, config, shard["path"], output_dir)
+
+
+class RemoteWorker:
+    """
+    sends the shards to a worker started with decode_coordinator.py (see serve).
+    """
+
+    def __init__(self, address, timeout=None):
+        """
+        :param address: host:port of the worker
+        :param timeout: socket timeout in seconds, None to wait as long as the decoding takes
+        """
+        host, port = address.rsplit(":", 1)
+        self.address = (host, int(port))
+        self.timeout = timeout
+        self.name = address
+
+    def decode(self, shard, config_data, output_dir):
+        with open(shard["path"], "rb") as inp:
+            data = inp.read()
+        with socket.create_connection(self.address, timeout=self.timeout) as sock, sock.makefile("rwb") as conn:
+            send_message(conn, {"op": "decode", "config": config_data, "format": shard["format"]}, data)
+            header, parts = recv_message(conn)
+        if header.get("status") != "ok":
+            raise RuntimeError("Worker {} failed: {}".format(self.name, header.get("error")))
+        output = pathlib.Path(output_dir, "decoded.zip")
+        output.write_bytes(parts[0])
+        telemetry = None
+        if config_data["decode"].get("telemetry"):
+            telemetry = pathlib.Path(output_dir, "telemetry.jsonl")
+            telemetry.write_bytes(parts[1])
+        return str(output), telemetry
+
+
+def merge_shards(results, output, most_common_only=True):
+    """
+    merge the decoded zip files of the shards (in shard order) into a single zip file, the entries are renumbered.
+    :param results: list of decoded zip files
+    :param output: path of the merged zip file
+    :param most_common_only: keep only the entries of the most common length over all shards
+    :return: number of entries in the merged zip file
+    """
+    sizes = Counter()
+    for path in results:
+        with zipfile.ZipFile(path) as inp:
+            sizes.update(info.file_size for info in inp.infolist())
+    length = sizes.most_common(1)[0][0] if sizes else None
+    count = 0
+    with zipfile.ZipFile(output, "w", zipfile.ZIP_STORED) as out:
+        for path in results:
+            with zipfile.ZipFile(path) as inp:
+                for info in inp.infolist():
+                    if most_common_only and info.file_size != length:
+                        continue
+                    metric = info.filename.split("_", 1)[-1]
+                    out.writestr("{}_{}".format(count, metric), inp.read(info))
+                    count += 1
+    return count
+
+
+def merge_telemetry(shards, telemetry_paths, output):
+    """
+    concatenate the telemetry records of the shards, the read indices are offset to the merged numbering of the reads.
+    """
+    offset = 0
+    with open(output, "w") as out:
+        for shard, path in zip(shards, telemetry_paths):
+            if path is not None and os.path.exists(path):
+                with open(path, "r") as inp:
+                    for line in inp:
+                        if line.strip():
+                            rec = json.loads(line)
+                            rec["read"] += offset
+                            out.write(json.dumps(rec) + "\n")
+            offset += shard["reads"]
+
+
+def decode_sharded(current_path, config_data, local_workers=0, hosts=(), num_shards=None, threads_per_worker=None,
+                   retries=2, timeout=None):
+    """
+    decode the input of the config on several local worker processes and / or remote workers and write the merged
+    result to decode.output (.zip), as the inner decoder does.
+    :param current_path: path of the DNA-Aeon folder
+    :param config_data:
+    :param local_workers: number of local inner decoder processes
+    :param hosts: host:port addresses of remote workers, an address can be given several times to decode several
+                  shards on that host at the same time (up to the --jobs of its worker)
+    :param num_shards: number of shards, defaults to four per worker
+    :param threads_per_worker: general.threads of the local workers, defaults to the config
+    :param retries: number of times a failed shard is retried, a worker is retired after retries + 1 failures in a row
+    :param timeout: socket timeout for remote workers in seconds
+    :return: path of the merged zip file
+    """
+    workers = [LocalWorker(current_path, threads_per_worker) for _ in range(local_workers)]
+    workers += [RemoteWorker(host, timeout) for host in hosts]
+    if not workers:
+        raise ValueError("At least one local or remote worker is required.")
+    start = time.time()
+    output = config_data["decode"]["output"]
+    if not output.endswith(".zip"):
+        output += ".zip"
+    tmp = tempfile.mkdtemp(prefix="dna_aeon_shards_")
+    try:
+        shards = split_input(config_data["decode"]["input"], tmp, num_shards or 4 * len(workers))
+        pending = deque(shards)
+        results = dict()
+        attempts = Counter()
+        errors = []
+        cond = threading.Condition()
+
+        def run(worker):
+            failures = 0
+            while True:
+                with cond:
+                    cond.wait_for(lambda: pending or len(results) == len(shards) or errors)
+                    if errors or not pending:
+                        return
+                    shard = pending.popleft()
+                output_dir = pathlib.Path(tmp, "shard_{}".format(shard["index"]), str(attempts[shard["index"]]))
+                output_dir.mkdir(parents=True)
+                try:
+                    result = worker.decode(shard, config_data, output_dir)
+                except (OSError, RuntimeError, ValueError) as err:
+                    failures += 1
+                    with cond:
+                        attempts[shard["index"]] += 1
+                        print("Shard {} failed on worker {} (attempt {}): {}".format(
+                            shard["index"], worker.name, attempts[shard["index"]], err))
+                        if attempts[shard["index"]] > retries:
+                            errors.append(err)
+                        else:
+                            pending.append(shard)
+                        cond.notify_all()
+                        if failures > retries:
+                            print("Retiring worker {} after {} failures in a row.".format(worker.name, failures))
+                            return
+                    continue
+                failures = 0
+                with cond:
+                    results[shard["index"]] = result
+                    print("Shard {} ({} reads) decoded by worker {}, {} of {} shards done.".format(
+                        shard["index"], shard["reads"], worker.name, len(results), len(shards)))
+                    cond.notify_all()
+
+        threads = [threading.Thread(target=run, args=(worker,), daemon=True) for worker in workers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise RuntimeError("Sharded decoding failed: {}".format(errors[0]))
+        if len(results) != len(shards):
+            raise RuntimeError("Sharded decoding failed: all workers were retired.")
+        ordered = [results[shard["index"]] for shard in shards]
+        entries = merge_shards([res[0] for res in ordered], output,
+                               config_data["general"].get("zip", {}).get("most_common_only", True))
+        if config_data["decode"].get("telemetry"):
+            merge_telemetry(shards, [res[1] for res in ordered], config_data["decode"]["telemetry"])
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    print("Decoded {} reads in {} shards on {} workers in {:.2f}s, {} packets written to {}.".format(
+        sum(shard["reads"] for shard in shards), len(shards), len(workers), time.time() - start, entries, output))
+    return output
+
+
+def serve(current_path, config_data, host="0.0.0.0", port=9000, jobs=1):
+    """
+    run a remote worker: shards are decoded with the code book and general.threads of config_data, all other settings
+    are taken from the config sent by the coordinator.
+    :param current_path: path of the DNA-Aeon folder
+    :param config_data: config of this worker
+    :param host:
+    :param port:
+    :param jobs: maximal number of shards that are decoded at once, further connections wait for a free slot
+    """
+    slots = threading.BoundedSemaphore(jobs)
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            try:
+                request, parts = recv_message(self.rfile)
+            except (ConnectionError, ValueError):
+                return
+            try:
+                if request.get("op") != "decode":
+                    raise ValueError("unknown op: {}".format(request.get("op")))
+                config = request["config"]
+                config["general"]["codebook"] = config_data["general"]["codebook"]
+                config["general"]["threads"] = config_data["general"].get("threads", os.cpu_count())
+                with slots, tempfile.TemporaryDirectory(prefix="dna_aeon_worker_") as tmp:
+                    input_path = pathlib.Path(tmp, "shard." + request["format"])
+                    input_path.write_bytes(parts[0])
+                    output, telemetry = decode_shard(current_path, config, input_path, tmp)
+                    with open(output, "rb") as inp:
+                        result = inp.read()
+                    records = pathlib.Path(telemetry).read_bytes() if telemetry and telemetry.exists() else b""
+                send_message(self.wfile, {"status": "ok"}, result, records)
+            except Exception as err:
+                send_message(self.wfile, {"status": "error", "error": str(err)})
+
+    socketserver.ThreadingTCPServer.allow_reuse_address = True
+    socketserver.ThreadingTCPServer.daemon_threads = True
+    with socketserver.ThreadingTCPServer((host, port), Handler) as server:
+        print("Decode worker listening on {}:{}, {} shard(s) at a time.".format(host, server.server_address[1], jobs),
+              flush=True)
+        server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Remote worker for the sharded inner decoding of decode.py (--hosts).')
+    parser.add_argument('--config', '-c', dest='conf', type=str, action='store',
+                        help='config file with the code book and general.threads of this worker.', required=True)
+    parser.add_argument('--host', dest='host', type=str, default="0.0.0.0", help='address to listen on.')
+    parser.add_argument('--port', dest='port', type=int, default=9000, help='port to listen on.')
+    parser.add_argument('--jobs', dest='jobs', type=int, default=1,
+                        help='number of shards that are decoded at once, each with general.threads threads.')
+    args = parser.parse_args()
+    with open(args.conf, "r") as conf_inp:
+        serve(pathlib.Path(__file__).parent.resolve(), json.load(conf_inp), args.host, args.port, args.jobs)
@@ -3,6 +3,15 @@ import argparse
 import pathlib
 import json
 import os
+import queue
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from inner_coder import print_progress, watch_progress, run_inner_coder, InnerCoder
+from seqpack import is_packed
+from decode_coordinator import count_reads
 
 
 def header_crc_mapper(header_crc_conf_entry, header_bool):
@@ -34,57 +43,327 @@ def encode_norec_for_ac(config_data, current_path):
     process = subprocess.Popen(py_command.split(), stdout=subprocess.PIPE)
     output, error = process.communicate()
     norec_config = output.split()[-1].decode()
-    # print("\n" + NOREC4DNA_BASE_PATH + "/" + filename + ".ini\n")
-    # os.rename(config, NOREC4DNA_BASE_PATH + "/" + filename + ".ini")
+    write_norec_config(norec_config, config_data, current_path)
+    return
+
+
+def norec_args(config_data):
+    """
+    NOREC4DNA encoder arguments shared by the zip based and the streaming pipeline.
+    :param config_data:
+    :return: list of arguments
+    """
+    args = ["--chunk_size", str(config_data["NOREC4DNA"]["chunk_size"]),
+            "--error_correction", config_data["NOREC4DNA"]["error_detection"],
+            "--overhead", str(config_data["NOREC4DNA"]["package_redundancy"])]
+    if config_data["NOREC4DNA"]["insert_header"]:
+        args.append("--insert_header")
+    header_crc_str = header_crc_mapper(config_data["NOREC4DNA"]["header_crc_length"], config_data["NOREC4DNA"]["insert_header"])
+    if header_crc_str:
+        args += ["--header_crc_str", header_crc_str]
+    return args
+
+
+def write_norec_config(norec_config, config_data, current_path, packets=None):
+    """
+    move the config written by the NOREC4DNA encoder to decode.NOREC4DNA_config.
+    :param norec_config: path of the config written by NOREC4DNA
+    :param config_data:
+    :param current_path:
+    :param packets: packet zip file the config refers to, defaults to data/<input file>_RU10.zip
+    :return:
+    """
+    filename = config_data["encode"]["input"].split("/")[-1]
+    if packets is None:
+        packets = "{cpath}/data/{fname}_RU10.zip".format(cpath=current_path, fname=filename)
     with open(norec_config, "r") as c_:
         line_list = c_.readlines()
-        line_list[0] = "[{cpath}/data/{fname}_RU10.zip]\n".format(cpath=current_path, fname=filename) #"[../data/" + filename + "_RU10.zip]\n"
+        line_list[0] = "[{packets}]\n".format(packets=packets) #"[../data/" + filename + "_RU10.zip]\n"
         if config_data["NOREC4DNA"]["header_crc_length"] == 0:
             del(line_list[-6])
-        with open("{cpath}/{ini_path}".format(cpath=current_path, ini_path=config_data["decode"]["NOREC4DNA_config"]), "w") as o_:
+        # pathlib keeps absolute paths (e.g. of batch encoding) as they are
+        with open(pathlib.Path(current_path, config_data["decode"]["NOREC4DNA_config"]), "w") as o_:
             o_.writelines(line_list)
     os.remove(norec_config)
+
+
+def encode_stream(config_data, current_path, progress=print_progress):
+    """
+    outer and inner encoder connected by a pipe, packets are inner encoded as soon as NOREC4DNA generates them,
+    without writing the intermediate zip file (see norec_stream.py).
+    :param config_data:
+    :param current_path:
+    :param progress: callback for the progress of the inner encoder (see inner_coder.watch_progress)
+    :return:
+    """
+    input_file = config_data["encode"]["input"]
+    config = json.loads(json.dumps(config_data))
+    config["encode"]["input"] = "-"
+    # per-run temporary files next to the output, so that concurrent encodes do not share them
+    output = pathlib.Path(config_data["encode"]["output"]).resolve()
+    fd, config_path = tempfile.mkstemp(prefix=output.name + ".", suffix=".config.json", dir=output.parent)
+    with os.fdopen(fd, "w") as inter:
+        json.dump(config, inter)
+    fd, norec_conf_out = tempfile.mkstemp(prefix=output.name + ".", suffix=".norec", dir=output.parent)
+    os.close(fd)
+    try:
+        outer = subprocess.Popen(["{cpath}/NOREC4DNA/venv/bin/python3".format(cpath=current_path),
+                                  "{cpath}/norec_stream.py".format(cpath=current_path), "encode", input_file,
+                                  "--config_out", norec_conf_out] + norec_args(config_data), stdout=subprocess.PIPE)
+        inner = subprocess.Popen(["{cpath}/arithmetic_modulator_error_correction".format(cpath=current_path), "-e",
+                                  config_path],
+                                 stdin=outer.stdout, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+        watcher = watch_progress(inner.stderr, progress)
+        # the inner encoder is the only reader of the pipe
+        outer.stdout.close()
+        inner.wait()
+        watcher.join()
+        outer.wait()
+        if outer.returncode != 0 or inner.returncode != 0:
+            raise RuntimeError("Streaming encoding failed.")
+        with open(norec_conf_out, "r") as c_:
+            norec_config = c_.read().strip()
+    finally:
+        os.remove(config_path)
+        os.remove(norec_conf_out)
+    write_norec_config(norec_config, config_data, current_path)
     return
 
 
-def encode_ac(current_path, config):
+def encode_ac(current_path, config, inner_coder=None, progress=print_progress):
     """
     encode the sequences using the fountaincode-arithmetic code concatenation.
     :param file:
+    :param inner_coder: optional InnerCoder (see inner_coder.py) that keeps the code book loaded between calls
+    :param progress: callback for the progress of the inner encoder (see inner_coder.watch_progress)
     :return:
     """
     filename = config["encode"]["input"].split("/")[-1]
     config["encode"]["input"] = "{cpath}/data/{filename}_RU10.zip".format(cpath=current_path, filename=filename)
     with open("intermediate_config.json", "w") as inter:
         json.dump(config, inter)
-    # Inner encoder command
-    py_command = ("{cpath}/arithmetic_modulator_error_correction -e {cpath}/{config_file}".format(
-        cpath=current_path, config_file="intermediate_config.json"))
-    process = subprocess.Popen(py_command.split(), stdout=subprocess.PIPE)
-    output, error = process.communicate()
+    if inner_coder is not None:
+        inner_coder.encode("intermediate_config.json", progress)
+    else:
+        # Inner encoder command
+        py_command = ("{cpath}/arithmetic_modulator_error_correction -e {cpath}/{config_file}".format(
+            cpath=current_path, config_file="intermediate_config.json"))
+        run_inner_coder(py_command.split(), progress)
     os.remove("intermediate_config.json")
     if not config["encode"]["keep_intermediary"]:
         os.remove(config["encode"]["input"])
     #ret = parse_fasta(file + "_encoded.fasta")
     return
 
+class OuterEncoder:
+    """
+    client for a long-running NOREC4DNA encoder (norec_stream.py batch), the interpreter and NOREC4DNA are loaded once
+    for all files. requests are answered in the order they were sent.
+    """
+
+    def __init__(self, current_path, config_data, work_dir):
+        """
+        :param current_path: path of the DNA-Aeon folder
+        :param config_data: config with the NOREC4DNA settings for all files
+        :param work_dir: working directory of the encoder, NOREC4DNA writes its config files there
+        """
+        self.process = subprocess.Popen(["{cpath}/NOREC4DNA/venv/bin/python3".format(cpath=current_path),
+                                         "{cpath}/norec_stream.py".format(cpath=current_path), "batch"]
+                                        + norec_args(config_data), cwd=work_dir, stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE, text=True, bufsize=1)
+
+    def alive(self):
+        return self.process.poll() is None
+
+    def encode(self, file, packets):
+        """
+        :param file: file to encode
+        :param packets: zip file for the packets
+        :return: (number of packets, path of the NOREC4DNA config written by the encoder)
+        """
+        self.process.stdin.write(json.dumps({"file": str(file), "packets": str(packets)}) + "\n")
+        self.process.stdin.flush()
+        line = self.process.stdout.readline()
+        if not line:
+            raise RuntimeError("Outer encoder terminated unexpectedly.")
+        resp = json.loads(line)
+        if "error" in resp:
+            raise RuntimeError("Outer encoding failed: {}".format(resp["error"]))
+        return resp["packets"], resp["config"]
+
+    def close(self):
+        if self.alive():
+            self.process.stdin.close()
+            self.process.wait()
+
+
+def batch_inputs(path):
+    """
+    :param path: folder (all files in it) or manifest (one file per line, relative to the manifest, # for comments)
+    :return: list of the input files
+    """
+    path = pathlib.Path(path)
+    if path.is_dir():
+        return sorted(p for p in path.iterdir() if p.is_file())
+    with open(path, "r") as manifest:
+        lines = [line.strip() for line in manifest]
+    return [pathlib.Path(path.parent, line) for line in lines if line and not line.startswith("#")]
+
+
+def encode_batch_file(current_path, config_data, input_file, name, output_dir, worker):
+    """
+    encode a single file of a batch with the encoders of the worker, in its own scratch directory.
+    :param worker: dict with the OuterEncoder (outer), the InnerCoder (inner) and the scratch directory (dir) of the
+                   worker, stopped encoders are restarted
+    :return: result dict of the file
+    """
+    start = time.time()
+    res = {"input": str(input_file), "name": name}
+    scratch = pathlib.Path(tempfile.mkdtemp(prefix=name + "_", dir=worker["dir"]))
+    packets = scratch / (name + "_RU10.zip")
+    output = output_dir / (name + pathlib.Path(config_data["encode"]["output"]).suffix)
+    config_path = output_dir / (name + ".json")
+    try:
+        res["bytes"] = os.path.getsize(input_file)
+        if not worker["outer"].alive():
+            worker["outer"] = OuterEncoder(current_path, config_data, worker["dir"])
+        if worker["inner"].process.poll() is not None:
+            worker["inner"] = InnerCoder(current_path, worker["config"])
+        res["packets"], norec_config = worker["outer"].encode(input_file, packets)
+        config = json.loads(json.dumps(config_data))
+        config["encode"]["input"] = str(packets)
+        config["encode"]["output"] = str(output)
+        # ZipWriter appends .zip
+        if not (config["general"]["as_fasta"] or is_packed(output) or str(output).endswith(".zip")):
+            output = pathlib.Path(str(output) + ".zip")
+        config["decode"]["input"] = str(output)
+        config["decode"]["output"] = str(output_dir / (name + "_decoded"))
+        config["decode"]["NOREC4DNA_config"] = str(output_dir / (name + ".ini"))
+        write_norec_config(norec_config, config, current_path, packets)
+        with open(config_path, "w") as o_:
+            json.dump(config, o_)
+        worker["inner"].encode(config_path, progress=None)
+        # the inner encoder may have updated decode.length, the config is kept to decode the file
+        with open(config_path, "r") as c_:
+            config = json.load(c_)
+        config["encode"]["input"] = str(input_file)
+        with open(config_path, "w") as o_:
+            json.dump(config, o_)
+        if config_data["encode"].get("keep_intermediary", False):
+            shutil.move(packets, output_dir / packets.name)
+        res.update({"output": str(output), "config": str(config_path), "sequences": count_reads(output),
+                    "status": "ok"})
+    except Exception as err:
+        res.update({"status": "failed", "error": str(err)})
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+    res["seconds"] = time.time() - start
+    return res
+
+
+def encode_batch(current_path, config_data, inputs, output_dir, workers=1):
+    """
+    encode many files with the settings of one config. every worker keeps an outer (norec_stream.py batch) and an
+    inner encoder (InnerCoder) running for all of its files, so NOREC4DNA and the code book are loaded once per worker
+    instead of once per file. every file is encoded in its own scratch directory with its own config, so files (and
+    batches in the same folder) do not share any temporary files. for every file, the encoded sequences (named after
+    the input, with the extension of encode.output), the config to decode them (<name>.json) and the NOREC4DNA config
+    (<name>.ini) are written to output_dir, together with summary.json.
+    :param current_path: path of the DNA-Aeon folder
+    :param config_data: config, encode.input / output and the decode paths are replaced for every file
+    :param inputs: list of input files
+    :param output_dir: folder for the results
+    :param workers: number of files encoded at the same time, each inner encoder uses general.threads threads
+    :return: summary dict with one result per file (in input order)
+    """
+    start = time.time()
+    output_dir = pathlib.Path(output_dir).resolve()
+    output_dir.mkdir(parents=True, exist_ok=True)
+    # unique output names, also for inputs with the same file name
+    names = []
+    for input_file in inputs:
+        name = pathlib.Path(input_file).name
+        while name in names:
+            name = "{}_{}".format(pathlib.Path(input_file).name, len(names))
+        names.append(name)
+    started = []
+    pool = queue.Queue()
+
+    def run(input_file, name):
+        worker = pool.get()
+        try:
+            res = encode_batch_file(current_path, config_data, pathlib.Path(input_file).resolve(), name, output_dir,
+                                    worker)
+        finally:
+            pool.put(worker)
+        print("{}: {} ({:.1f}s){}".format(res["input"], res["status"], res["seconds"],
+                                          ", " + res["error"] if "error" in res else ""))
+        return res
+
+    try:
+        for i in range(max(1, min(workers, len(inputs)))):
+            work_dir = tempfile.mkdtemp(prefix="worker_{}_".format(i), dir=output_dir)
+            worker_config = pathlib.Path(work_dir, "config.json")
+            with open(worker_config, "w") as o_:
+                json.dump(config_data, o_)
+            worker = {"dir": work_dir, "config": worker_config, "outer": None, "inner": None}
+            started.append(worker)
+            worker["outer"] = OuterEncoder(current_path, config_data, work_dir)
+            worker["inner"] = InnerCoder(current_path, worker_config)
+            pool.put(worker)
+        with ThreadPoolExecutor(max_workers=len(started)) as executor:
+            results = list(executor.map(run, inputs, names))
+    finally:
+        # the workers hold the current (possibly restarted) encoders
+        for worker in started:
+            for coder in (worker["outer"], worker["inner"]):
+                if coder is not None:
+                    coder.close()
+            shutil.rmtree(worker["dir"], ignore_errors=True)
+    summary = {"files": results, "encoded": sum(res["status"] == "ok" for res in results),
+               "failed": sum(res["status"] != "ok" for res in results), "workers": len(started),
+               "seconds": time.time() - start}
+    with open(output_dir / "summary.json", "w") as o_:
+        json.dump(summary, o_, indent=2)
+    return summary
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Encode data in DNA using the concatenation of the NOREC4DNA raptor-fountain implementation and DNA-Aeon.')
     parser.add_argument('--config', '-c', dest='conf', type=str, action='store',
                         help='path to the config file.', required=True)
+    parser.add_argument('--stream', dest='stream', action='store_true',
+                        help='pipe the packets from the outer to the inner encoder instead of using an intermediate zip file.')
+    parser.add_argument('--batch', dest='batch', type=str, default=None,
+                        help='encode all files of a folder or a manifest (one file per line) instead of encode.input.')
+    parser.add_argument('--output_dir', dest='output_dir', type=str, default="data/batch",
+                        help='with --batch, folder for the encoded files, their configs and summary.json.')
+    parser.add_argument('--workers', dest='workers', type=int, default=1,
+                        help='with --batch, number of files encoded at the same time.')
     args = parser.parse_args()
+    if args.batch and args.stream:
+        parser.error("--batch can not be combined with --stream.")
 
     cpath = pathlib.Path(__file__).parent.resolve()
     with open(args.conf, "r") as conf_inp:
         config_data = json.load(conf_inp)
 
-    # Start outer encoder
-    encode_norec_for_ac(config_data, cpath)
-    print("\n\nFinished outer encoding, starting inner encoder...\n")
-    # Start inner encoder
-    encode_ac(cpath, config_data)
-    file_ext = "" if config_data["general"]["as_fasta"] else ".zip"
+    if args.batch:
+        summary = encode_batch(cpath, config_data, batch_inputs(args.batch), args.output_dir, args.workers)
+        print("Encoded {} of {} files in {:.1f}s, the summary can be found at {}".format(
+            summary["encoded"], len(summary["files"]), summary["seconds"],
+            pathlib.Path(args.output_dir, "summary.json").resolve()))
+        sys.exit(0 if summary["failed"] == 0 else 1)
+    if args.stream:
+        print("Starting streaming encoder...\n")
+        encode_stream(config_data, cpath)
+    else:
+        # Start outer encoder
+        encode_norec_for_ac(config_data, cpath)
+        print("\n\nFinished outer encoding, starting inner encoder...\n")
+        # Start inner encoder
+        encode_ac(cpath, config_data)
+    file_ext = "" if config_data["general"]["as_fasta"] or is_packed(config_data["encode"]["output"]) else ".zip"
     output_path = pathlib.Path(config_data["encode"]["output"] + file_ext).resolve()
     print("Finished encoding! data can be found at {output_path}".format(output_path=output_path))
     print("The NOREC4DNA encoder config file can be found at {norec_conf}".format(norec_conf=pathlib.Path(config_data["decode"]["NOREC4DNA_config"]).resolve()))
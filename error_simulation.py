@@ -1,6 +1,7 @@
 import math
 import os
 import sys
+import pathlib
 import pandas as pd
 from numpy import count_nonzero
 import numpy as np
@@ -12,7 +13,12 @@ from datetime import datetime
 from contextlib import closing
 from zipfile import ZipFile
 import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import warnings
+import decode
+import seqpack
+from inner_coder import get_inner_coder
 warnings.filterwarnings("ignore")
 
 NOREC4DNA_BASE_PATH = "/home/wintermute/projects/dna_aeon_review_clean/DNA-Aeon/NOREC4DNA"
@@ -20,6 +26,7 @@ DNA_AEON_PATH = "/home/wintermute/projects/dna_aeon_review_clean/DNA-Aeon"
 INPUT_DATA = "/home/wintermute/projects/dna_aeon_review_clean/DNA-Aeon/data/D"
 FILENAME = "D"
 CONFIG = "/home/wintermute/projects/dna_aeon_review_clean/DNA-Aeon/config.json"
+# FASTA or packed sequence file (.dnapack, see seqpack.py)
 ENCODED_FILE = "/home/wintermute/projects/dna_aeon_review_clean/DNA-Aeon/data/encoded.fasta"
 
 
@@ -34,23 +41,98 @@ def modify_seq(original, pos_sub, pos_ins, pos_del):
     return modified  # , len(pos_sub), len(pos_ins), len(pos_del)
 
 
-def modify_seqs(seqs, results, num_subs, num_dels, num_ins):
-    enc_data_len = sum([len(seq) for seq in seqs])
-    one_seq_len = len(seqs[0])  # assuming all seqs have the same length
-    all_pos_subs = np.random.choice(enc_data_len, num_subs, replace=False)
-    all_pos_ins = np.random.choice(enc_data_len, num_ins, replace=False)
-    all_pos_dels = np.random.choice(enc_data_len, num_dels, replace=False)
-    mult = 1
-    modified_seqs = []
-    for seq in seqs:
-        curr_low = one_seq_len * (mult - 1)
-        curr_high = one_seq_len * mult
-        pos_sub = [num % one_seq_len for num in all_pos_subs if (curr_high >= num > curr_low)]
-        pos_ins = [num % one_seq_len for num in all_pos_ins if (curr_high >= num > curr_low)]
-        pos_del = [num % one_seq_len for num in all_pos_dels if (curr_high >= num > curr_low)]
-        modified_seqs.append(modify_seq(seq, pos_sub, pos_ins, pos_del))
-        mult += 1
-    return modified_seqs
+BASES = np.frombuffer(b"ACGT", dtype=np.uint8)
+BASE_CODES = np.zeros(256, dtype=np.uint8)
+BASE_CODES[BASES] = np.arange(4, dtype=np.uint8)
+
+
+def pack_seqs(seqs):
+    """
+    pack a list of sequences into one flat uint8 buffer and the offsets of the sequences in it
+    :param seqs:
+    :return: (buffer, offsets), sequence i is buffer[offsets[i]:offsets[i + 1]]
+    """
+    buf = np.frombuffer("".join(seqs).encode("ascii"), dtype=np.uint8).copy()
+    offsets = np.zeros(len(seqs) + 1, dtype=np.int64)
+    np.cumsum([len(seq) for seq in seqs], out=offsets[1:])
+    return buf, offsets
+
+
+def unpack_seqs(buf, offsets):
+    """
+    inverse of pack_seqs
+    :param buf:
+    :param offsets:
+    :return: list of sequences
+    """
+    data = buf.tobytes().decode("ascii")
+    return [data[offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1)]
+
+
+def mutate_packed(buf, offsets, pos_sub, pos_ins, pos_del, rng, return_source=False):
+    """
+    apply substitutions, insertions and deletions to a packed sequence buffer in one vectorized pass.
+    all positions are absolute positions in the unmodified buffer, an insertion is placed in front of the
+    base at its position and belongs to the same sequence as that base.
+    :param buf: flat uint8 buffer of bases, see pack_seqs
+    :param offsets: sequence offsets into buf
+    :param pos_sub: positions to substitute with a different random base
+    :param pos_ins: positions to insert a random base in front of
+    :param pos_del: positions to delete
+    :param rng: np.random.Generator
+    :param return_source: additionally return the position in the unmodified buffer of every base (-1 if inserted)
+    :return: (buffer, offsets) of the mutated sequences
+    """
+    buf = buf.copy()
+    if len(pos_sub):
+        shift = rng.integers(1, 4, size=len(pos_sub), dtype=np.uint8)
+        buf[pos_sub] = BASES[(BASE_CODES[buf[pos_sub]] + shift) % 4]
+    keep = np.ones(len(buf), dtype=bool)
+    keep[pos_del] = False
+    source = np.arange(len(buf), dtype=np.int64) if return_source else None
+    pos_ins = np.sort(pos_ins)
+    if len(pos_ins):
+        ins_bases = BASES[rng.integers(0, 4, size=len(pos_ins))]
+        buf = np.insert(buf, pos_ins, ins_bases)
+        keep = np.insert(keep, pos_ins, True)
+        if return_source:
+            source = np.insert(source, pos_ins, -1)
+    buf = buf[keep]
+    # bucket the errors per sequence: +1 for every insertion, -1 for every deletion
+    n_seqs = len(offsets) - 1
+    ins_per_seq = np.bincount(np.searchsorted(offsets, pos_ins, side="right") - 1, minlength=n_seqs)
+    del_per_seq = np.bincount(np.searchsorted(offsets, pos_del, side="right") - 1, minlength=n_seqs)
+    new_offsets = np.zeros_like(offsets)
+    np.cumsum(np.diff(offsets) + ins_per_seq[:n_seqs] - del_per_seq[:n_seqs], out=new_offsets[1:])
+    if return_source:
+        return buf, new_offsets, source[keep]
+    return buf, new_offsets
+
+
+def modify_seqs(seqs, results, num_subs, num_dels, num_ins, rng=None, as_buffer=False):
+    """
+    mutate the sequences by placing exactly num_subs substitutions, num_dels deletions and num_ins insertions
+    uniformly over all bases (positions are distinct per error type).
+    :param seqs: list of sequences or seqpack.PackedSequences
+    :param results: result dict of the current run
+    :param num_subs:
+    :param num_dels:
+    :param num_ins:
+    :param rng: np.random.Generator, a fresh unseeded one is used if None
+    :param as_buffer: return the mutated sequences as (buffer, offsets), see pack_seqs
+    :return: list of mutated sequences
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+    buf, offsets = seqs.to_buffer() if isinstance(seqs, seqpack.PackedSequences) else pack_seqs(seqs)
+    enc_data_len = len(buf)
+    all_pos_subs = rng.choice(enc_data_len, num_subs, replace=False)
+    all_pos_ins = rng.choice(enc_data_len, num_ins, replace=False)
+    all_pos_dels = rng.choice(enc_data_len, num_dels, replace=False)
+    buf, offsets = mutate_packed(buf, offsets, all_pos_subs, all_pos_ins, all_pos_dels, rng)
+    if as_buffer:
+        return buf, offsets
+    return unpack_seqs(buf, offsets)
 
 
 def calculate_num_chunks(file, chunk_size):
@@ -85,24 +167,52 @@ def parse_fasta(filename):
     """
     global ac_seqlen
 
-    with open(filename, 'r') as f:
-        lines = f.readlines()
     sequences = []
-    seq = ''
-    for line in lines:
-        if line[0] == '>':
-            if seq != '':
-                sequences.append(seq)
-            seq = ''
-        else:
-            seq += line.strip()
-    sequences.append(seq)
+    seq = []
+    with open(filename, 'r') as f:
+        for line in f:
+            if line[0] == '>':
+                if seq:
+                    sequences.append("".join(seq))
+                seq = []
+            else:
+                seq.append(line.strip())
+    sequences.append("".join(seq))
     ac_seqlen = len(sequences[0])
     print("Seqlen: " + str(ac_seqlen))
     return sequences
 
 
-def encode_mutate_decode(file, encoder_function, decoder_function, code_name, num_errors, repeat=1, pre_encoded=False):
+def error_counts(encoded_seq, num_errors, code_name, file):
+    """
+    calculate the absolute number of errors to inject for the given error rates
+    :param encoded_seq: list of encoded sequences
+    :param num_errors: dict with the substitution, deletion and insertion rates
+    :param code_name:
+    :param file: the original (unencoded) file
+    :return: result dict of the run
+    """
+    res = dict()
+    res["encoded_bases"] = len(encoded_seq[0].strip()) * len(
+        encoded_seq)
+    res["encoded_bytes"] = (res["encoded_bases"] * 2 / 8)
+    print("Encoded bases: " + str(res["encoded_bases"]))
+
+    res["num_subs"] = int(num_errors["substitutions"]*res["encoded_bases"])
+    res["num_dels"] = int(num_errors["deletions"]*res["encoded_bases"])
+    res["num_ins"] = int(num_errors["insertions"]*res["encoded_bases"])
+    print("subs: " + str(res["num_subs"]) + " dels: " + str(res["num_dels"]) + " ins: " + str(res["num_ins"]))
+    res["num_errors"] = sum([res["num_subs"], res["num_dels"], res["num_ins"]])
+    res["code"] = code_name
+    res["information_bytes"] = os.path.getsize(file)
+
+    global base_err_ratio
+    base_err_ratio = res["num_errors"]/res["encoded_bases"]
+    return res
+
+
+def encode_mutate_decode(file, encoder_function, decoder_function, code_name, num_errors, repeat=1, pre_encoded=False,
+                         seed=None):
     """
     encode a file using a given algorithm, apply mess_data and try to decode it
     results will be stored in a csv/yaml file
@@ -113,8 +223,10 @@ def encode_mutate_decode(file, encoder_function, decoder_function, code_name, nu
     :param decoder_function: function that take the list of sequences as input and returns information about the success of the decoding
     :param num_errors:
     :param repeat:
+    :param seed: seed for the error placement, makes a sweep reproducible
     :return:
     """
+    rng = np.random.default_rng(seed)
     results = []
     # open a file and read to variable
     with open(file, 'rb') as f:
@@ -126,31 +238,12 @@ def encode_mutate_decode(file, encoder_function, decoder_function, code_name, nu
         if not pre_encoded:
             encoded_seq = encoder_function(file)
         
-        encoded_seq = parse_fasta(ENCODED_FILE)
+        encoded_seq = load_encoded(ENCODED_FILE)
 
-        res = dict()
-        res["encoded_bases"] = len(encoded_seq[0].strip()) * len(
-            encoded_seq)
-        res["encoded_bytes"] = (res["encoded_bases"] * 2 / 8)
-        print("Encoded bases: " + str(res["encoded_bases"]))
-        
-        res["num_subs"] = int(num_errors["substitutions"]*res["encoded_bases"])
-        res["num_dels"] = int(num_errors["deletions"]*res["encoded_bases"])
-        res["num_ins"] = int(num_errors["insertions"]*res["encoded_bases"])
-        print("subs: " + str(res["num_subs"]) + " dels: " + str(res["num_dels"]) + " ins: " + str(res["num_ins"]))
-        res["num_errors"] = sum([res["num_subs"], res["num_dels"], res["num_ins"]])
-        res["code"] = code_name
-        res["information_bytes"] = os.path.getsize(file)
-
-        res["encoded_bases"] = len(encoded_seq[0].strip()) * len(
-            encoded_seq)
-        res["encoded_bytes"] = (res["encoded_bases"] * 2 / 8)
-        
-        global base_err_ratio
-        base_err_ratio = res["num_errors"]/res["encoded_bases"]
+        res = error_counts(encoded_seq, num_errors, code_name, file)
 
         mutated_seqs = modify_seqs(encoded_seq, res, res["num_subs"], res["num_dels"],
-                                   res["num_ins"])
+                                   res["num_ins"], rng)
         success = decoder_function(mutated_seqs, ground_truth)
         res["decoding_success"] = success
         print("Number of Errors: " + str(res["num_errors"]))
@@ -191,6 +284,16 @@ def deletions(original, pos):
     return modified
 
 
+def load_encoded(filename):
+    """
+    :param filename: FASTA or packed sequence file (see seqpack.py)
+    :return: list of sequences, packed sequences are memory mapped instead of read
+    """
+    if seqpack.is_packed(filename):
+        return seqpack.PackedSequences(filename)
+    return parse_fasta(filename)
+
+
 def encode_dna_aeon(file):
     py_command = ("python3 " + DNA_AEON_PATH + "/encode.py -c " + CONFIG)
     
@@ -199,44 +302,177 @@ def encode_dna_aeon(file):
     return
 
 
-def decode_dna_aeon(sequences, validation_data):
-    
-    # write sequences to fasta:
+def setup_trial(trial_dir, config_data, packed=False):
+    """
+    prepare an isolated scratch directory for a single decoding trial, with its own copy of the config
+    and of the NOREC4DNA ini (which is rewritten by decode.py).
+    :param trial_dir:
+    :param config_data: the (already encoded) config as dict
+    :param packed: the mutated sequences are passed to the decoder as packed sequences instead of FASTA
+    :return: path of the config copy
+    """
+    pathlib.Path(trial_dir, "data", "results").mkdir(parents=True, exist_ok=True)
+    ini_path = pathlib.Path(DNA_AEON_PATH, config_data["decode"]["NOREC4DNA_config"])
+    trial_ini = pathlib.Path(trial_dir, ini_path.name)
+    shutil.copy(ini_path, trial_ini)
+    trial_config = deepcopy(config_data)
+    trial_config["decode"]["input"] = trial_dir + ("/data/mut_encoded.dnapack" if packed else "/data/mut_encoded.fasta")
+    trial_config["decode"]["output"] = trial_dir + "/decoded.txt"
+    trial_config["decode"]["NOREC4DNA_config"] = str(trial_ini)
+    trial_config["decode"]["telemetry"] = trial_dir + "/telemetry.jsonl"
+    # the decoder runs inside the trial directory, so relative codebook paths have to be resolved
+    for key in ("words", "motifs"):
+        trial_config["general"]["codebook"][key] = str(pathlib.Path(DNA_AEON_PATH,
+                                                                    config_data["general"]["codebook"][key]))
+    config_path = trial_dir + "/config.json"
+    with open(config_path, "w") as o_:
+        json.dump(trial_config, o_)
+    return config_path
+
+
+def run_trial(trial):
+    """
+    run one mutate-decode trial in its own scratch directory, used as process pool worker.
+    the encoded FASTA is only read, so all trials can share it. packed encoded sequences are memory mapped and the
+    mutated sequences are passed to the decoder packed, without converting them to strings.
+    :param trial: dict with the keys file, encoded_file, config, num_errors, code_name, seed, scratch, index and use_server
+    :return: result dict of the trial
+    """
+    with open(trial["file"], 'rb') as f:
+        ground_truth = f.read()
+    packed = seqpack.is_packed(trial["encoded_file"])
+    encoded_seq = load_encoded(trial["encoded_file"])
+    res = error_counts(encoded_seq, trial["num_errors"], trial["code_name"], trial["file"])
+    res["trial"] = trial["index"]
+    rng = np.random.default_rng(trial["seed"])
+    mutated_seqs = modify_seqs(encoded_seq, res, res["num_subs"], res["num_dels"],
+                               res["num_ins"], rng, as_buffer=packed)
+    trial_dir = tempfile.mkdtemp(prefix="trial_{}_".format(trial["index"]), dir=trial["scratch"])
+    try:
+        config_path = setup_trial(trial_dir, trial["config"], packed)
+        # one inner decoder server per worker process, reused by all trials of the worker
+        inner_coder = get_inner_coder(DNA_AEON_PATH, config_path) if trial["use_server"] else None
+        res["decoding_success"] = decode_dna_aeon(mutated_seqs, ground_truth, trial_dir, config_path,
+                                                  tag="trial_{}_".format(trial["index"]), inner_coder=inner_coder)
+        # decode cost of the trial, so that it can be related to the number of injected errors
+        telemetry_path = trial_dir + "/telemetry.jsonl"
+        if os.path.exists(telemetry_path):
+            summary = decode.summarize_telemetry(decode.read_telemetry(telemetry_path))
+            res.update({"decode_" + key: value for key, value in summary.items()})
+    finally:
+        shutil.rmtree(trial_dir, ignore_errors=True)
+    print("Trial {}: number of errors: {}, decoding success: {}".format(trial["index"], res["num_errors"],
+                                                                         res["decoding_success"]))
+    return res
+
+
+def encode_mutate_decode_parallel(file, code_name, num_errors, repeat=1, pre_encoded=False, seed=None, workers=None,
+                                  threads_per_trial=1, scratch=None, out_csv=None, use_server=False):
+    """
+    parallel version of encode_mutate_decode: the file is encoded once, every trial then mutates and decodes the
+    shared encoded FASTA in its own scratch directory on a process pool.
+    results are added to the DataFrame (and optionally written to out_csv) as soon as a trial finishes.
+    :param file:
+    :param code_name: name of the evaluated code
+    :param num_errors: dict with the substitution, deletion and insertion rates
+    :param repeat: number of trials
+    :param pre_encoded: skip the encoding and use ENCODED_FILE as is
+    :param seed: seed for the error placement, every trial gets an independent child seed
+    :param workers: number of concurrent trials, defaults to the cpu count divided by threads_per_trial
+    :param threads_per_trial: number of inner decoder threads used by each trial (general.threads)
+    :param scratch: base directory for the trial directories, defaults to the systems temp dir
+    :param out_csv: optional csv file that is updated after every finished trial
+    :param use_server: decode in the worker processes using a persistent inner decoder instead of starting decode.py
+    :return: pandas DataFrame with one row per trial, the decode_* columns summarize the inner decoder telemetry
+    """
+    if not pre_encoded:
+        encode_dna_aeon(file)
+    with open(CONFIG, "r") as conf_inp:
+        config_data = json.load(conf_inp)
+    config_data["general"]["threads"] = threads_per_trial
+    if workers is None:
+        workers = max(1, (os.cpu_count() or 1) // threads_per_trial)
+    seeds = np.random.SeedSequence(seed).spawn(repeat)
+    trials = [{"file": file, "encoded_file": ENCODED_FILE, "config": config_data, "num_errors": num_errors,
+               "code_name": code_name, "seed": seeds[i], "scratch": scratch, "index": i, "use_server": use_server}
+              for i in range(repeat)]
+    results = pd.DataFrame()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(run_trial, trial) for trial in trials]
+        for future in as_completed(futures):
+            results = pd.concat([results, pd.DataFrame([future.result()])], ignore_index=True)
+            print("{}/{} trials finished, {}".format(len(results), repeat, datetime.now()))
+            if out_csv:
+                results.to_csv(out_csv)
+    return results.sort_values("trial", ignore_index=True)
+
+
+def decode_dna_aeon(sequences, validation_data, workdir=DNA_AEON_PATH, config=CONFIG, tag="", inner_coder=None):
+    """
+    decode the (mutated) sequences and compare the result with the validation data
+    :param sequences: list of sequences, or (buffer, offsets) (see pack_seqs) to pass them as packed sequences
+    :param validation_data:
+    :param workdir: directory the decoder runs in, the config has to read its input from workdir/data/mut_encoded.fasta
+                    (workdir/data/mut_encoded.dnapack for packed sequences)
+    :param config: config file used for decoding
+    :param tag: prefix for the files copied to data/failed
+    :param inner_coder: optional InnerCoder, if given the decoding runs in this process instead of calling decode.py
+    :return: True if the file was decoded without errors
+    """
+    decoded_zip = workdir + "/decoded.txt.zip"
+    result_file = workdir + "/data/results/" + FILENAME
+    failed_dir = DNA_AEON_PATH + "/data/failed/"
+
+    # write sequences to fasta (or packed sequences):
     c = 0
-    with open(DNA_AEON_PATH + "/data/mut_encoded.fasta", 'w') as f:
-        for sequence in sequences:
-            f.write(">" + str(c) + "\n")
-            f.write(sequence + "\n")
+    if isinstance(sequences, tuple):
+        with seqpack.PackedWriter(workdir + "/data/mut_encoded.dnapack") as f:
+            f.write_buffer(*sequences)
+    else:
+        with open(workdir + "/data/mut_encoded.fasta", 'w') as f:
+            for sequence in sequences:
+                f.write(">" + str(c) + "\n")
+                f.write(sequence + "\n")
 
     
-    if os.path.exists(DNA_AEON_PATH + "/decoded.txt.zip"):
-        os.remove(DNA_AEON_PATH + "/decoded.txt.zip")
+    if os.path.exists(decoded_zip):
+        os.remove(decoded_zip)
 
-    if os.path.exists(DNA_AEON_PATH + "/data/results/" + FILENAME):
-        os.remove(DNA_AEON_PATH + "/data/results/" + FILENAME)
+    if os.path.exists(result_file):
+        os.remove(result_file)
 
 
-    filename = INPUT_DATA.split("/")[-1]
-    py_command = ("python3 " + DNA_AEON_PATH + "/decode.py -c " + CONFIG)
-    process = subprocess.Popen(py_command.split(), stdout=subprocess.PIPE)
-    output, error = process.communicate()
+    if inner_coder is not None:
+        with open(config, "r") as conf_inp:
+            config_data = json.load(conf_inp)
+        cwd = os.getcwd()
+        os.chdir(workdir)
+        try:
+            decode.decode_ac(DNA_AEON_PATH, config, inner_coder, progress=None)
+            decode.decode_norec_for_ac(DNA_AEON_PATH, config_data)
+        finally:
+            os.chdir(cwd)
+    else:
+        py_command = ("python3 " + DNA_AEON_PATH + "/decode.py -c " + config)
+        process = subprocess.Popen(py_command.split(), stdout=subprocess.PIPE, cwd=workdir)
+        output, error = process.communicate()
     
-    if os.path.exists(DNA_AEON_PATH + "/decoded.txt.zip"):
-        with closing(ZipFile(DNA_AEON_PATH + "/decoded.txt.zip")) as archive:
+    if os.path.exists(decoded_zip):
+        with closing(ZipFile(decoded_zip)) as archive:
             count = len(archive.infolist())
             print("Number of files in zip: " + str(count))
 
     # validate
-    if not os.path.exists(DNA_AEON_PATH + "/data/results/" + FILENAME):
+    if not os.path.exists(result_file):
         try:
-            shutil.copy(DNA_AEON_PATH + "/decoded.txt.zip", DNA_AEON_PATH + "/data/failed/")
+            shutil.copy(decoded_zip, failed_dir + tag + "decoded.txt.zip")
         except:
             print("failed copy.")
         return False
     
     try:
-        messcheck = np.fromfile(DNA_AEON_PATH + "/data/results/" + FILENAME, dtype=np.uint8)
-        validation_data = np.fromstring(validation_data, dtype=np.uint8)
+        messcheck = np.fromfile(result_file, dtype=np.uint8)
+        validation_data = np.frombuffer(validation_data, dtype=np.uint8)
         validation_data = np.append(validation_data, [0] * (len(messcheck) - len(validation_data)), axis=0)
         badbytes = count_nonzero(validation_data - messcheck)
         print(badbytes)
@@ -244,11 +480,11 @@ def decode_dna_aeon(sequences, validation_data):
         badbytes = 1
     if badbytes:
         try:
-            shutil.copy(DNA_AEON_PATH + "/data/results/" + FILENAME, DNA_AEON_PATH + "/data/failed/")
+            shutil.copy(result_file, failed_dir + tag + FILENAME)
         except:
             pass
         try:
-            shutil.copy(DNA_AEON_PATH + "/decoded.txt.zip", DNA_AEON_PATH + "/data/failed/")
+            shutil.copy(decoded_zip, failed_dir + tag + "decoded.txt.zip")
         except:
             pass
     return badbytes == 0
@@ -262,8 +498,6 @@ if __name__ == '__main__':
         filename = INPUT_DATA.split("/")[-1] 
         if os.path.exists(DNA_AEON_PATH + "/data/results/" + FILENAME):
             os.remove(DNA_AEON_PATH + "/data/results/" + FILENAME)
-        res_list = encode_mutate_decode(INPUT_DATA, encode_dna_aeon,
-                                        decode_dna_aeon, code_name, num_errors, repeat=100,
-                                        pre_encoded=False)
-        results = pd.DataFrame(res_list)
-        results.to_csv(code_name + "_s" + str(res_list[0]["num_subs"]) + "_i" + str(res_list[0]["num_ins"]) + "_d" + str(res_list[0]["num_dels"]) + ".csv")
+        results = encode_mutate_decode_parallel(INPUT_DATA, code_name, num_errors, repeat=100, pre_encoded=False,
+                                                threads_per_trial=2, use_server=True)
+        results.to_csv(code_name + "_s" + str(results["num_subs"][0]) + "_i" + str(results["num_ins"][0]) + "_d" + str(results["num_dels"][0]) + ".csv")
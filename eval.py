@@ -1,69 +1,331 @@
-import numpy as np
-import subprocess
-import random
-from copy import deepcopy
+"""
+benchmark suite for the complete encode.py / decode.py pipeline.
+
+run: every cell of the matrix input file x codebook x general.threads x error rate is encoded, mutated and decoded
+     (repeat times), the encode / decode throughput, the time of the outer (NOREC4DNA) and the inner (DNA-Aeon) stage,
+     the peak RSS and the decoding success rate are written to a JSON file.
+compare: compare two result files and report all cells that got slower, use more memory or decode less often.
+
+$ python3 eval.py run -c config.json --inputs data/D data/Dorn random:100000 --threads 1 4 --error_rates 0 0.01 -o new.json
+$ python3 eval.py compare old.json new.json --tolerance 0.1
+
+The pipeline writes its intermediate files into the DNA-Aeon folder, so the cells are run one after another.
+"""
+import argparse
+import json
 import os
+import pathlib
+import platform
 import shutil
-import filecmp
-import yaml
-from time import time
-import json
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+import numpy as np
+import error_simulation
+import read_clustering
 
+# ratio of substitutions, deletions and insertions, as used by error_simulation.py
+ERROR_PROFILE = {"substitutions": 0.0238, "deletions": 0.0082, "insertions": 0.0039}
 
-def run_eval(ac_path, norec_path, ini_name, out_path, orig_path, out_zip_name, length, norec_out_path, conf_file_path):
-    subprocess.call([ac_path, '-d', conf_file_path])
-    shutil.copy(out_zip_name, norec_path + '/' + out_zip_name)
-    try:
-        subprocess.call([norec_path + '/venv/bin/python', norec_path + '/ConfigWorker.py', norec_path + "/" + ini_name])
-        return filecmp.cmp(orig_path, norec_out_path)
-    except:
+# every stage is run in a fresh interpreter, so that its peak RSS is not inflated by the benchmark process
+STAGE_SCRIPT = """import json, pathlib, sys
+import encode, decode
+cpath = pathlib.Path(sys.argv[1])
+config_path = sys.argv[2]
+with open(config_path, "r") as conf_inp:
+    config = json.load(conf_inp)
+{call}
+"""
+STAGES = {
+    "encode_outer": "encode.encode_norec_for_ac(config, cpath)",
+    "encode_inner": "encode.encode_ac(cpath, config)",
+    "decode_inner": "decode.decode_ac(cpath, config_path)",
+    "decode_outer": "decode.decode_norec_for_ac(cpath, config)",
+}
+
+# metric: True if higher is better
+COMPARED_METRICS = {
+    "encode_bases_per_s": True,
+    "encode_bytes_per_s": True,
+    "encode_peak_rss_mib": False,
+    "decode_bases_per_s": True,
+    "decode_bytes_per_s": True,
+    "decode_peak_rss_mib": False,
+    "decode_success_rate": True,
+}
+CELL_KEY = ("input", "codebook", "threads", "error_rate")
+
+
+def run_stage(stage, current_path, config_path, cwd):
+    """
+    run one stage of the pipeline in a new process.
+    :param stage: key of STAGES
+    :param current_path: path of the DNA-Aeon folder
+    :param config_path: config of the stage
+    :param cwd: working directory of the stage
+    :return: (seconds, peak RSS in MiB of the stage and all processes it started, exit code)
+    """
+    env = dict(os.environ, PYTHONPATH=str(current_path))
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, "-c", STAGE_SCRIPT.format(call=STAGES[stage]), str(current_path),
+                                str(config_path)], cwd=cwd, env=env, stdout=subprocess.DEVNULL)
+    # wait4 instead of wait: the resource usage includes all (waited for) descendants of the stage
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    seconds = time.perf_counter() - start
+    # ru_maxrss is given in KiB on linux
+    return seconds, usage.ru_maxrss / 1024, process.returncode
+
+
+def prepare_input(current_path, spec, seed):
+    """
+    :param current_path:
+    :param spec: path of an input file or random:<bytes> for a generated file
+    :param seed:
+    :return: (name, path relative to current_path, True if the file was generated)
+    """
+    if spec.startswith("random:"):
+        size = int(spec.split(":")[1])
+        name = "bench_random_{}".format(size)
+        # the outer encoder writes its zip next to the input, the inner encoder expects it in data/
+        path = pathlib.Path("data", name)
+        pathlib.Path(current_path, path).write_bytes(np.random.default_rng(seed).bytes(size))
+        return name, path, True
+    path = pathlib.Path(spec)
+    if path.is_absolute():
+        path = path.relative_to(current_path)
+    return path.name, path, False
+
+
+def codebook_entry(spec, config_data):
+    """
+    :param spec: words:motifs or None for the codebook of the config
+    :param config_data:
+    :return: (name, codebook config entry)
+    """
+    if spec is None:
+        codebook = dict(config_data["general"]["codebook"])
+    else:
+        words, motifs = spec.split(":")
+        codebook = {"words": words, "motifs": motifs}
+    return pathlib.Path(codebook["words"]).stem, codebook
+
+
+def error_counts(num_bases, error_rate):
+    """
+    split the total error rate according to ERROR_PROFILE
+    :return: (number of substitutions, deletions, insertions)
+    """
+    total = sum(ERROR_PROFILE.values())
+    return tuple(int(error_rate * ERROR_PROFILE[key] / total * num_bases)
+                 for key in ("substitutions", "deletions", "insertions"))
+
+
+def is_decoded(results_dir, original):
+    """
+    :param results_dir: output directory of the outer decoder
+    :param original: content of the encoded file
+    :return: True if a file in results_dir equals original (up to trailing zero padding)
+    """
+    if not results_dir.exists():
         return False
+    for path in results_dir.iterdir():
+        data = path.read_bytes()
+        if data[:len(original)] == original and not any(data[len(original):]):
+            return True
+    return False
+
+
+def write_config(path, config_data):
+    with open(path, "w") as o_:
+        json.dump(config_data, o_)
+    return path
+
+
+def run_cell(current_path, config_data, input_spec, codebook_spec, threads, error_rates, repeat, rng, scratch):
+    """
+    encode one input once and decode it repeat times for every error rate.
+    :return: list of result dicts, one per error rate
+    """
+    name, input_path, generated = prepare_input(current_path, input_spec, int(rng.integers(2 ** 32)))
+    codebook_name, codebook = codebook_entry(codebook_spec, config_data)
+    cell_dir = pathlib.Path(tempfile.mkdtemp(prefix="bench_{}_".format(name), dir=scratch))
+    ini_path = pathlib.Path("data", "bench_{}.ini".format(name))
+    try:
+        config = json.loads(json.dumps(config_data))
+        config["general"]["threads"] = threads
+        config["general"]["as_fasta"] = True
+        config["general"]["codebook"] = {key: str(pathlib.Path(current_path, value))
+                                         for key, value in codebook.items()}
+        config["encode"]["input"] = str(input_path)
+        config["encode"]["output"] = str(cell_dir / "encoded.fasta")
+        config["decode"]["NOREC4DNA_config"] = str(ini_path)
+        config_path = write_config(cell_dir / "encode_config.json", config)
+        original = pathlib.Path(current_path, input_path).read_bytes()
+
+        encode_res = {}
+        for stage in ("encode_outer", "encode_inner"):
+            encode_res[stage] = run_stage(stage, current_path, config_path, current_path)
+            if encode_res[stage][2] != 0:
+                raise RuntimeError("Stage {} failed for {}.".format(stage, name))
+        reads = read_clustering.read_fasta(config["encode"]["output"])
+        num_bases = sum(len(read) for read in reads)
+        encode_seconds = sum(stage[0] for stage in encode_res.values())
+        base = {"input": name, "input_bytes": len(original), "codebook": codebook_name, "threads": threads,
+                "reads": len(reads), "encoded_bases": num_bases, "repeat": repeat,
+                "encode_seconds": encode_seconds,
+                "encode_outer_seconds": encode_res["encode_outer"][0],
+                "encode_inner_seconds": encode_res["encode_inner"][0],
+                "encode_bases_per_s": num_bases / encode_seconds,
+                "encode_bytes_per_s": len(original) / encode_seconds,
+                "encode_peak_rss_mib": max(stage[1] for stage in encode_res.values())}
+        print("{} / {} / {} threads: encoded {} bytes into {} bases in {:.2f}s.".format(
+            name, codebook_name, threads, len(original), num_bases, encode_seconds))
+
+        results = []
+        for error_rate in error_rates:
+            runs = []
+            for r in range(repeat):
+                run_dir = cell_dir / "run_{}_{}".format(error_rate, r)
+                (run_dir / "data" / "results").mkdir(parents=True)
+                num_subs, num_dels, num_ins = error_counts(num_bases, error_rate)
+                # seeded by repetition and error rate, so that cells that only differ in the threads see the same errors
+                mutated = error_simulation.modify_seqs(reads, {}, num_subs, num_dels, num_ins,
+                                                       np.random.default_rng([r, int(error_rate * 1e6)]))
+                read_clustering.write_fasta(run_dir / "mut_encoded.fasta", mutated)
+                shutil.copy(pathlib.Path(current_path, ini_path), run_dir / ini_path.name)
+                run_config = json.loads(json.dumps(config))
+                run_config["decode"]["input"] = str(run_dir / "mut_encoded.fasta")
+                run_config["decode"]["output"] = str(run_dir / "decoded.txt")
+                run_config["decode"]["NOREC4DNA_config"] = str(run_dir / ini_path.name)
+                run_config_path = write_config(run_dir / "config.json", run_config)
+                stages = {stage: run_stage(stage, current_path, run_config_path, run_dir)
+                          for stage in ("decode_inner", "decode_outer")}
+                runs.append((stages, sum(len(read) for read in mutated),
+                             is_decoded(run_dir / "data" / "results", original)))
+                shutil.rmtree(run_dir, ignore_errors=True)
+            decode_seconds = np.mean([sum(stage[0] for stage in stages.values()) for stages, _, _ in runs])
+            res = dict(base, error_rate=error_rate,
+                       decode_seconds=decode_seconds,
+                       decode_outer_seconds=np.mean([stages["decode_outer"][0] for stages, _, _ in runs]),
+                       decode_inner_seconds=np.mean([stages["decode_inner"][0] for stages, _, _ in runs]),
+                       decode_bases_per_s=np.mean([bases for _, bases, _ in runs]) / decode_seconds,
+                       decode_bytes_per_s=len(original) / decode_seconds,
+                       decode_peak_rss_mib=max(stage[1] for stages, _, _ in runs for stage in stages.values()),
+                       decode_success_rate=np.mean([decoded for _, _, decoded in runs]))
+            results.append({key: value.item() if isinstance(value, np.generic) else value
+                             for key, value in res.items()})
+            print("{} / {} / {} threads / error rate {}: decoded {:.0%} in {:.2f}s on average.".format(
+                name, codebook_name, threads, error_rate, res["decode_success_rate"], decode_seconds))
+        return results
+    finally:
+        shutil.rmtree(cell_dir, ignore_errors=True)
+        pathlib.Path(current_path, ini_path).unlink(missing_ok=True)
+        if generated:
+            pathlib.Path(current_path, input_path).unlink(missing_ok=True)
+
+
+def git_revision(current_path):
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=current_path, capture_output=True,
+                              text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run_benchmark(current_path, config_data, inputs, codebooks, threads, error_rates, repeat=3, seed=0,
+                  scratch=None):
+    """
+    run all cells of the benchmark matrix.
+    :param current_path: path of the DNA-Aeon folder
+    :param config_data: base config, general.threads, general.codebook and the en-/decoding paths are replaced
+    :param inputs: list of input files (relative to current_path) or random:<bytes>
+    :param codebooks: list of words:motifs specs, [None] for the codebook of the config
+    :param threads: list of general.threads values
+    :param error_rates: list of total error rates per base
+    :param repeat: number of decodings per error rate
+    :param seed: seed of the generated inputs
+    :param scratch: directory for the temporary files of the cells
+    :return: dict with the benchmark environment (meta) and a list of results (cells)
+    """
+    rng = np.random.default_rng(seed)
+    meta = {"date": datetime.now().isoformat(), "revision": git_revision(current_path), "host": platform.node(),
+            "platform": platform.platform(), "cpus": os.cpu_count(), "python": platform.python_version(),
+            "inputs": inputs, "codebooks": codebooks, "threads": threads, "error_rates": error_rates,
+            "repeat": repeat, "seed": seed}
+    cells = []
+    for input_spec in inputs:
+        for codebook_spec in codebooks:
+            for num_threads in threads:
+                cells += run_cell(current_path, config_data, input_spec, codebook_spec, num_threads, error_rates,
+                                  repeat, rng, scratch)
+    return {"meta": meta, "cells": cells}
 
 
-def auto_test(out_path, ac_path, norec_path, ini_name, orig_path, out_zip_name, length, iterations, results, counter, conf_file_path):
-    for i in range(iterations):
-        results[str(counter)] = dict()
-        res = run_eval(ac_path, norec_path, ini_name, out_path, orig_path, out_zip_name, length, results, conf_file_path)
-        results[str(counter)]["decoded"] = res
-        counter += 1
-        print(counter)
+def compare(old, new, tolerance=0.1):
+    """
+    compare the cells of two benchmark results.
+    :param old: baseline result
+    :param new: result to check
+    :param tolerance: allowed relative change of every metric in the wrong direction
+    :return: list of (cell key, metric, old value, new value) of all regressions
+    """
+    old_cells = {tuple(cell[key] for key in CELL_KEY): cell for cell in old["cells"]}
+    regressions = []
+    for cell in new["cells"]:
+        key = tuple(cell[k] for k in CELL_KEY)
+        if key not in old_cells:
+            continue
+        for metric, higher_is_better in COMPARED_METRICS.items():
+            old_value, new_value = old_cells[key][metric], cell[metric]
+            if higher_is_better:
+                regressed = new_value < old_value * (1 - tolerance)
+            else:
+                regressed = new_value > old_value * (1 + tolerance)
+            if regressed:
+                regressions.append((key, metric, old_value, new_value))
+    return regressions
 
-    return results
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the DNA-Aeon encode / decode pipeline.')
+    subparsers = parser.add_subparsers(dest="mode", required=True)
+    run = subparsers.add_parser("run", help="run the benchmark matrix.")
+    run.add_argument('--config', '-c', dest='conf', type=str, default="config.json",
+                     help='base config, the NOREC4DNA and decoder settings are used for all cells.')
+    run.add_argument('--inputs', nargs="+", default=["data/D", "data/Dorn", "random:100000"],
+                     help='input files (inside the DNA-Aeon folder) or random:<bytes> for generated files.')
+    run.add_argument('--codebooks', nargs="+", default=[None],
+                     help='codebooks as words:motifs (default: the codebook of the config).')
+    run.add_argument('--threads', nargs="+", type=int, default=[1, 4], help='values of general.threads.')
+    run.add_argument('--error_rates', nargs="+", type=float, default=[0.0, 0.01],
+                     help='total error rates per base, split into substitutions, deletions and insertions as in error_simulation.py.')
+    run.add_argument('--repeat', type=int, default=3, help='number of decodings per error rate.')
+    run.add_argument('--seed', type=int, default=0, help='seed of the generated inputs.')
+    run.add_argument('--scratch', type=str, default=None, help='directory for temporary files.')
+    run.add_argument('--output', '-o', type=str, default="bench_results.json", help='result file.')
+    cmp = subparsers.add_parser("compare", help="compare two result files.")
+    cmp.add_argument('old', type=str)
+    cmp.add_argument('new', type=str)
+    cmp.add_argument('--tolerance', type=float, default=0.1,
+                     help='allowed relative change of a metric before it is reported as a regression.')
+    args = parser.parse_args()
 
-    out_path = "/home/wintermute/projects/arithmetic_modulator_error_correction/data/dorn_encoded_mod.fasta"
-    ac_path = "/home/wintermute/projects/arithmetic_modulator_error_correction/cmake-build-release/arithmetic_modulator_error_correction"
-    norec_path = "/home/wintermute/projects/NOREC4DNA"
-    ini_name = "Dorn.ini"
-    orig_path = "/home/wintermute/projects/arithmetic_modulator_error_correction/data/Dorn"
-    norec_out_path = "/home/wintermute/projects/arithmetic_modulator_error_correction/Dorn"
-    out_zip_name = "dorn_decoded_auto.zip"
-    conf_file_path = "eval_config.json"
-    length = 172
-    iterations = 1
-    results = dict()
-    counter = 0
-    config = {
-        "general": {
-            "sync": 4,
-            "as_fasta": true
-        },
-        "decode": {
-            "input": out_path,
-            "output": out_zip_name,
-            "length": length
-    }
-    with open(conf_file_path, "w") as conf_file:
-        json.dump(config, conf_file)
-    if os.path.exists(norec_out_path):
-        os.remove(norec_out_path)
-    print("start")
-    start = time()
-    auto_test(out_path, ac_path, norec_path, ini_name, orig_path, out_zip_name, length, iterations, results, counter, conf_file_path)
-    end = time()
-    print(end - start)
-    #with open("test_split.yaml", "w") as o_:
-    #    mod_data = yaml.load(o_, Loader=yaml.CLoader)
-    #    re = z = mod_data | results
-    #    yaml.dump(re, o_)
+    cpath = pathlib.Path(__file__).parent.resolve()
+    if args.mode == "run":
+        with open(args.conf, "r") as conf_inp:
+            config_data = json.load(conf_inp)
+        result = run_benchmark(cpath, config_data, args.inputs, args.codebooks, args.threads, args.error_rates,
+                               args.repeat, args.seed, args.scratch)
+        with open(args.output, "w") as o_:
+            json.dump(result, o_, indent=2)
+        print("Results written to {}.".format(args.output))
+    else:
+        with open(args.old, "r") as old_inp, open(args.new, "r") as new_inp:
+            regressions = compare(json.load(old_inp), json.load(new_inp), args.tolerance)
+        for key, metric, old_value, new_value in regressions:
+            print("REGRESSION {}: {} {:.4g} -> {:.4g}".format(dict(zip(CELL_KEY, key)), metric, old_value, new_value))
+        print("{} regressions found.".format(len(regressions)))
+        sys.exit(1 if regressions else 0)
@@ -1,7 +1,22 @@
-from collections import defaultdict
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
 import json
 from subprocess import Popen, PIPE, STDOUT
 import argparse
+import math
+import os
+import shutil
+import struct
+import tempfile
+import zlib
+import numpy as np
+
+COMPILED_MAGIC = b"AEONCB01"
+COMPILED_BASES = "ACGT"
+# 2 bit code of each base for the native generator, the numeric order of the packed code words is the lexicographic
+# order of the code words
+PACKED_BASES = "ACGT"
+MAX_PACKED_LENGTH = 31
 
 
 def read_fasta(seq, file_name):
@@ -22,6 +37,303 @@ def string_splitting(seq):
             str_map['motif'][start].append(end)
     return str_map
 
+def pack_word(word):
+    value = 0
+    for base in word:
+        value = (value << 2) | PACKED_BASES.index(base)
+    return value
+
+
+def unpack_words(values, length):
+    """
+    :param values: np.uint64 array of packed code words
+    :param length: code word length
+    :return: list of code words
+    """
+    shifts = np.arange(2 * (length - 1), -1, -2, dtype=np.uint64)
+    codes = ((values[:, None] >> shifts[None, :]) & np.uint64(3)).astype(np.uint8)
+    data = np.frombuffer(PACKED_BASES.encode(), dtype=np.uint8)[codes].tobytes().decode("ascii")
+    return [data[i:i + length] for i in range(0, len(data), length)]
+
+
+def popcount(values):
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(values)
+    return np.unpackbits(values.view(np.uint8).reshape(-1, 8), axis=1).sum(axis=1)
+
+
+def motif_automaton(motifs):
+    """
+    aho-corasick automaton of the undesired motifs, as dense transition table over the bases.
+    :param motifs: list of motifs
+    :return: (transitions, accepting): next state for each state and base (PACKED_BASES order), and whether a
+             motif ends in the state
+    """
+    goto = [dict()]
+    accepting = [False]
+    for motif in motifs:
+        state = 0
+        for base in motif:
+            if base not in goto[state]:
+                goto.append(dict())
+                accepting.append(False)
+                goto[state][base] = len(goto) - 1
+            state = goto[state][base]
+        accepting[state] = True
+    transitions = np.zeros((len(goto), 4), dtype=np.int32)
+    fail = [0] * len(goto)
+    queue = deque()
+    for i, base in enumerate(PACKED_BASES):
+        if base in goto[0]:
+            transitions[0, i] = goto[0][base]
+            queue.append(goto[0][base])
+    while queue:
+        state = queue.popleft()
+        accepting[state] = accepting[state] or accepting[fail[state]]
+        for i, base in enumerate(PACKED_BASES):
+            if base in goto[state]:
+                nxt = goto[state][base]
+                fail[nxt] = transitions[fail[state], i]
+                transitions[state, i] = nxt
+                queue.append(nxt)
+            else:
+                transitions[state, i] = transitions[fail[state], i]
+    return transitions, np.array(accepting, dtype=bool)
+
+
+def _check_prefix(prefix, length, gc_count, hp, transitions, accepting):
+    """
+    :return: automaton state after the prefix, or None if no code word with this prefix can satisfy the constraints
+    """
+    gc = sum(base in "GC" for base in prefix)
+    if gc > gc_count[1] or gc + length - len(prefix) < gc_count[0]:
+        return None
+    if hp and any(prefix[i:i + hp] == prefix[i] * hp for i in range(len(prefix) - hp + 1)):
+        return None
+    state = 0
+    for base in prefix:
+        state = transitions[state, PACKED_BASES.index(base)]
+        if accepting[state]:
+            return None
+    return int(state)
+
+
+def _generate_range(task):
+    """
+    filter all code words with the given prefix and write the valid ones (packed, in order) to task["output"].
+    :return: number of valid code words
+    """
+    length, prefix_len, hp = task["length"], task["prefix_len"], task["hp"]
+    transitions, accepting = task["transitions"], task["accepting"]
+    gc_low, gc_high = task["gc_count"]
+    suffix_len = length - prefix_len
+    base_value = np.uint64(task["prefix"] << (2 * suffix_len))
+    # bit masks: the low bit of each base, and of each pair of neighbouring bases
+    base_mask = np.uint64(int("01" * length, 2))
+    pair_mask = np.uint64(int("01" * (length - 1), 2)) if length > 1 else np.uint64(0)
+    count = 0
+    with open(task["output"], "wb") as out:
+        for start in range(0, 4 ** suffix_len, task["block_size"]):
+            values = base_value + np.arange(start, min(start + task["block_size"], 4 ** suffix_len), dtype=np.uint64)
+            # C and G are the codes 01 and 10
+            gc = popcount((values ^ (values >> np.uint64(1))) & base_mask)
+            valid = (gc >= gc_low) & (gc <= gc_high)
+            if hp and hp <= length:
+                diff = values ^ (values >> np.uint64(2))
+                equal = ~(diff | (diff >> np.uint64(1))) & pair_mask
+                run = equal
+                for i in range(1, hp - 1):
+                    run = run & (equal >> np.uint64(2 * i))
+                if hp > 1:
+                    valid &= run == 0
+                else:
+                    valid[:] = False
+            if len(accepting) > 1:
+                state = np.full(len(values), task["state"], dtype=np.int32)
+                for pos in range(prefix_len, length):
+                    codes = ((values >> np.uint64(2 * (length - 1 - pos))) & np.uint64(3)).astype(np.intp)
+                    state = transitions[state, codes]
+                    valid &= ~accepting[state]
+            values = values[valid]
+            values.tofile(out)
+            count += len(values)
+    return count
+
+
+def generate_codewords(length, output, gc_low=0.0, gc_high=1.0, hp=None, motifs=(), workers=None,
+                       block_size=1 << 20):
+    """
+    native code book generator: all 4^length code words are enumerated bit-packed (2 bits per base) in prefix
+    ranges on a process pool, the code words with a GC content in [gc_low, gc_high], without homopolymers of length
+    hp or longer and without any of the undesired motifs (matched with an aho-corasick automaton) are written in
+    lexicographic order to the FASTA file output. only the valid code words are stored (on disk), the memory does not
+    depend on 4^length.
+    :param length: code word length (at most 31)
+    :param output: path of the code book (FASTA)
+    :param gc_low: minimal GC content of a code word
+    :param gc_high: maximal GC content of a code word
+    :param hp: homopolymer length that is not allowed (None: no limit)
+    :param motifs: undesired motifs
+    :param workers: number of worker processes (default: number of cpus)
+    :param block_size: number of code words checked at once by a worker
+    :return: number of code words
+    """
+    if not 0 < length <= MAX_PACKED_LENGTH:
+        raise ValueError("The native generator supports code word lengths from 1 to {}.".format(MAX_PACKED_LENGTH))
+    workers = workers or os.cpu_count()
+    transitions, accepting = motif_automaton([motif for motif in motifs if motif])
+    # small tolerance, so that e.g. 0.4 * 10 allows exactly 4 GC bases
+    gc_count = (math.ceil(gc_low * length - 1e-9), math.floor(gc_high * length + 1e-9))
+    # enough prefixes to balance the work, every prefix range is one task
+    prefix_len = min(length, max(1, math.ceil(math.log(16 * workers, 4))))
+    tmp = tempfile.mkdtemp(prefix="codebook_", dir=os.path.dirname(os.path.abspath(output)))
+    try:
+        tasks = []
+        for prefix_value in range(4 ** prefix_len):
+            prefix = unpack_words(np.array([prefix_value], dtype=np.uint64), prefix_len)[0]
+            state = _check_prefix(prefix, length, gc_count, hp, transitions, accepting)
+            if state is not None:
+                tasks.append({"prefix": prefix_value, "prefix_len": prefix_len, "length": length, "hp": hp,
+                              "gc_count": gc_count, "transitions": transitions, "accepting": accepting,
+                              "state": state, "block_size": block_size,
+                              "output": os.path.join(tmp, "{}.bin".format(prefix_value))})
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            counts = list(executor.map(_generate_range, tasks))
+        index = 0
+        with open(output, "w") as out:
+            for task, count in zip(tasks, counts):
+                with open(task["output"], "rb") as inp:
+                    while True:
+                        values = np.fromfile(inp, dtype=np.uint64, count=block_size)
+                        if not len(values):
+                            break
+                        out.write("".join(">{}\n{}\n".format(index + i, word)
+                                          for i, word in enumerate(unpack_words(values, length))))
+                        index += len(values)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    return index
+
+
+def read_codewords(file_name):
+    """
+    read the code words the same way as the inner coder (parseFasta in FastaParser.h) does.
+    :param file_name:
+    :return: set of code words
+    """
+    codewords = set()
+    seq_id, seq = None, ""
+    with open(file_name, "r") as file:
+        for line in file:
+            line = line.rstrip("\n")
+            if not line or line[0] == ";":
+                continue
+            if line[0] == ">":
+                if seq_id:
+                    codewords.add(seq)
+                seq_id, seq = line[1:], ""
+            else:
+                seq += line
+    if seq_id:
+        codewords.add(seq)
+    return codewords
+
+
+def freq_dict(codewords, cw_length):
+    """
+    number of code words starting with each prefix, see ProbMap::freqDict.
+    :param codewords:
+    :param cw_length:
+    :return:
+    """
+    fd = defaultdict(int)
+    for i in range(cw_length):
+        for ele in codewords:
+            fd[ele[0:i + 1]] += 1
+    # ProbMap::calcFirstBase adds missing first bases to the frequency dict
+    for base in COMPILED_BASES:
+        fd[base] += 0
+    return dict(fd)
+
+
+def transition_dict(fd, cw_length, normalized):
+    """
+    next base probabilities for each code word prefix, see ProbMap::createTransitionDict.
+    the values are calculated in the same order as in the inner coder, so that they are bit-identical.
+    :param fd: frequency dict, see freq_dict
+    :param cw_length:
+    :param normalized:
+    :return:
+    """
+    if normalized:
+        sum_first_base = float(sum(fd[base] for base in "ATGC"))
+        t_dict = {"": {base: fd[base] / sum_first_base for base in COMPILED_BASES}}
+    else:
+        t_dict = {"": {base: float(fd[base]) for base in COMPILED_BASES}}
+    for prefix, count in fd.items():
+        if len(prefix) < cw_length:
+            nxt = {base: fd.get(prefix + base, 0) for base in COMPILED_BASES}
+            if not normalized:
+                t_dict[prefix] = {base: float(nxt[base]) for base in COMPILED_BASES}
+            elif count:
+                t_dict[prefix] = {base: 1.0 * nxt[base] / float(count) for base in COMPILED_BASES}
+            else:
+                t_dict[prefix] = {base: 0.0 for base in COMPILED_BASES}
+    return t_dict
+
+
+def compiled_path(words_path):
+    return os.path.splitext(words_path)[0] + ".cbc"
+
+
+def source_hash(file_name):
+    with open(file_name, "rb") as file:
+        data = file.read()
+    return struct.pack("<IQ", zlib.crc32(data), len(data))
+
+
+def write_compiled_codebook(words_path, motifs_path):
+    """
+    write the compiled code book (frequency dict, both transition tables and the concatenation scheme) next to
+    the code book, so that the inner coder does not have to rebuild them on every start.
+    format (little endian): magic, CRC32 (uint32) and size (uint64) of the code book and of the concatenation
+    scheme, code word length (uint32), then the frequency dict, the un-normalized (encoding) and the normalized
+    (decoding) transition table and the concatenation scheme, each as uint32 entry count followed by the entries.
+    strings are stored as uint16 length + bytes, transition entries as prefix + 4 doubles (A, C, G, T).
+    :param words_path: code book (FASTA)
+    :param motifs_path: concatenation scheme (json)
+    :return: path of the compiled code book
+    """
+    codewords = read_codewords(words_path)
+    cw_length = len(next(iter(codewords)))
+    with open(motifs_path, "r") as file:
+        motifs = json.load(file)["motif"]
+    fd = freq_dict(codewords, cw_length)
+
+    def pack_str(string):
+        data = string.encode()
+        return struct.pack("<H", len(data)) + data
+
+    def pack_transitions(t_dict):
+        return struct.pack("<I", len(t_dict)) + b"".join(
+            pack_str(prefix) + struct.pack("<4d", *[probs[base] for base in COMPILED_BASES])
+            for prefix, probs in t_dict.items())
+
+    out_path = compiled_path(words_path)
+    tmp_path = out_path + ".tmp" + str(os.getpid())
+    with open(tmp_path, "wb") as out:
+        out.write(COMPILED_MAGIC + source_hash(words_path) + source_hash(motifs_path))
+        out.write(struct.pack("<II", cw_length, len(fd)))
+        out.write(b"".join(pack_str(prefix) + struct.pack("<i", count) for prefix, count in fd.items()))
+        out.write(pack_transitions(transition_dict(fd, cw_length, False)))
+        out.write(pack_transitions(transition_dict(fd, cw_length, True)))
+        out.write(struct.pack("<I", len(motifs)))
+        for key, suffixes in motifs.items():
+            out.write(pack_str(key) + struct.pack("<I", len(suffixes)) + b"".join(pack_str(s) for s in suffixes))
+    os.replace(tmp_path, out_path)
+    return out_path
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Generate a codebook and the concatenation scheme using ContrainedKaos.')
     parser.add_argument('--Path', '-p', dest='path', type=str, action='store',
@@ -39,7 +351,11 @@ if __name__ == "__main__":
     parser.add_argument('--Output', '-o', dest='outp', type=str, action='store',
                         help='Destination to save the codewords.', required=True)
     parser.add_argument('--Length', '-l', dest='cw_length', type=int, action='store',
-                        help='Length of the output code words, over 10 requires a large amount of memory.', required=True)
+                        help='Length of the output code words, over 10 requires a large amount of memory with ConstrainedKaos.', required=True)
+    parser.add_argument('--native', dest='native', action='store_true',
+                        help='use the built-in parallel generator instead of ConstrainedKaos (code word lengths up to 31).')
+    parser.add_argument('--workers', dest='workers', type=int, default=None,
+                        help='with --native, number of worker processes (default: number of cpus).')
     args = parser.parse_args()
 
     if args.gc and (args.gcl or args.gch):
@@ -60,6 +376,20 @@ if __name__ == "__main__":
     with open(args.outp[:-5] + 'json', "w") as outfile:
         json.dump(str_map, outfile)
 
+    if args.native:
+        if args.gc is not None:
+            # fixed GC content: the nearest number of GC bases a code word of this length can have
+            gc_low = gc_high = round(args.gc * args.cw_length) / args.cw_length
+        else:
+            gc_low = 0.0 if args.gcl is None else args.gcl
+            gc_high = 1.0 if args.gch is None else args.gch
+        motifs = read_fasta([], args.motifs) if args.motifs else []
+        num = generate_codewords(args.cw_length, args.outp, gc_low, gc_high, args.hp, motifs, args.workers)
+        print("{} code words written to {}".format(num, args.outp))
+        compiled = write_compiled_codebook(args.outp, args.outp[:-5] + 'json')
+        print("Compiled code book written to {}".format(compiled))
+        exit(0)
+
     ck_command = ['java', '-jar', args.path, '-length', str(args.cw_length), '-output', str(args.outp)]
     if args.gc:
         ck_command.append('-gc')
@@ -81,3 +411,7 @@ if __name__ == "__main__":
     lines = Popen(ck_command, stdout=PIPE, stderr=STDOUT)
     for line in lines.stdout:
         print(line.decode())
+    lines.wait()
+
+    compiled = write_compiled_codebook(args.outp, args.outp[:-5] + 'json')
+    print("Compiled code book written to {}".format(compiled))
@@ -0,0 +1,212 @@
+import subprocess
+import threading
+import pathlib
+import atexit
+import json
+import sys
+
+_servers = dict()
+
+
+def print_progress(progress):
+    """
+    default progress callback, prints the progress reported by the inner coder to stderr.
+    :param progress: dict with stage, pass, done, total (None if unknown), seconds and per_second
+    """
+    total = "" if progress["total"] is None else " of {}".format(progress["total"])
+    print("{stage} pass {pass_}: {done}{total} done in {seconds:.1f}s ({per_second:.1f}/s)".format(
+        stage=progress["stage"], pass_=progress["pass"], done=progress["done"], total=total,
+        seconds=progress["seconds"], per_second=progress["per_second"]), file=sys.stderr, flush=True)
+
+
+def watch_progress(stream, progress=print_progress):
+    """
+    read the stderr of an inner coder in a background thread. progress lines ("PROGRESS {...}", see
+    general.progress) are passed to the callback, all other lines are written to stderr.
+    :param stream: stderr pipe of the inner coder (text mode)
+    :param progress: callback for the progress dicts, None to drop them
+    :return: the started thread, it finishes when the inner coder closes stderr
+    """
+    def forward():
+        for line in stream:
+            if line.startswith("PROGRESS "):
+                if progress is not None:
+                    progress(json.loads(line[len("PROGRESS "):]))
+            else:
+                sys.stderr.write(line)
+        stream.close()
+
+    thread = threading.Thread(target=forward, daemon=True)
+    thread.start()
+    return thread
+
+
+def run_inner_coder(args, progress=print_progress, **kwargs):
+    """
+    run arithmetic_modulator_error_correction and wait for it, its progress is reported to the callback.
+    :param args: command line of the inner coder
+    :param progress: callback for the progress dicts (see watch_progress), None to drop them
+    :param kwargs: passed to subprocess.Popen, stdout is discarded unless given
+    :return: return code of the inner coder
+    """
+    kwargs.setdefault("stdout", subprocess.DEVNULL)
+    process = subprocess.Popen(args, stderr=subprocess.PIPE, text=True, **kwargs)
+    watcher = watch_progress(process.stderr, progress)
+    process.wait()
+    watcher.join()
+    return process.returncode
+
+
+class InnerCoder:
+    """
+    client for a long-running inner en-/decoder (arithmetic_modulator_error_correction --serve).
+    the code book is loaded once on startup and kept in memory for all following requests,
+    requests are answered in the order they were sent.
+    """
+
+    def __init__(self, current_path, config_path):
+        """
+        :param current_path: path of the DNA-Aeon folder
+        :param config_path: config used to load the code book, and as default config for all requests
+        """
+        self.lock = threading.Lock()
+        # progress callback of the running request
+        self.progress = None
+        self.process = subprocess.Popen(
+            ["{cpath}/arithmetic_modulator_error_correction".format(cpath=current_path), "--serve", str(config_path)],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, bufsize=1)
+        watch_progress(self.process.stderr, self._report)
+        ready = self._read()
+        if ready.get("status") != "ready":
+            raise RuntimeError("Inner coder did not start: {}".format(ready))
+
+    def _read(self):
+        line = self.process.stdout.readline()
+        if not line:
+            raise RuntimeError("Inner coder terminated unexpectedly.")
+        return json.loads(line)
+
+    def _report(self, progress):
+        if self.progress is not None:
+            self.progress(progress)
+
+    def request(self, op, progress=None, **kwargs):
+        """
+        send a request and yield all of its responses, the final status response is not yielded.
+        :param op: encode, decode, decode_reads or encode_packets
+        :param progress: callback for the progress of the request (see watch_progress)
+        :param kwargs: additional request fields, e.g. config, reads, packets or length
+        :return: generator of response dicts
+        """
+        with self.lock:
+            req = dict(kwargs, op=op)
+            if "config" in req:
+                req["config"] = str(pathlib.Path(req["config"]).resolve())
+            # kept until the next request, the last progress lines may arrive after the final response
+            self.progress = progress
+            self.process.stdin.write(json.dumps(req) + "\n")
+            self.process.stdin.flush()
+            while True:
+                resp = self._read()
+                if "status" in resp:
+                    if resp["status"] == "error":
+                        raise RuntimeError("Inner coder request failed: {}".format(resp["error"]))
+                    return
+                try:
+                    yield resp
+                except BaseException:
+                    # the caller stopped iterating (or raised), the remaining responses are read before the lock is
+                    # released, otherwise the next request would take them for its own
+                    self._drain()
+                    raise
+
+    def _drain(self):
+        try:
+            while "status" not in self._read():
+                pass
+        except RuntimeError:
+            pass
+
+    def encode(self, config_path, progress=print_progress):
+        """
+        encode the file given in the config, same as arithmetic_modulator_error_correction -e config_path
+        """
+        for _ in self.request("encode", progress=progress, config=config_path):
+            pass
+
+    def decode(self, config_path, progress=print_progress):
+        """
+        decode the file given in the config, same as arithmetic_modulator_error_correction -d config_path
+        """
+        for _ in self.request("decode", progress=progress, config=config_path):
+            pass
+
+    def decode_reads(self, reads, length=None, config_path=None, qualities=None):
+        """
+        decode single reads, results are yielded as soon as they are available (not in input order).
+        :param reads: list of DNA sequences
+        :param length: length of the encoded sequences, defaults to decode.length of the config
+        :param config_path: defaults to the config the server was started with
+        :param qualities: optional list of phred+33 quality strings of the reads (as in FASTQ files)
+        :return: generator of (read index, metric, decoded bytes), the metric is "ERR" if no candidate was found
+        """
+        kwargs = dict(reads=list(reads))
+        if qualities is not None:
+            kwargs["qualities"] = list(qualities)
+        if length is not None:
+            kwargs["length"] = length
+        if config_path is not None:
+            kwargs["config"] = config_path
+        for resp in self.request("decode_reads", **kwargs):
+            yield resp["read"], resp["metric"], bytes.fromhex(resp["data"])
+
+    def encode_packets(self, packets, min_length=None, config_path=None):
+        """
+        encode single packets, results are yielded as soon as they are available (not in input order).
+        :param packets: list of bytes
+        :param min_length: minimal length of the encoded sequences, defaults to encode.min_length of the config
+        :param config_path: defaults to the config the server was started with
+        :return: generator of (packet index, DNA sequence)
+        """
+        kwargs = dict(packets=[packet.hex() for packet in packets])
+        if min_length is not None:
+            kwargs["min_length"] = min_length
+        if config_path is not None:
+            kwargs["config"] = config_path
+        for resp in self.request("encode_packets", **kwargs):
+            yield resp["packet"], resp["seq"]
+
+    def close(self):
+        if self.process.poll() is None:
+            try:
+                for _ in self.request("shutdown"):
+                    pass
+            except (RuntimeError, BrokenPipeError):
+                pass
+            self.process.wait()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def get_inner_coder(current_path, config_path):
+    """
+    return the inner coder server for the DNA-Aeon installation at current_path, the server is started on the
+    first call and reused afterwards (a different code book in later configs is loaded on demand).
+    :param current_path:
+    :param config_path:
+    :return: InnerCoder
+    """
+    key = str(current_path)
+    if key not in _servers or _servers[key].process.poll() is not None:
+        _servers[key] = InnerCoder(current_path, pathlib.Path(config_path).resolve())
+    return _servers[key]
+
+
+@atexit.register
+def _close_servers():
+    for server in _servers.values():
+        server.close()
@@ -0,0 +1,220 @@
+"""
+Streaming bridge between NOREC4DNA and the inner coder, has to be run with the NOREC4DNA virtual environment.
+
+Packets are exchanged as frames: uint32 name length, name, uint32 data length, data (little endian), see
+readFrame / writeFrame in cpp/src/commons.cpp.
+
+encode: generate the raptor packets of a file and write them to stdout as soon as they are created.
+decode: read decoded packets from stdin and feed them to the raptor decoder until the file is recovered.
+batch: long-running outer encoder for batch encoding (see encode.py --batch), reads one json request
+       {"file": ..., "packets": ...} per line from stdin, writes the packets of the file to the zip file "packets" and
+       answers with {"file": ..., "packets": <number of packets>, "config": <NOREC4DNA config file>} or
+       {"file": ..., "error": ...}.
+"""
+import argparse
+import configparser
+import json
+import pathlib
+import struct
+import sys
+import zipfile
+
+NOREC4DNA_PATH = pathlib.Path(__file__).parent.resolve() / "NOREC4DNA"
+sys.path.insert(0, str(NOREC4DNA_PATH))
+
+from norec4dna.Encoder import Encoder
+from norec4dna.RU10Encoder import RU10Encoder
+from norec4dna.RU10Decoder import RU10Decoder
+from norec4dna.distributions.RaptorDistribution import RaptorDistribution
+from norec4dna.ErrorCorrection import get_error_correction_encode, get_error_correction_decode
+
+# same formats as used by demo_raptor_encode.py
+PACKET_LEN_FORMAT = "I"
+CRC_LEN_FORMAT = "I"
+NUMBER_OF_CHUNKS_LEN_FORMAT = "I"
+ID_LEN_FORMAT = "I"
+
+
+def write_frame(out, name, data):
+    name = name.encode()
+    out.write(struct.pack("<I", len(name)) + name + struct.pack("<I", len(data)) + data)
+
+
+def read_frame(inp):
+    """
+    :param inp: binary input stream
+    :return: (name, data) or None at the end of the stream
+    """
+    head = inp.read(4)
+    if len(head) < 4:
+        return None
+    name = inp.read(struct.unpack("<I", head)[0]).decode()
+    data = inp.read(struct.unpack("<I", inp.read(4))[0])
+    return name, data
+
+
+class StreamingPackets:
+    """
+    replaces the packet set of the encoder: packets are written to the output as soon as they are added,
+    instead of being kept in memory until all packets are generated.
+    """
+
+    def __init__(self, out):
+        self.out = out
+        self.seeds = set()
+
+    def add(self, packet):
+        if packet.id in self.seeds:
+            return
+        self.seeds.add(packet.id)
+        write_frame(self.out, str(packet.id), packet.get_struct(True))
+        self.out.flush()
+
+    def __len__(self):
+        return len(self.seeds)
+
+    def __contains__(self, packet):
+        return packet.id in self.seeds
+
+    def __iter__(self):
+        # the packets are already written
+        return iter(())
+
+
+class ZipPackets(StreamingPackets):
+    """
+    packets are written to a zip file as soon as they are added, one stored entry per packet (the input of the inner
+    encoder), as the frames of StreamingPackets.
+    """
+
+    def __init__(self, archive):
+        super().__init__(None)
+        self.archive = archive
+
+    def add(self, packet):
+        if packet.id in self.seeds:
+            return
+        self.seeds.add(packet.id)
+        self.archive.writestr(str(packet.id), packet.get_struct(True))
+
+
+def new_encoder(file, args):
+    number_of_chunks = Encoder.get_number_of_chunks_for_file_with_chunk_size(file, args.chunk_size)
+    error_correction = get_error_correction_encode(args.error_correction, args.repair_symbols)
+    encoder = RU10Encoder(file, number_of_chunks, RaptorDistribution(number_of_chunks),
+                          insert_header=args.insert_header, pseudo_decoder=None, chunk_size=0, rules=None,
+                          error_correction=error_correction, packet_len_format=PACKET_LEN_FORMAT,
+                          crc_len_format=CRC_LEN_FORMAT, number_of_chunks_len_format=NUMBER_OF_CHUNKS_LEN_FORMAT,
+                          id_len_format=ID_LEN_FORMAT, save_number_of_chunks_in_packet=False,
+                          checksum_len_str=args.header_crc_str)
+    encoder.set_overhead_limit(args.overhead)
+    return encoder
+
+
+def save_config(encoder, args):
+    """
+    :return: path of the NOREC4DNA config file of the encoded file
+    """
+    conf = {'error_correction': args.error_correction, 'repair_symbols': args.repair_symbols, 'asdna': False,
+            'number_of_splits': 0, 'read_all': False}
+    return str(pathlib.Path(encoder.save_config_file(conf)).resolve())
+
+
+def encode(args):
+    encoder = new_encoder(args.file, args)
+    encoder.encodedPackets = StreamingPackets(sys.stdout.buffer)
+    encoder.encode_to_packets()
+    sys.stdout.buffer.flush()
+    config_filename = save_config(encoder, args)
+    with open(args.config_out, "w") as o_:
+        o_.write(config_filename)
+    print("Streamed {} packets.".format(len(encoder.encodedPackets)), file=sys.stderr)
+
+
+def batch(args):
+    """
+    encode the files of the requests one after another, the interpreter and NOREC4DNA are only loaded once.
+    everything NOREC4DNA prints is redirected to stderr, so that stdout only contains responses.
+    """
+    replies = sys.stdout
+    sys.stdout = sys.stderr
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        req = json.loads(line)
+        try:
+            encoder = new_encoder(req["file"], args)
+            with zipfile.ZipFile(req["packets"], "w", zipfile.ZIP_STORED) as archive:
+                encoder.encodedPackets = ZipPackets(archive)
+                encoder.encode_to_packets()
+            resp = {"file": req["file"], "packets": len(encoder.encodedPackets), "config": save_config(encoder, args)}
+        except Exception as err:
+            resp = {"file": req["file"], "error": "{}: {}".format(type(err).__name__, err)}
+        replies.write(json.dumps(resp) + "\n")
+        replies.flush()
+
+
+def decode(args):
+    """
+    the decoder is configured from the NOREC4DNA config file written during encoding, as done by ConfigWorker.py
+    :return: 0 if the file was recovered
+    """
+    ini = configparser.ConfigParser()
+    ini.read(args.ini)
+    conf = ini[ini.sections()[0]]
+    error_correction = get_error_correction_decode(conf.get("error_correction", "nocode"),
+                                                   conf.getint("repair_symbols", 2))
+    # the section name is the file the packets were read from, used to name the decoded file
+    decoder = RU10Decoder(ini.sections()[0], use_headerchunk=conf.getboolean("insert_header", False),
+                          error_correction=error_correction,
+                          static_number_of_chunks=conf.getint("number_of_chunks", None),
+                          checksum_len_str=conf.get("checksum_len_str", None) or None)
+    decoder.read_all_before_decode = False
+    num_packets = 0
+    decoded = False
+    while not decoded:
+        frame = read_frame(sys.stdin.buffer)
+        if frame is None:
+            break
+        packet = decoder.parse_raw_packet(frame[1], crc_len_format=conf.get("crc_len_format", CRC_LEN_FORMAT),
+                                          number_of_chunks_len_format=conf.get("number_of_chunks_len_format",
+                                                                               NUMBER_OF_CHUNKS_LEN_FORMAT),
+                                          packet_len_format=conf.get("packet_len_format", PACKET_LEN_FORMAT),
+                                          id_len_format=conf.get("id_len_format", ID_LEN_FORMAT))
+        num_packets += 1
+        if packet == "CORRUPT PACKET":
+            continue
+        decoded = decoder.input_new_packet(packet)
+    if not decoded:
+        decoded = decoder.solve()
+    if not decoded:
+        print("Could not recover the file from {} packets.".format(num_packets), file=sys.stderr)
+        return 1
+    decoder.saveDecodedFile(null_is_terminator=conf.getboolean("is_null_terminated", False), print_to_output=False)
+    print("Recovered the file from {} packets.".format(num_packets), file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Stream packets between NOREC4DNA and the DNA-Aeon inner coder.')
+    subparsers = parser.add_subparsers(dest="mode", required=True)
+    enc = subparsers.add_parser("encode")
+    enc.add_argument("file", type=str)
+    enc.add_argument("--config_out", type=str, required=True, help="file to write the path of the NOREC4DNA config to.")
+    bat = subparsers.add_parser("batch")
+    for sub in (enc, bat):
+        sub.add_argument("--chunk_size", type=int, required=True)
+        sub.add_argument("--error_correction", type=str, default="nocode")
+        sub.add_argument("--repair_symbols", type=int, default=2)
+        sub.add_argument("--insert_header", action="store_true")
+        sub.add_argument("--header_crc_str", type=str, default=None)
+        sub.add_argument("--overhead", type=float, default=0.4)
+    dec = subparsers.add_parser("decode")
+    dec.add_argument("ini", type=str, help="NOREC4DNA config file.")
+    args = parser.parse_args()
+    if args.mode == "encode":
+        encode(args)
+    elif args.mode == "batch":
+        batch(args)
+    else:
+        sys.exit(decode(args))
@@ -0,0 +1,324 @@
+"""
+clustering of sequencing reads and consensus calling, used as optional pre-stage of the inner decoder.
+
+reads are bucketed by locality sensitive hashing of their k-mer minhash signatures, reads sharing a bucket are
+joined into a cluster if their (banded) edit distance is small enough. every cluster is then aligned to its center
+read and reduced to a per position majority vote, so that only one sequence per cluster has to be decoded.
+"""
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+import os
+import numpy as np
+
+BASE_CODES = np.zeros(256, dtype=np.uint64)
+for _i, _b in enumerate("ACGT"):
+    BASE_CODES[ord(_b)] = _i
+MAX_HASH = np.uint64(np.iinfo(np.uint64).max)
+
+
+def iter_fasta(filename):
+    """
+    :param filename:
+    :return: generator of all sequences (including duplicates) of the FASTA file, in file order
+    """
+    seq = []
+    with open(filename, "r") as f:
+        for line in f:
+            if line.startswith(">"):
+                if seq:
+                    yield "".join(seq)
+                seq = []
+            elif not line.startswith(";"):
+                seq.append(line.strip())
+    if seq:
+        yield "".join(seq)
+
+
+def iter_fastq(filename):
+    """
+    :param filename:
+    :return: generator of all (sequence, quality) pairs (including duplicates) of the FASTQ file, in file order
+    """
+    with open(filename, "r") as f:
+        for header in f:
+            if not header.strip():
+                continue
+            seq = []
+            for line in f:
+                if line.startswith("+"):
+                    break
+                seq.append(line.strip())
+            seq = "".join(seq)
+            qual = ""
+            while len(qual) < len(seq):
+                line = f.readline()
+                if not line:
+                    break
+                qual += line.strip()
+            if len(qual) != len(seq):
+                raise ValueError("Sequence and quality length differ in {}.".format(filename))
+            yield seq, qual
+
+
+def read_fasta(filename):
+    """
+    :param filename:
+    :return: list of all sequences (including duplicates) of the FASTA file
+    """
+    return list(iter_fasta(filename))
+
+
+def write_fasta(filename, sequences):
+    with open(filename, "w") as f:
+        for i, seq in enumerate(sequences):
+            f.write(">{}\n{}\n".format(i, seq))
+
+
+def mix64(x):
+    """
+    64 bit finalizer of murmurhash3, the multiplications wrap around as intended.
+    """
+    x = x ^ (x >> np.uint64(33))
+    x = x * np.uint64(0xff51afd7ed558ccd)
+    x = x ^ (x >> np.uint64(33))
+    x = x * np.uint64(0xc4ceb9fe1a85ec53)
+    return x ^ (x >> np.uint64(33))
+
+
+def minhash_signatures(reads, k, num_hashes, seed):
+    """
+    :param reads: list of sequences
+    :param k: k-mer length (at most 15)
+    :param num_hashes: length of the signatures
+    :param seed: seed of the hash functions, has to be the same for all reads that are compared
+    :return: array (len(reads) x num_hashes), reads shorter than k get a signature that matches no other read
+    """
+    masks = np.random.default_rng(seed).integers(0, MAX_HASH, num_hashes, dtype=np.uint64, endpoint=True)
+    shifts = np.arange(2 * (k - 1), -1, -2, dtype=np.uint64)
+    signatures = np.full((len(reads), num_hashes), MAX_HASH, dtype=np.uint64)
+    for i, read in enumerate(reads):
+        if len(read) < k:
+            signatures[i] = MAX_HASH - np.uint64(i + 1)
+            continue
+        codes = BASE_CODES[np.frombuffer(read.encode(), dtype=np.uint8)]
+        kmers = np.unique((np.lib.stride_tricks.sliding_window_view(codes, k) << shifts).sum(axis=1))
+        signatures[i] = mix64(kmers[None, :] ^ masks[:, None]).min(axis=1)
+    return signatures
+
+
+def banded_alignment(ref, read, band):
+    """
+    global alignment of read against ref, only considering cells within band of the diagonal.
+    :param ref:
+    :param read:
+    :param band: maximal number of edits
+    :return: (edit distance, ops, ins) where ops[i] is the base of read aligned to ref[i] ("-" if it was deleted)
+             and ins[i] are the bases inserted before ref[i], (None, None, None) if the distance exceeds band
+    """
+    n, m = len(ref), len(read)
+    if abs(n - m) > band:
+        return None, None, None
+    inf = band + 1
+    dist = [[inf] * (m + 1) for _ in range(n + 1)]
+    for j in range(min(m, band) + 1):
+        dist[0][j] = j
+    for i in range(1, n + 1):
+        lo, hi = max(0, i - band), min(m, i + band)
+        row, prev = dist[i], dist[i - 1]
+        if lo == 0:
+            row[0] = i
+        r = ref[i - 1]
+        for j in range(max(1, lo), hi + 1):
+            row[j] = min(prev[j - 1] + (r != read[j - 1]), prev[j] + 1, row[j - 1] + 1)
+        if min(row[lo:hi + 1]) > band:
+            return None, None, None
+    if dist[n][m] > band:
+        return None, None, None
+    # traceback
+    ops = ["-"] * n
+    ins = [""] * (n + 1)
+    i, j = n, m
+    while i > 0 or j > 0:
+        if i > 0 and j > 0 and dist[i][j] == dist[i - 1][j - 1] + (ref[i - 1] != read[j - 1]):
+            ops[i - 1] = read[j - 1]
+            i, j = i - 1, j - 1
+        elif i > 0 and dist[i][j] == dist[i - 1][j] + 1:
+            i -= 1
+        else:
+            ins[i] = read[j - 1] + ins[i]
+            j -= 1
+    return dist[n][m], ops, ins
+
+
+def edit_distance(a, b):
+    """
+    bit-parallel edit distance (Myers / Hyyro), every column of the dp matrix is handled as one integer.
+    :return: edit distance of a and b
+    """
+    m = len(a)
+    if m == 0:
+        return len(b)
+    peq = defaultdict(int)
+    for i, c in enumerate(a):
+        peq[c] |= 1 << i
+    mask = (1 << m) - 1
+    high = 1 << (m - 1)
+    pv, mv, score = mask, 0, m
+    for c in b:
+        eq = peq.get(c, 0)
+        xv = eq | mv
+        xh = (((eq & pv) + pv) ^ pv) | eq
+        ph = mv | (~(xh | pv) & mask)
+        mh = pv & xh
+        if ph & high:
+            score += 1
+        elif mh & high:
+            score -= 1
+        ph = ((ph << 1) | 1) & mask
+        mh = (mh << 1) & mask
+        pv = mh | (~(xv | ph) & mask)
+        mv = ph & xv
+    return score
+
+
+def consensus(reads, band):
+    """
+    star alignment of all reads against the center read (the first read with the most common length), followed by
+    a majority vote for every position and for the insertions between positions.
+    :param reads: reads of one cluster
+    :param band: maximal number of edits between a read and the center read, other reads are not used for voting
+    :return: consensus sequence
+    """
+    if len(reads) <= 2:
+        return reads[0]
+    common_len = Counter(len(read) for read in reads).most_common(1)[0][0]
+    center = next(read for read in reads if len(read) == common_len)
+    votes = [Counter() for _ in center]
+    ins_votes = [Counter() for _ in range(len(center) + 1)]
+    voters = 0
+    for read in reads:
+        dist = edit_distance(center, read)
+        if dist > band:
+            continue
+        # the exact distance is the narrowest band that still contains an optimal alignment
+        _, ops, ins = banded_alignment(center, read, max(1, dist))
+        voters += 1
+        for i, op in enumerate(ops):
+            votes[i][op] += 1
+        for i, seq in enumerate(ins):
+            if seq:
+                ins_votes[i][seq] += 1
+    res = []
+    for i in range(len(center) + 1):
+        if sum(ins_votes[i].values()) * 2 > voters:
+            res.append(ins_votes[i].most_common(1)[0][0])
+        if i < len(center):
+            base = votes[i].most_common(1)[0][0]
+            if base != "-":
+                res.append(base)
+    return "".join(res)
+
+
+_worker_reads = None
+
+
+def _init_worker(reads):
+    # the reads are sent to every worker once instead of with every task
+    global _worker_reads
+    _worker_reads = reads
+
+
+def _signatures(args):
+    start, end, k, num_hashes, seed = args
+    return minhash_signatures(_worker_reads[start:end], k, num_hashes, seed)
+
+
+def _verify_pairs(args):
+    pairs, band = args
+    return [(i, j) for i, j in pairs if edit_distance(_worker_reads[i], _worker_reads[j]) <= band]
+
+
+def _cluster_consensus(args):
+    reads, band, top_n = args
+    cons = consensus(reads, band)
+    if top_n <= 0:
+        return [cons]
+    members = sorted(set(reads) - {cons}, key=lambda read: edit_distance(cons, read))
+    return [cons] + members[:top_n]
+
+
+def _chunks(items, num):
+    size = max(1, -(-len(items) // num))
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def cluster_reads(reads, k=6, num_hashes=32, bands=16, min_similarity=0.125, max_error=0.15, workers=None, seed=0):
+    """
+    cluster reads that are noisy copies of the same sequence.
+    :param reads: list of sequences
+    :param k: k-mer length of the minhash signatures
+    :param num_hashes: length of the minhash signatures, has to be divisible by bands
+    :param bands: number of lsh bands, reads that share all hashes of at least one band are candidates
+    :param min_similarity: minimal fraction of equal signature hashes of a candidate pair
+    :param max_error: maximal edit distance (relative to the read length) of two reads of the same cluster
+    :param workers: number of worker processes
+    :param seed: seed of the hash functions
+    :return: list of clusters (lists of read indices), largest clusters first
+    """
+    if not reads:
+        return []
+    rows = num_hashes // bands
+    band = max(1, int(max_error * float(np.median([len(read) for read in reads]))))
+    workers = workers or os.cpu_count() or 1
+    num_chunks = workers * 4
+    parent = list(range(len(reads)))
+
+    def find(x):
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(reads,)) as pool:
+        size = max(1, -(-len(reads) // num_chunks))
+        signatures = np.concatenate(list(pool.map(_signatures, [(start, start + size, k, num_hashes, seed)
+                                                               for start in range(0, len(reads), size)])))
+        # the bands are processed one after another, so that pairs already joined by an earlier band are skipped
+        for b in range(bands):
+            buckets = defaultdict(list)
+            for i, key in enumerate(signatures[:, b * rows:(b + 1) * rows]):
+                buckets[key.tobytes()].append(i)
+            pairs = []
+            for members in buckets.values():
+                # every read is compared to the first read of the bucket
+                for j in members[1:]:
+                    if find(members[0]) != find(j) and \
+                            np.count_nonzero(signatures[members[0]] == signatures[j]) >= min_similarity * num_hashes:
+                        pairs.append((members[0], j))
+            for verified in pool.map(_verify_pairs, [(chunk, band) for chunk in _chunks(pairs, num_chunks)]):
+                for i, j in verified:
+                    parent[find(i)] = find(j)
+    clusters = defaultdict(list)
+    for i in range(len(reads)):
+        clusters[find(i)].append(i)
+    return sorted(clusters.values(), key=len, reverse=True)
+
+
+def cluster_consensus(reads, top_n=0, max_error=0.15, workers=None, **kwargs):
+    """
+    cluster the reads and reduce every cluster to its consensus sequence.
+    :param reads: list of sequences
+    :param top_n: additionally return the top_n cluster members closest to the consensus
+    :param max_error: see cluster_reads
+    :param workers: number of worker processes
+    :param kwargs: passed to cluster_reads
+    :return: (list of sequences, number of clusters)
+    """
+    clusters = cluster_reads(reads, max_error=max_error, workers=workers, **kwargs)
+    jobs = []
+    for cluster in clusters:
+        members = [reads[i] for i in cluster]
+        jobs.append((members, max(1, int(max_error * len(members[0]))), top_n))
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        res = [seq for seqs in pool.map(_cluster_consensus, jobs, chunksize=max(1, len(jobs) // 64)) for seq in seqs]
+    return res, len(clusters)
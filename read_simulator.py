@@ -0,0 +1,230 @@
+"""
+streaming simulator of sequencing runs, for capacity planning and decoder throughput measurements on inputs shaped
+like real sequencing data.
+
+the encoded oligos are read in chunks, every oligo is sequenced a random number of times (negative binomial
+coverage, with dropout of whole oligos) and every read gets errors from a channel profile: substitution, insertion
+and deletion rates that depend on the position in the read and (for indels) on the length of the homopolymer a base
+belongs to, plus bursts of errors. the reads of each chunk are shuffled and written as FASTA, FASTQ or packed
+sequences (see seqpack.py) before the next chunk is read, so the memory does not grow with the size of the run. the
+output only depends on the input, the settings, the chunk size and the seed.
+
+$ python3 read_simulator.py -i data/encoded.fasta -o data/reads.fastq --coverage 30 --dispersion 4 --dropout 0.01 --profile illumina --seed 1
+"""
+import argparse
+import json
+import time
+from itertools import islice
+import numpy as np
+from error_simulation import pack_seqs, mutate_packed
+import seqpack
+
+# error rates per base, position: error rate multiplier at the start and the end of the read (linear in between),
+# homopolymer: indel rate multiplier per additional base of the homopolymer, burst_*: probability of a burst per
+# read, mean length of a burst in bases and error rate inside a burst
+CHANNEL_PROFILES = {
+    "uniform": {"substitution": 0.005, "insertion": 0.0025, "deletion": 0.0025, "position": [1.0, 1.0],
+                "homopolymer": 1.0, "burst_rate": 0.0, "burst_length": 1.0, "burst_error": 0.0},
+    "illumina": {"substitution": 0.002, "insertion": 0.0001, "deletion": 0.0002, "position": [0.5, 4.0],
+                 "homopolymer": 1.3, "burst_rate": 0.002, "burst_length": 5.0, "burst_error": 0.25},
+    "nanopore": {"substitution": 0.03, "insertion": 0.02, "deletion": 0.03, "position": [1.3, 1.0],
+                 "homopolymer": 1.6, "burst_rate": 0.02, "burst_length": 10.0, "burst_error": 0.3},
+}
+MAX_QUALITY = 41
+
+
+def load_profile(profile, error_multiplier=1.0):
+    """
+    :param profile: name of a profile in CHANNEL_PROFILES or path of a json file, missing values are taken from the
+                    uniform profile
+    :param error_multiplier: factor for the substitution, insertion and deletion rates
+    :return: profile dict
+    """
+    if profile in CHANNEL_PROFILES:
+        values = CHANNEL_PROFILES[profile]
+    else:
+        with open(profile, "r") as inp:
+            values = json.load(inp)
+    res = dict(CHANNEL_PROFILES["uniform"], **values)
+    for key in ("substitution", "insertion", "deletion"):
+        res[key] *= error_multiplier
+    return res
+
+
+def sample_coverage(num_oligos, coverage, dispersion, dropout, rng):
+    """
+    :param num_oligos:
+    :param coverage: mean number of reads per oligo
+    :param dispersion: negative binomial dispersion (smaller is more uneven), 0 for poisson distributed coverage
+    :param dropout: probability of an oligo to get no reads at all
+    :param rng: np.random.Generator
+    :return: number of reads per oligo
+    """
+    if dispersion > 0:
+        counts = rng.negative_binomial(dispersion, dispersion / (dispersion + coverage), size=num_oligos)
+    else:
+        counts = rng.poisson(coverage, size=num_oligos)
+    counts[rng.random(num_oligos) < dropout] = 0
+    return counts
+
+
+def homopolymer_lengths(buf, offsets):
+    """
+    :param buf: packed sequences, see error_simulation.pack_seqs
+    :param offsets:
+    :return: length of the homopolymer every base belongs to
+    """
+    starts = np.ones(len(buf), dtype=bool)
+    starts[1:] = buf[1:] != buf[:-1]
+    starts[offsets[:-1][offsets[:-1] < len(buf)]] = True
+    run_ids = np.cumsum(starts) - 1
+    return np.bincount(run_ids)[run_ids]
+
+
+def sequence_chunk(oligos, counts, profile, rng, with_quality=False):
+    """
+    sequence a chunk of oligos: copy every oligo counts times and add the errors of the profile.
+    :param oligos: list of sequences
+    :param counts: number of reads per oligo
+    :param profile: see load_profile
+    :param rng: np.random.Generator
+    :param with_quality: also simulate phred quality scores
+    :return: (reads, qualities or None, oligo index per read, dict with the number of errors per type)
+    """
+    oligo_buf, oligo_offsets = pack_seqs(oligos)
+    oligo_lens = np.diff(oligo_offsets)
+    hp_lens = homopolymer_lengths(oligo_buf, oligo_offsets)
+    read_oligo = np.repeat(np.arange(len(oligos)), counts)
+    read_lens = oligo_lens[read_oligo]
+    offsets = np.zeros(len(read_oligo) + 1, dtype=np.int64)
+    np.cumsum(read_lens, out=offsets[1:])
+    # position of every base in its read and in the packed oligos
+    within = np.arange(offsets[-1], dtype=np.int64) - np.repeat(offsets[:-1], read_lens)
+    source = np.repeat(oligo_offsets[:-1][read_oligo], read_lens) + within
+    buf = oligo_buf[source]
+
+    rel_pos = within / np.maximum(np.repeat(read_lens, read_lens) - 1, 1)
+    start_factor, end_factor = profile["position"]
+    factor = start_factor + (end_factor - start_factor) * rel_pos
+    hp_factor = profile["homopolymer"] ** (hp_lens[source] - 1)
+    p_sub = profile["substitution"] * factor
+    p_ins = profile["insertion"] * factor * hp_factor
+    p_del = profile["deletion"] * factor * hp_factor
+    if profile["burst_rate"] > 0 and len(read_lens):
+        burst = rng.random(len(read_lens)) < profile["burst_rate"]
+        burst_start = rng.integers(0, np.maximum(read_lens, 1))
+        burst_end = burst_start + rng.geometric(1.0 / max(profile["burst_length"], 1.0), size=len(read_lens))
+        in_burst = (np.repeat(burst, read_lens) & (within >= np.repeat(burst_start, read_lens))
+                    & (within < np.repeat(burst_end, read_lens)))
+        burst_p = profile["burst_error"] / 3
+        p_sub[in_burst] = np.maximum(p_sub[in_burst], burst_p)
+        p_ins[in_burst] = np.maximum(p_ins[in_burst], burst_p)
+        p_del[in_burst] = np.maximum(p_del[in_burst], burst_p)
+    draws = rng.random((3, len(buf)))
+    pos_sub = np.flatnonzero(draws[0] < p_sub)
+    pos_ins = np.flatnonzero(draws[1] < p_ins)
+    pos_del = np.flatnonzero(draws[2] < p_del)
+    buf, offsets, origin = mutate_packed(buf, offsets, pos_sub, pos_ins, pos_del, rng, return_source=True)
+    errors = {"substitutions": len(pos_sub), "insertions": len(pos_ins), "deletions": len(pos_del)}
+
+    data = buf.tobytes().decode("ascii")
+    reads = [data[offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1)]
+    qualities = None
+    if with_quality:
+        # correct bases are called with the expected error rate of their position (with some noise), substituted and
+        # inserted bases with a low quality
+        expected = np.minimum(p_sub + p_ins + p_del, 0.75)
+        wrong = np.zeros(len(expected) + 1, dtype=bool)
+        wrong[pos_sub] = True
+        wrong[-1] = True
+        quality = -10 * np.log10(np.maximum(expected[np.maximum(origin, 0)], 1e-5)) + rng.normal(0, 3, size=len(buf))
+        low = wrong[np.where(origin < 0, -1, origin)]
+        quality[low] = rng.uniform(2, 15, size=int(low.sum()))
+        quality = (np.clip(np.rint(quality), 2, MAX_QUALITY) + 33).astype(np.uint8).tobytes().decode("ascii")
+        qualities = [quality[offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1)]
+    return reads, qualities, read_oligo, errors
+
+
+def simulate_run(input_file, output_file, coverage=30.0, dispersion=4.0, dropout=0.0, profile="illumina",
+                 error_multiplier=1.0, fmt=None, chunk_size=1000, seed=None):
+    """
+    simulate a sequencing run of the encoded oligos and write the reads to output_file.
+    :param input_file: FASTA or packed sequence file of the encoded oligos
+    :param output_file: FASTA, FASTQ or packed sequence file of the reads
+    :param coverage: mean number of reads per oligo
+    :param dispersion: negative binomial dispersion of the coverage, 0 for poisson
+    :param dropout: probability of an oligo to get no reads at all
+    :param profile: channel profile, see load_profile
+    :param error_multiplier: factor for the error rates of the profile
+    :param fmt: fasta, fastq or dnapack, defaults to the extension of output_file
+    :param chunk_size: number of oligos sequenced and written at once
+    :param seed: seed of the random number generator
+    :return: dict with the number of oligos, oligos without reads (dropped), reads, bases and errors per type and the
+             run time
+    """
+    if fmt is None:
+        fmt = "fastq" if str(output_file).endswith((".fastq", ".fq")) else "fasta"
+        if seqpack.is_packed(output_file):
+            fmt = "dnapack"
+    profile = load_profile(profile, error_multiplier)
+    rng = np.random.default_rng(seed)
+    stats = {"oligos": 0, "dropped": 0, "reads": 0, "bases": 0, "substitutions": 0, "insertions": 0, "deletions": 0}
+    start = time.time()
+    oligos = seqpack.iter_sequences(input_file)
+    with seqpack.PackedWriter(output_file) if fmt == "dnapack" else open(output_file, "w") as out:
+        while True:
+            chunk = list(islice(oligos, chunk_size))
+            if not chunk:
+                break
+            counts = sample_coverage(len(chunk), coverage, dispersion, dropout, rng)
+            reads, qualities, read_oligo, errors = sequence_chunk(chunk, counts, profile, rng, fmt == "fastq")
+            order = rng.permutation(len(reads))
+            if fmt == "dnapack":
+                # packed sequences have no names
+                for i in order:
+                    out.write(reads[i])
+            else:
+                lines = []
+                for i in order:
+                    name = "{}_oligo{}".format(stats["reads"] + len(lines), stats["oligos"] + read_oligo[i])
+                    if fmt == "fastq":
+                        lines.append("@{}\n{}\n+\n{}\n".format(name, reads[i], qualities[i]))
+                    else:
+                        lines.append(">{}\n{}\n".format(name, reads[i]))
+                out.write("".join(lines))
+            stats["oligos"] += len(chunk)
+            stats["dropped"] += int(np.count_nonzero(counts == 0))
+            stats["reads"] += len(reads)
+            stats["bases"] += sum(len(read) for read in reads)
+            for key, value in errors.items():
+                stats[key] += value
+    stats["seconds"] = time.time() - start
+    return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Simulate a sequencing run of encoded oligos (coverage, dropout and channel errors).')
+    parser.add_argument('--input', '-i', dest='input', type=str, required=True,
+                        help='FASTA or packed sequence (.dnapack) file of the encoded oligos.')
+    parser.add_argument('--output', '-o', dest='output', type=str, required=True,
+                        help='FASTA, FASTQ (.fastq / .fq) or packed sequence (.dnapack) file for the simulated reads.')
+    parser.add_argument('--format', dest='fmt', choices=["fasta", "fastq", "dnapack"], default=None,
+                        help='output format (default: from the extension of the output file).')
+    parser.add_argument('--coverage', dest='coverage', type=float, default=30.0, help='mean number of reads per oligo.')
+    parser.add_argument('--dispersion', dest='dispersion', type=float, default=4.0,
+                        help='negative binomial dispersion of the coverage, smaller is more uneven (0: poisson).')
+    parser.add_argument('--dropout', dest='dropout', type=float, default=0.0,
+                        help='probability of an oligo to get no reads.')
+    parser.add_argument('--profile', dest='profile', type=str, default="illumina",
+                        help='channel profile ({}) or json file with the profile values.'.format(", ".join(CHANNEL_PROFILES)))
+    parser.add_argument('--error_multiplier', dest='error_multiplier', type=float, default=1.0,
+                        help='factor for the error rates of the profile.')
+    parser.add_argument('--chunk_size', dest='chunk_size', type=int, default=1000,
+                        help='number of oligos sequenced and written at once.')
+    parser.add_argument('--seed', dest='seed', type=int, default=None, help='seed of the random number generator.')
+    args = parser.parse_args()
+    res = simulate_run(args.input, args.output, args.coverage, args.dispersion, args.dropout, args.profile,
+                       args.error_multiplier, args.fmt, args.chunk_size, args.seed)
+    print("Simulated {reads} reads ({bases} bases) of {oligos} oligos ({dropped} dropped) with {substitutions} "
+          "substitutions, {insertions} insertions and {deletions} deletions in {seconds:.2f}s ({rate:.0f} reads/s).".format(
+            rate=res["reads"] / res["seconds"] if res["seconds"] > 0 else 0, **res))
@@ -0,0 +1,222 @@
+"""
+2 bit packed sequence container, a compact replacement for the FASTA files exchanged between the en- and decoder,
+the error simulation and the read simulator. the file can be memory mapped, a single sequence (or all of them) is
+unpacked without reading the rest of the file.
+
+layout (all integers little endian uint64):
+    magic "DNAPACK1", number of sequences n, number of bases, number of escapes
+    packed bases: 4 bases per byte (A=0, C=1, G=2, T=3, first base in the lowest bits), zero padded to 8 bytes
+    offsets: n + 1 base offsets, sequence i is bases offsets[i]:offsets[i + 1]
+    escape positions: base offsets of all symbols besides A, C, G and T (e.g. N), ascending, packed as A
+    escape symbols: one byte per escape position
+reads of any length (e.g. with indels) only differ in their offsets, sequence names are not kept (the FASTA
+converter numbers the sequences).
+
+$ python3 seqpack.py data/encoded.fasta data/encoded.dnapack
+$ python3 seqpack.py data/encoded.dnapack data/encoded.fasta
+"""
+import argparse
+import struct
+from array import array
+import numpy as np
+from read_clustering import iter_fasta
+
+MAGIC = b"DNAPACK1"
+EXTENSION = ".dnapack"
+HEADER = struct.Struct("<8sQQQ")
+
+BASES = np.frombuffer(b"ACGT", dtype=np.uint8)
+BASE_CODES = np.zeros(256, dtype=np.uint8)
+BASE_CODES[BASES] = np.arange(4, dtype=np.uint8)
+IS_BASE = np.zeros(256, dtype=bool)
+IS_BASE[BASES] = True
+# number of sequences that are unpacked at once while iterating
+ITER_BLOCK = 4096
+
+
+def is_packed(path):
+    return str(path).endswith(EXTENSION)
+
+
+def _padded(size):
+    return -(-size // 8) * 8
+
+
+def pack_codes(codes):
+    """
+    :param codes: uint8 array of base codes (0-3), the length has to be a multiple of 4
+    :return: packed bytes
+    """
+    codes = codes.reshape(-1, 4)
+    return (codes[:, 0] | (codes[:, 1] << 2) | (codes[:, 2] << 4) | (codes[:, 3] << 6)).astype(np.uint8).tobytes()
+
+
+def unpack_codes(packed):
+    """
+    :param packed: uint8 array of packed bytes
+    :return: uint8 array of the base codes, 4 per byte
+    """
+    packed = np.asarray(packed, dtype=np.uint8)
+    return np.stack((packed & 3, (packed >> 2) & 3, (packed >> 4) & 3, packed >> 6), axis=1).ravel()
+
+
+class PackedWriter:
+    """
+    writes the sequences one by one, only the offsets and escapes are kept in memory until the file is closed.
+    """
+
+    def __init__(self, path):
+        self.out = open(path, "wb")
+        self.out.write(bytes(HEADER.size))
+        self.offsets = array("Q", [0])
+        self.escape_pos = array("Q")
+        self.escape_sym = bytearray()
+        # codes of the last incomplete byte
+        self.rest = np.zeros(0, dtype=np.uint8)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _write_bases(self, raw):
+        escapes = np.flatnonzero(~IS_BASE[raw])
+        if len(escapes):
+            self.escape_pos.extend((escapes + self.offsets[-1]).tolist())
+            self.escape_sym.extend(raw[escapes].tobytes())
+        codes = np.concatenate((self.rest, BASE_CODES[raw]))
+        full = len(codes) // 4 * 4
+        self.out.write(pack_codes(codes[:full]))
+        self.rest = codes[full:]
+
+    def write(self, seq):
+        raw = np.frombuffer(seq.encode("ascii"), dtype=np.uint8)
+        self._write_bases(raw)
+        self.offsets.append(self.offsets[-1] + len(raw))
+
+    def write_buffer(self, buf, offsets):
+        """
+        write all sequences of a flat buffer at once (see error_simulation.pack_seqs).
+        :param buf: uint8 buffer of the bases
+        :param offsets: offsets of the sequences in buf, starting with 0
+        """
+        self._write_bases(np.asarray(buf, dtype=np.uint8))
+        self.offsets.extend((np.asarray(offsets[1:], dtype=np.uint64) + np.uint64(self.offsets[-1])).tolist())
+
+    def close(self):
+        if self.out.closed:
+            return
+        bases = self.offsets[-1]
+        if len(self.rest):
+            self.out.write(pack_codes(np.concatenate((self.rest, np.zeros(4 - len(self.rest), dtype=np.uint8)))))
+        packed_size = -(-bases // 4)
+        self.out.write(bytes(_padded(packed_size) - packed_size))
+        self.out.write(np.asarray(self.offsets, dtype="<u8").tobytes())
+        self.out.write(np.asarray(self.escape_pos, dtype="<u8").tobytes())
+        self.out.write(bytes(self.escape_sym))
+        self.out.seek(0)
+        self.out.write(HEADER.pack(MAGIC, len(self.offsets) - 1, bases, len(self.escape_pos)))
+        self.out.close()
+
+
+class PackedSequences:
+    """
+    read-only, memory mapped view of a packed sequence file, behaves like a list of sequences.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.data = np.memmap(path, dtype=np.uint8, mode="r")
+        if len(self.data) < HEADER.size:
+            raise ValueError("{} is not a packed sequence file.".format(path))
+        magic, count, self.num_bases, num_escapes = HEADER.unpack(self.data[:HEADER.size].tobytes())
+        if magic != MAGIC:
+            raise ValueError("{} is not a packed sequence file.".format(path))
+        pos = HEADER.size + _padded(-(-self.num_bases // 4))
+        self.packed = self.data[HEADER.size:pos]
+        self.offsets = self.data[pos:pos + 8 * (count + 1)].view("<u8")
+        pos += 8 * (count + 1)
+        self.escape_pos = self.data[pos:pos + 8 * num_escapes].view("<u8")
+        pos += 8 * num_escapes
+        self.escape_sym = self.data[pos:pos + num_escapes]
+        if len(self.offsets) != count + 1 or len(self.escape_sym) != num_escapes:
+            raise ValueError("{} is truncated.".format(path))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def bases(self, start, end):
+        """
+        :param start: first base offset
+        :param end: base offset after the last base
+        :return: uint8 array of the bases (ASCII) start:end of the concatenated sequences
+        """
+        first = start // 4
+        codes = unpack_codes(self.packed[first:-(-end // 4)])
+        res = BASES[codes[start - 4 * first:end - 4 * first]]
+        lo, hi = np.searchsorted(self.escape_pos, np.array([start, end], dtype=np.uint64))
+        res[(self.escape_pos[lo:hi] - np.uint64(start)).astype(np.int64)] = self.escape_sym[lo:hi]
+        return res
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("sequence index out of range")
+        return self.bases(int(self.offsets[i]), int(self.offsets[i + 1])).tobytes().decode("ascii")
+
+    def __iter__(self):
+        for first in range(0, len(self), ITER_BLOCK):
+            last = min(first + ITER_BLOCK, len(self))
+            start = int(self.offsets[first])
+            data = self.bases(start, int(self.offsets[last])).tobytes().decode("ascii")
+            ends = (self.offsets[first:last + 1] - np.uint64(start)).tolist()
+            for i in range(last - first):
+                yield data[ends[i]:ends[i + 1]]
+
+    def to_buffer(self):
+        """
+        :return: (buffer, offsets) of all sequences, the layout of error_simulation.pack_seqs
+        """
+        return self.bases(0, self.num_bases), self.offsets.astype(np.int64)
+
+
+def write_packed(path, sequences):
+    with PackedWriter(path) as out:
+        for seq in sequences:
+            out.write(seq)
+
+
+def iter_sequences(path):
+    """
+    :param path: packed sequence or FASTA file
+    :return: generator of all sequences (including duplicates), in file order
+    """
+    if is_packed(path):
+        return iter(PackedSequences(path))
+    return iter_fasta(path)
+
+
+def fasta_to_packed(fasta, output):
+    write_packed(output, iter_sequences(fasta))
+
+
+def packed_to_fasta(packed, output):
+    with open(output, "w") as out:
+        for i, seq in enumerate(PackedSequences(packed)):
+            out.write(">{}\n{}\n".format(i, seq))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="convert between FASTA and 2 bit packed sequence files, the "
+                                                 "direction is given by the {} extension.".format(EXTENSION))
+    parser.add_argument('input', type=str, help='FASTA or packed sequence file.')
+    parser.add_argument('output', type=str, help='output file.')
+    args = parser.parse_args()
+    if is_packed(args.input) and not is_packed(args.output):
+        packed_to_fasta(args.input, args.output)
+    elif is_packed(args.output) and not is_packed(args.input):
+        fasta_to_packed(args.input, args.output)
+    else:
+        parser.error("exactly one of input and output has to be a {} file.".format(EXTENSION))
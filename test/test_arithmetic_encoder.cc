@@ -8,6 +8,9 @@
 #include "include/FreqTable.h"
 #include "include/ACEncode.h"
 #include "include/ECDecoding.h"
+#include "include/Codebook.h"
+#include "include/Scheduler.h"
+#include "include/SeqPack.h"
 #include "../Zippy/library/Zippy/ZipArchive.hpp"
 
 #define TEST_FILENAME "tmp_test_output.file"
@@ -68,6 +71,12 @@ void test_simple_en_decode(tuple<uint8_t, string, string, string, string> tup, n
     string t2(msg.begin(), msg.end());
     ALEPH_ASSERT_STRING_EQUAL(static_cast<string>(get<0>(results.front())), pred2);
     ALEPH_ASSERT_STRING_EQUAL(t2, data);
+    // the search is stopped once the budget of the read is used up
+    results.clear();
+    config["decode"]["budget"]["nodes"] = 1;
+    do_decode(s2, freqs, tMap, motif, config, codewordLen, results, res_lock);
+    ALEPH_ASSERT_EQUAL(results.size(), 1);
+    ALEPH_ASSERT_STRING_EQUAL(static_cast<string>(get<0>(results.front())), "1000.000000");
 }
 
 void test_load_zip_store_fasta_circle(const robin_hood::unordered_set<string> &input_data, uint8_t sync, nlohmann::json config) {
@@ -105,7 +114,12 @@ void test_load_zip_store_fasta_circle(const robin_hood::unordered_set<string> &i
 
     //test fasta output:
     remove(TEST_FILENAME);
-    write_to_fasta(TEST_FILENAME, results);
+    {
+        FastaWriter out(TEST_FILENAME);
+        for (auto &[name, data]: results)
+            out.write(name, data);
+        out.close();
+    }
     // re-read the fasta file and compare the results:
     robin_hood::unordered_set<string> content = parseFasta(TEST_FILENAME);
     for (auto &ent: results) {
@@ -116,7 +130,12 @@ void test_load_zip_store_fasta_circle(const robin_hood::unordered_set<string> &i
     remove(TEST_FILENAME);
     string filename = TEST_FILENAME;
     filename += ".zip";
-    write_to_zip(filename, true, true, true, results);
+    {
+        ZipWriter out(filename, true, true, true);
+        for (auto &[name, data]: results)
+            out.write(name, data);
+        out.close();
+    }
 
     ALEPH_ASSERT_THROW(std::filesystem::exists(filename));
     results.clear();
@@ -148,6 +167,153 @@ void test_load_zip_store_fasta_circle(const robin_hood::unordered_set<string> &i
     remove(TEST_FILENAME);
 }
 
+void test_compiled_codebook() {
+    string compiled = Codebook::compiledPath("./codewords/t2.fasta");
+    remove(compiled.c_str());
+    Codebook source("./codewords/t2.fasta", "./codewords/motifs.json", false);
+    source.buildDecodeMap();
+    ALEPH_ASSERT_THROW(!source.compiled);
+    ALEPH_ASSERT_THROW(source.writeCompiled(compiled));
+    Codebook cached("./codewords/t2.fasta", "./codewords/motifs.json");
+    ALEPH_ASSERT_THROW(cached.compiled);
+    ALEPH_ASSERT_EQUAL(cached.codewordLen, source.codewordLen);
+    ALEPH_ASSERT_THROW(cached.freqDict == source.freqDict);
+    ALEPH_ASSERT_THROW(cached.pMap == source.pMap);
+    ALEPH_ASSERT_THROW(cached.tMap == source.tMap);
+    ALEPH_ASSERT_THROW(cached.motif == source.motif);
+    for (char base: string("ACGT")) {
+        ALEPH_ASSERT_EQUAL(cached.freqs.get(base), source.freqs.get(base));
+        ALEPH_ASSERT_EQUAL(cached.freqs.getLow(base), source.freqs.getLow(base));
+    }
+    remove(compiled.c_str());
+}
+
+void test_ordered_scheduler() {
+    // later jobs finish first, the results must still be consumed in submission order
+    vector<int> consumed;
+    OrderedScheduler<int> scheduler(4, [&consumed](int &&res) { consumed.push_back(res); }, true, 8);
+    for (int i = 0; i < 32; i++) {
+        scheduler.submit([i] {
+            this_thread::sleep_for(chrono::milliseconds((32 - i) % 5));
+            return i;
+        });
+    }
+    scheduler.finish();
+    ALEPH_ASSERT_EQUAL(consumed.size(), 32);
+    for (int i = 0; i < 32; i++)
+        ALEPH_ASSERT_EQUAL(consumed[i], i);
+}
+
+void test_extend_encode() {
+    // extending a sequence to a larger minimal length gives the sequence of encoding with that length
+    res_lock = new std::mutex();
+    Codebook cb("./codewords/t2.fasta", "./codewords/motifs.json");
+    for (const string &data: {"HelloWorld"s, "12345678912345671234567891234567"s}) {
+        PacketEncoder enc(data, 4, cb.freqs);
+        enc.encode(0);
+        size_t minLen = enc.out.size() + 23;
+        enc.encode(minLen);
+        PacketEncoder direct(data, 4, cb.freqs);
+        direct.encode(minLen);
+        ALEPH_ASSERT_EQUAL(enc.out.size(), minLen);
+        ALEPH_ASSERT_THROW(enc.out == direct.out);
+    }
+}
+
+void test_prob_automaton() {
+    // the state machines give the probabilities of ProbabilityEval (decoder metric) and FreqTable (arithmetic coder)
+    res_lock = new std::mutex();
+    Codebook cb("./codewords/t2.fasta", "./codewords/motifs.json", false);
+    cb.buildDecodeMap();
+    vector<string> words(cb.codewords.begin(), cb.codewords.end());
+    sort(words.begin(), words.end());
+    FreqTable ref(cb.motif, "", 0, false, cb.codewordLen, cb.pMap);
+    ref.calcFreqs();
+    FreqTable compiled = cb.freqs;
+    string seq;
+    uint32_t state = ProbAutomaton::start;
+    for (size_t w = 0; w < 50; w++) {
+        for (char base: words[(w * 7919) % words.size()]) {
+            char2double expected = ProbabilityEval(seq, cb.motif, 0, true, cb.codewordLen, &cb.tMap).nextProbsSingleLetter();
+            BaseProbs probs(cb.decodeStates.probs(state));
+            for (char sym: string("ACGT")) {
+                ALEPH_ASSERT_EQUAL(probs[sym], expected[sym]);
+                ALEPH_ASSERT_EQUAL(compiled.getLow(sym), ref.getLow(sym));
+                ALEPH_ASSERT_EQUAL(compiled.getHigh(sym), ref.getHigh(sym));
+            }
+            ALEPH_ASSERT_EQUAL(compiled.getTotal(), ref.getTotal());
+            seq += base;
+            state = cb.decodeStates.next(state, base);
+            ref.calcNewFreqs(base);
+            compiled.calcNewFreqs(base);
+        }
+    }
+}
+
+void test_seqpack() {
+    // packed sequences of any length (with escaped symbols) are read back as written
+    vector<string> seqs = {"ACGTACGTA", "", "GATTACA", "NNACGNT", "T", string(1001, 'G')};
+    PackedWriter out(TEST_FILENAME);
+    for (const string &seq: seqs)
+        out.write("", vector<unsigned char>(seq.begin(), seq.end()));
+    out.close();
+    PackedSequences packed(TEST_FILENAME);
+    ALEPH_ASSERT_EQUAL(packed.size(), seqs.size());
+    for (size_t i = 0; i < seqs.size(); i++)
+        ALEPH_ASSERT_THROW(packed.get(i) == seqs[i]);
+    ALEPH_ASSERT_THROW(readPacked(TEST_FILENAME) == seqs);
+    remove(TEST_FILENAME);
+}
+
+
+void test_beam_decode(tuple<uint8_t, string, string, string, string> tup, nlohmann::json config) {
+    auto[sync, filename, data, pred1, pred2] = std::move(tup);
+    results = list<tuple<string, vector<unsigned char>>>();
+    res_lock = new std::mutex();
+    robin_hood::unordered_set<string> codewords = parseFasta("./codewords/t2.fasta");
+    robin_hood::unordered_map<string, vector<string>> motif = readConcScheme("./codewords/motifs.json");
+    int codewordLen = getCodewordLen(codewords);
+    auto propMap = ProbMap(codewordLen, false, codewords, motif);
+    robin_hood::unordered_map<string, int32_t> freqDict = propMap.freqDict();
+    robin_hood::unordered_map<string, char2double> pMap = propMap.createTransitionDict(freqDict);
+    FreqTable freqs = FreqTable(motif, "", 0, false, codewordLen, pMap);
+    freqs.calcFreqs();
+    do_encode(data, sync, freqs, 0, filename, results, res_lock);
+    vector<unsigned char> msg = get<1>(results.front());
+    string s(msg.begin(), msg.end());
+    s.at(s.size() - 1) = 'T';
+    robin_hood::unordered_map<string, char2double> tMap = ProbMap(codewordLen, true, codewords,
+                                                            motif).createTransitionDict(freqDict);
+    config["decode"]["length"] = s.size();
+    config["general"]["sync"] = sync;
+    config["decode"]["search"] = "beam";
+    config["decode"]["beam"]["width"] = 64;
+    config["decode"]["beam"]["fallback"] = false;
+    results.clear();
+    do_decode(s, freqs, tMap, motif, config, codewordLen, results, res_lock);
+    ALEPH_ASSERT_EQUAL(results.size(), 1);
+    msg = get<1>(results.front());
+    string t(msg.begin(), msg.end());
+    ALEPH_ASSERT_STRING_EQUAL(t, data);
+    // the beam search never expands more than length * width nodes
+    DecodeStats stats;
+    results.clear();
+    do_decode(s, freqs, tMap, motif, config, codewordLen, results, res_lock, &stats);
+    ALEPH_ASSERT_THROW(stats.success);
+    ALEPH_ASSERT_THROW(stats.nodes <= s.size() * 64);
+    // with a single candidate per step the search is greedy, reads it fails on are decoded with the stack search
+    config["decode"]["beam"]["width"] = 1;
+    results.clear();
+    do_decode(s, freqs, tMap, motif, config, codewordLen, results, res_lock, &stats);
+    ALEPH_ASSERT_THROW(stats.nodes <= s.size());
+    config["decode"]["beam"]["fallback"] = true;
+    results.clear();
+    do_decode(s, freqs, tMap, motif, config, codewordLen, results, res_lock);
+    msg = get<1>(results.front());
+    string t2(msg.begin(), msg.end());
+    ALEPH_ASSERT_STRING_EQUAL(t2, data);
+}
+
 int main(int, char **) {
     robin_hood::unordered_set<string> input_data = {"HelloWorld"s, "test1235"s, "long test 123"s, "\x00""abcdefghij"s,
                                               "test""\x00""123"s, "1234567891234567",
@@ -208,8 +374,14 @@ int main(int, char **) {
     )"_json;
     
     test_data_load();
+    test_compiled_codebook();
+    test_ordered_scheduler();
+    test_extend_encode();
+    test_prob_automaton();
+    test_seqpack();
     for (auto &i: t) {
         test_simple_en_decode(i, config);
+        test_beam_decode(i, config);
     }
     test_load_zip_store_fasta_circle(input_data, 5, config);
     this_thread::sleep_for(chrono::milliseconds(1000));
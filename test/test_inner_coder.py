@@ -0,0 +1,62 @@
+import os
+import pathlib
+import stat
+import sys
+import tempfile
+import textwrap
+import unittest
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+from inner_coder import InnerCoder
+
+# stand-in for arithmetic_modulator_error_correction --serve: decode_reads answers every read with its sequence as
+# data, in reverse order (the real server answers in the order the reads are decoded)
+FAKE_SERVER = textwrap.dedent("""\
+    #!{python}
+    import json
+    import sys
+    print(json.dumps({{"status": "ready"}}), flush=True)
+    for line in sys.stdin:
+        req = json.loads(line)
+        if req["op"] == "decode_reads":
+            for i in reversed(range(len(req["reads"]))):
+                print(json.dumps({{"read": i, "metric": "-1.0", "data": req["reads"][i].encode().hex()}}), flush=True)
+        print(json.dumps({{"status": "ok"}}), flush=True)
+        if req["op"] == "shutdown":
+            break
+""")
+
+
+class TestInnerCoder(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        server = pathlib.Path(self.tmp.name, "arithmetic_modulator_error_correction")
+        server.write_text(FAKE_SERVER.format(python=sys.executable))
+        server.chmod(server.stat().st_mode | stat.S_IEXEC)
+        config = pathlib.Path(self.tmp.name, "config.json")
+        config.write_text("{}")
+        self.coder = InnerCoder(self.tmp.name, config)
+
+    def tearDown(self):
+        self.coder.close()
+        self.tmp.cleanup()
+
+    def decoded(self, reads):
+        return sorted((read, data.decode()) for read, _, data in self.coder.decode_reads(reads))
+
+    def test_abandoned_request(self):
+        first = ["AAAA", "CCCC", "GGGG", "TTTT"]
+        for _ in self.coder.decode_reads(first):
+            break
+        self.assertEqual(self.decoded(["ACGT", "TGCA"]), [(0, "ACGT"), (1, "TGCA")])
+
+    def test_failed_consumer(self):
+        with self.assertRaises(ValueError):
+            for _ in self.coder.decode_reads(["AAAA", "CCCC", "GGGG"]):
+                raise ValueError()
+        self.assertEqual(self.decoded(["ACGT"]), [(0, "ACGT")])
+
+
+if __name__ == "__main__":
+    unittest.main()
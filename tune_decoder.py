@@ -0,0 +1,311 @@
+"""
+parallel tuner for the decoder settings, on top of error_simulation.py.
+
+the input file has to be encoded already (see encode.py), a fixed corpus of mutated copies of the encoded reads is
+generated for the target channel (or reused), and randomly sampled decode settings are evaluated on this corpus by
+successive halving: all candidates decode the first reads sets, the best candidates (by pareto rank of decode time
+and success rate) are promoted to more read sets, until the survivors have decoded the complete corpus.
+with --min_success, candidates are aborted as soon as they can no longer reach the required success rate.
+
+$ python3 tune_decoder.py -c config.json --multiplier 1.0 --corpus_size 27 --candidates 27 --min_success 0.95 -o tuning
+"""
+import argparse
+import json
+import math
+import os
+import pathlib
+import shutil
+import tempfile
+import time
+from copy import deepcopy
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import decode
+import error_simulation
+import read_clustering
+from inner_coder import get_inner_coder
+
+# error rates of the high mutagenesis channel, scaled by the multiplier (see example_configuration_files/README.md)
+BASE_ERROR_RATES = {"substitutions": 0.0238, "deletions": 0.0082, "insertions": 0.0039}
+
+# decode settings that are tuned: (kind, low, high), log / log_int are sampled uniformly on a log scale
+SEARCH_SPACE = {
+    "metric/fano/error_probability": ("log", 0.005, 0.2),
+    "metric/fano/rate/low": ("int", 1, 8),
+    "metric/fano/rate/high": ("int", 2, 10),
+    "metric/penalties/crc": ("float", 0.0, 1.0),
+    "metric/penalties/no_hit": ("int", 2, 16),
+    "queue/size": ("log_int", 1000, 300000),
+    "queue/reduce": ("float", 0.1, 0.9),
+    "threshold/loop": ("int", 0, 4),
+    "threshold/checkpoint": ("int", 1, 8),
+    "threshold/finish": ("int", 0, 2),
+}
+
+
+def sample_params(rng):
+    """
+    :param rng: np.random.Generator
+    :return: dict of decode setting (path relative to decode) to value, rate.high is always larger than rate.low
+    """
+    params = dict()
+    for key, (kind, low, high) in SEARCH_SPACE.items():
+        if kind == "int":
+            params[key] = int(rng.integers(low, high, endpoint=True))
+        elif kind == "float":
+            params[key] = float(rng.uniform(low, high))
+        elif kind == "log":
+            params[key] = float(np.exp(rng.uniform(np.log(low), np.log(high))))
+        else:
+            params[key] = int(np.exp(rng.uniform(np.log(low), np.log(high))))
+    if params["metric/fano/rate/high"] <= params["metric/fano/rate/low"]:
+        params["metric/fano/rate/high"] = params["metric/fano/rate/low"] + 1
+    return params
+
+
+def apply_params(config_data, params):
+    """
+    :return: copy of config_data with the decode settings replaced by params
+    """
+    config = deepcopy(config_data)
+    for key, value in params.items():
+        entry = config["decode"]
+        *path, name = key.split("/")
+        for part in path:
+            entry = entry.setdefault(part, dict())
+        entry[name] = value
+    return config
+
+
+def build_corpus(file, encoded_file, num_errors, size, corpus_dir, seed=None):
+    """
+    mutate the encoded reads size times, existing corpus files are reused.
+    :param file: the original (unencoded) file
+    :param encoded_file: FASTA file of the encoded reads
+    :param num_errors: dict with the substitution, deletion and insertion rates
+    :param size: number of mutated read sets
+    :param corpus_dir:
+    :param seed:
+    :return: list of FASTA files
+    """
+    pathlib.Path(corpus_dir).mkdir(parents=True, exist_ok=True)
+    corpus = [pathlib.Path(corpus_dir, "reads_{}.fasta".format(i)) for i in range(size)]
+    missing = [path for path in corpus if not path.exists()]
+    if missing:
+        encoded_seq = error_simulation.parse_fasta(encoded_file)
+        res = error_simulation.error_counts(encoded_seq, num_errors, "DNA-Aeon", file)
+        seeds = np.random.SeedSequence(seed).spawn(size)
+        for i, path in enumerate(corpus):
+            if path in missing:
+                mutated = error_simulation.modify_seqs(encoded_seq, res, res["num_subs"], res["num_dels"],
+                                                       res["num_ins"], np.random.default_rng(seeds[i]))
+                read_clustering.write_fasta(path, mutated)
+    return corpus
+
+
+def _init_worker(current_path, filename):
+    # the paths of error_simulation.py are set for the DNA-Aeon installation that is tuned
+    error_simulation.DNA_AEON_PATH = current_path
+    error_simulation.FILENAME = filename
+
+
+def evaluate(task):
+    """
+    decode one read set of the corpus with the config of a candidate, used as process pool worker.
+    :param task: dict with the keys candidate, trial, config, reads, file, scratch and use_server
+    :return: dict with the success, the decode wall-clock time and the decode_* telemetry summary
+    """
+    sequences = error_simulation.parse_fasta(task["reads"])
+    with open(task["file"], "rb") as f:
+        ground_truth = f.read()
+    tag = "tune_{}_{}_".format(task["candidate"], task["trial"])
+    trial_dir = tempfile.mkdtemp(prefix=tag, dir=task["scratch"])
+    try:
+        config_path = error_simulation.setup_trial(trial_dir, task["config"])
+        inner_coder = get_inner_coder(error_simulation.DNA_AEON_PATH, config_path) if task["use_server"] else None
+        start = time.perf_counter()
+        success = error_simulation.decode_dna_aeon(sequences, ground_truth, trial_dir, config_path, tag=tag,
+                                                   inner_coder=inner_coder)
+        res = {"success": bool(success), "seconds": time.perf_counter() - start}
+        telemetry_path = trial_dir + "/telemetry.jsonl"
+        if os.path.exists(telemetry_path):
+            summary = decode.summarize_telemetry(decode.read_telemetry(telemetry_path))
+            res.update({"decode_" + key: value for key, value in summary.items()})
+    finally:
+        shutil.rmtree(trial_dir, ignore_errors=True)
+    return res
+
+
+def dominates(a, b):
+    """
+    :return: True if candidate a is at least as fast and successful as b, and better in one of both
+    """
+    return (a["success_rate"] >= b["success_rate"] and a["seconds"] <= b["seconds"] and
+            (a["success_rate"] > b["success_rate"] or a["seconds"] < b["seconds"]))
+
+
+def pareto_fronts(candidates):
+    """
+    non-dominated sorting by decode time and success rate.
+    :param candidates: list of candidates with success_rate and seconds
+    :return: list of fronts (sorted by time), the first front is the pareto front
+    """
+    remaining = list(candidates)
+    fronts = []
+    while remaining:
+        front = [c for c in remaining if not any(dominates(other, c) for other in remaining)]
+        fronts.append(sorted(front, key=lambda c: c["seconds"]))
+        ids = {c["id"] for c in front}
+        remaining = [c for c in remaining if c["id"] not in ids]
+    return fronts
+
+
+def _summarize(candidate):
+    trials = candidate["trials"].values()
+    candidate["success_rate"] = float(np.mean([res["success"] for res in trials])) if trials else 0.0
+    candidate["seconds"] = float(np.mean([res["seconds"] for res in trials])) if trials else math.inf
+
+
+def _promotion_key(candidate, min_success):
+    # inside a front, the candidates that meet min_success are promoted first (fastest first), then the most
+    # successful ones
+    if min_success is not None and candidate["success_rate"] >= min_success:
+        return 0, candidate["seconds"]
+    return 1, -candidate["success_rate"]
+
+
+def tune(current_path, config_data, corpus, file, num_candidates=27, eta=3, min_trials=1, strategy="halving",
+         min_success=None, workers=None, threads_per_trial=1, use_server=True, seed=None, scratch=None):
+    """
+    search the decode settings for the pareto front of decode time and success rate.
+    :param current_path: path of the DNA-Aeon folder
+    :param config_data: base config, the first candidate uses its decode settings as they are
+    :param corpus: list of FASTA files of mutated reads (see build_corpus)
+    :param file: the original (unencoded) file
+    :param num_candidates: number of candidates (including the base config)
+    :param eta: successive halving: 1/eta of the candidates is promoted to eta times as many read sets
+    :param min_trials: successive halving: number of read sets of the first rung
+    :param strategy: halving or random (every candidate decodes the complete corpus)
+    :param min_success: abort candidates that can no longer reach this success rate on the corpus
+    :param workers: number of concurrent decodings, defaults to the cpu count divided by threads_per_trial
+    :param threads_per_trial: number of inner decoder threads used by each decoding (general.threads)
+    :param use_server: decode in the worker processes using a persistent inner decoder instead of starting decode.py
+    :param seed: seed of the sampled settings
+    :param scratch: base directory for the trial directories
+    :return: (all candidates, pareto front of the candidates that decoded the complete corpus)
+    """
+    rng = np.random.default_rng(seed)
+    candidates = [{"id": 0, "params": {}}] + [{"id": i, "params": sample_params(rng)}
+                                             for i in range(1, num_candidates)]
+    for candidate in candidates:
+        candidate["config"] = apply_params(config_data, candidate["params"])
+        candidate["config"]["general"]["threads"] = threads_per_trial
+        candidate["trials"] = dict()
+        candidate["aborted"] = False
+    budgets = []
+    if strategy == "halving":
+        budget = min_trials
+        while budget < len(corpus):
+            budgets.append(budget)
+            budget *= eta
+    budgets.append(len(corpus))
+    if workers is None:
+        workers = max(1, (os.cpu_count() or 1) // threads_per_trial)
+
+    survivors = candidates
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(str(current_path), pathlib.Path(file).name)) as pool:
+        for rung, budget in enumerate(budgets):
+            futures = dict()
+            for candidate in survivors:
+                for trial in range(budget):
+                    if trial not in candidate["trials"]:
+                        task = {"candidate": candidate["id"], "trial": trial, "config": candidate["config"],
+                                "reads": str(corpus[trial]), "file": str(file), "scratch": scratch,
+                                "use_server": use_server}
+                        futures[pool.submit(evaluate, task)] = (candidate, trial)
+            for future in as_completed(futures):
+                if future.cancelled():
+                    continue
+                candidate, trial = futures[future]
+                candidate["trials"][trial] = future.result()
+                if min_success is None or candidate["aborted"]:
+                    continue
+                failures = sum(not res["success"] for res in candidate["trials"].values())
+                if failures > (1 - min_success) * len(corpus):
+                    # the candidate can not reach min_success on the corpus anymore, its remaining decodings are
+                    # not started
+                    candidate["aborted"] = True
+                    for other, (other_candidate, _) in futures.items():
+                        if other_candidate is candidate:
+                            other.cancel()
+            for candidate in survivors:
+                _summarize(candidate)
+            finished = [c for c in survivors if not c["aborted"]]
+            print("Rung {}: {} candidates decoded {} read sets, {} aborted.".format(
+                rung + 1, len(survivors), budget, len(survivors) - len(finished)))
+            if not finished:
+                break
+            if rung + 1 < len(budgets):
+                promoted = max(1, math.ceil(len(finished) / eta))
+                survivors = [c for front in pareto_fronts(finished)
+                             for c in sorted(front, key=lambda c: _promotion_key(c, min_success))][:promoted]
+    complete = [c for c in candidates if len(c["trials"]) == len(corpus) and not c["aborted"]]
+    return candidates, (pareto_fronts(complete)[0] if complete else [])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Tune the DNA-Aeon decoder settings for a channel.')
+    parser.add_argument('--config', '-c', dest='conf', type=str, required=True,
+                        help='config of the encoded file, the decode settings are used as first candidate.')
+    parser.add_argument('--multiplier', type=float, default=1.0,
+                        help='multiplier of the high mutagenesis error rates (see example_configuration_files/README.md).')
+    parser.add_argument('--corpus', type=str, default="data/tuning_corpus",
+                        help='directory of the mutated read sets, existing read sets are reused.')
+    parser.add_argument('--corpus_size', type=int, default=27, help='number of mutated read sets.')
+    parser.add_argument('--candidates', type=int, default=27, help='number of sampled decode settings.')
+    parser.add_argument('--strategy', choices=["halving", "random"], default="halving")
+    parser.add_argument('--eta', type=int, default=3, help='successive halving reduction factor.')
+    parser.add_argument('--min_success', type=float, default=None,
+                        help='required success rate, candidates that can not reach it are aborted.')
+    parser.add_argument('--workers', type=int, default=None, help='number of concurrent decodings.')
+    parser.add_argument('--threads_per_trial', type=int, default=1, help='general.threads of every decoding.')
+    parser.add_argument('--no_server', dest='use_server', action='store_false',
+                        help='start decode.py for every decoding instead of using a persistent inner decoder.')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--scratch', type=str, default=None, help='base directory for temporary files.')
+    parser.add_argument('--output', '-o', type=str, default="tuning",
+                        help='directory for the results and the configs of the pareto front.')
+    args = parser.parse_args()
+
+    cpath = pathlib.Path(__file__).parent.resolve()
+    with open(args.conf, "r") as conf_inp:
+        config_data = json.load(conf_inp)
+    input_file = pathlib.Path(cpath, config_data["encode"]["input"])
+    num_errors = {key: rate * args.multiplier for key, rate in BASE_ERROR_RATES.items()}
+    corpus = build_corpus(input_file, pathlib.Path(cpath, config_data["encode"]["output"]), num_errors,
+                          args.corpus_size, args.corpus, args.seed)
+    candidates, front = tune(cpath, config_data, corpus, input_file, args.candidates, args.eta, 1, args.strategy,
+                             args.min_success, args.workers, args.threads_per_trial, args.use_server, args.seed,
+                             args.scratch)
+
+    pathlib.Path(args.output).mkdir(parents=True, exist_ok=True)
+    for i, candidate in enumerate(front):
+        # the configs keep the threads of the base config
+        with open(pathlib.Path(args.output, "front_{}.json".format(i)), "w") as o_:
+            json.dump(apply_params(config_data, candidate["params"]), o_, indent=2)
+    with open(pathlib.Path(args.output, "results.json"), "w") as o_:
+        json.dump({"channel": num_errors, "corpus": [str(path) for path in corpus], "strategy": args.strategy,
+                   "front": [c["id"] for c in front],
+                   "candidates": [{key: c[key] for key in ("id", "params", "success_rate", "seconds", "aborted")}
+                                  | {"trials": len(c["trials"])} for c in candidates]}, o_, indent=2)
+    print("Pareto front (decode time per read set, success rate):")
+    for i, candidate in enumerate(front):
+        print("  front_{}.json: {:.2f}s, {:.0%}".format(i, candidate["seconds"], candidate["success_rate"]))
+    if args.min_success is not None:
+        meeting = [c for c in front if c["success_rate"] >= args.min_success]
+        if meeting:
+            print("Fastest config with a success rate of at least {:.0%}: front_{}.json".format(
+                args.min_success, front.index(meeting[0])))
+        else:
+            print("No config reached a success rate of {:.0%}.".format(args.min_success))